@@ -5,475 +5,5537 @@ import sysadmintoolkit
 import os
 import os.path
 import tempfile
-import shutil
-import filecmp
 import collections
 import time
 import socket
+import sys
+import json
+import pipes
+import zlib
+import difflib
+import re
+import hashlib
+import signal
+import contextlib
+import glob
+import bisect
+import itertools
+import errno
+import random
+import optparse
+import ConfigParser
+import imp
+import logging
 
 global plugin_instance
 
 plugin_instance = None
 
 
-def get_plugin(logger, config):
-    global plugin_instance
+class ConfigDiagnostic(collections.namedtuple('ConfigDiagnostic', 'line column message')):
+    '''
+    A problem found in a configuration buffer, line and column start at 1
+    '''
+    __slots__ = ()
 
-    if plugin_instance is None:
-        plugin_instance = Keepalived(logger, config)
+    def __str__(self):
+        return 'line %s, column %s: %s' % (self.line, self.column, self.message)
 
-    return plugin_instance
+
+class ConfigSyntaxError(Exception):
+    '''
+    Raised by parse_config when the buffer does not follow the keepalived.conf grammar
+    '''
+    def __init__(self, diagnostic):
+        super(ConfigSyntaxError, self).__init__(str(diagnostic))
+        self.diagnostic = diagnostic
 
 
-class Keepalived(sysadmintoolkit.plugin.Plugin):
+class ConfigEntry(object):
     '''
-    Description
-    -----------
+    One statement of a keepalived.conf file: its values (keyword and arguments)
+    and, for blocks, the list of entries between braces
+    '''
+    __slots__ = ('values', 'body', 'line', 'column')
 
-    Provides a keepalived configuration manager, to manage an any-node
-    cluster of keepalived/LVS servers.
+    def __init__(self, values, body, line, column):
+        self.values = values
+        self.body = body
+        self.line = line
+        self.column = column
 
-    Some keywords are replaced in the master configuration file to
-    generate per node configuration.
+    @property
+    def key(self):
+        return self.values[0]
 
-    Requirements
-    ------------
+    @property
+    def args(self):
+        return self.values[1:]
 
-    The plugin uses the Clustering plugin to communicated with nodes
-    across the cluster.
+    def __repr__(self):
+        return '<ConfigEntry %s at line %s>' % (' '.join(self.values), self.line)
+
+
+# Token order matters, the first alternative matching at a position wins,
+# exactly like the keepalived-check scanner
+_config_token_re = re.compile(r"""
+     (?P<blank>[ \t]+)
+    |(?P<comment>[!\#][^\r\n]*(?=\n|\Z))
+    |(?P<line_end>[\r\n])
+    |(?P<qstr>'[^']*')
+    |(?P<qqstr>"[^"]*")
+    |(?P<open>\{)
+    |(?P<close>\})
+    |(?P<sym>[^ \t\n\r]+)
+    """, re.VERBOSE)
+
+_config_value_tokens = frozenset(['sym', 'qstr', 'qqstr'])
+
+
+def tokenize_config(config_buffer, line=1):
+    '''
+    Returns the list of significant tokens of config_buffer, as
+    (kind, text, line, column) tuples. Blanks and comments are dropped.
+    '''
+    tokens = []
+    line_start = 0
+
+    for match in _config_token_re.finditer(config_buffer):
+        kind = match.lastgroup
+
+        if kind == 'blank' or kind == 'comment':
+            continue
+
+        start = match.start()
+        text = match.group(kind)
+        tokens.append((kind, text, line, start - line_start + 1))
+
+        if kind == 'line_end':
+            if text == '\n':
+                line += 1
+                line_start = start + 1
+        elif kind == 'qstr' or kind == 'qqstr':
+            newlines = text.count('\n')
+            if newlines:
+                line += newlines
+                line_start = start + text.rindex('\n') + 1
+
+    return tokens
+
+
+class _ConfigParser(object):
+    '''
+    Recursive descent version of the keepalived-check grammar:
+
+    ::
+
+      Rule        = line_end* Rbody eof
+      Rbody       = Rconf*
+      Rconf       = Rconf_value+ Rblock? line_end+
+      Rblock      = '{' line_end+ Rbody '}'
+      Rconf_value = sym | qstr | qqstr
+
+    A statement that does not parse always makes the whole file fail,
+    so there is no need for the backtracking of the original parser.
+    '''
+    def __init__(self, tokens, eof_line):
+        self.tokens = tokens
+        self.position = 0
+        self.eof = ('eof', '', eof_line, 1)
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+
+        return self.eof
+
+    def error(self, token, message):
+        if token[0] == 'eof':
+            found = 'end of file'
+        elif token[0] == 'line_end':
+            found = 'end of line'
+        else:
+            found = "'%s'" % token[1]
+
+        raise ConfigSyntaxError(ConfigDiagnostic(token[2], token[3], '%s, found %s' % (message, found)))
+
+    def skip_line_ends(self, after):
+        token = self.peek()
+        if token[0] != 'line_end':
+            self.error(token, 'expected end of line after %s' % after)
+
+        while self.peek()[0] == 'line_end':
+            self.position += 1
+
+    def parse(self):
+        while self.peek()[0] == 'line_end':
+            self.position += 1
+
+        body = self.parse_body(nested=False)
+
+        return ConfigEntry(['root'], body, 1, 1)
+
+    def parse_body(self, nested):
+        body = []
+
+        while True:
+            token = self.peek()
+
+            if token[0] in _config_value_tokens:
+                body.append(self.parse_entry())
+            elif nested and token[0] == 'close':
+                return body
+            elif not nested and token[0] == 'eof':
+                return body
+            elif nested:
+                self.error(token, "expected a keyword or '}'")
+            else:
+                self.error(token, 'expected a keyword')
+
+    def parse_entry(self):
+        first = self.peek()
+        values = []
+
+        while self.peek()[0] in _config_value_tokens:
+            values.append(self.peek()[1])
+            self.position += 1
+
+        body = None
+        if self.peek()[0] == 'open':
+            self.position += 1
+            self.skip_line_ends("'{'")
+
+            body = self.parse_body(nested=True)
+
+            self.position += 1
+            self.skip_line_ends("'}'")
+        else:
+            self.skip_line_ends("'%s'" % values[-1])
+
+        return ConfigEntry(values, body, first[2], first[3])
+
+
+def parse_config(config_buffer, line=1):
+    '''
+    Parses config_buffer and returns the root ConfigEntry, whose body holds
+    the top level entries. line is the line number of the first line of the
+    buffer.
+
+    Raises ConfigSyntaxError if the buffer does not follow the grammar.
+    '''
+    tokens = tokenize_config(config_buffer, line)
+
+    return _ConfigParser(tokens, config_buffer.count('\n') + line).parse()
+
+
+class ValuePattern(object):
+    '''
+    Matches a whole configuration value against a regular expression and,
+    optionally, an integer range
+    '''
+    def __init__(self, name, regex, value_range=None):
+        self.name = name
+        self.regex = re.compile(r'(?:%s)\Z' % regex)
+        self.value_range = value_range
+
+    @classmethod
+    def union(cls, words):
+        return cls('<%s>' % '|'.join(words), '|'.join([re.escape(word) for word in words]))
+
+    def match(self, value):
+        if self.regex.match(value) is None:
+            return False
+
+        if self.value_range is not None:
+            return self.value_range[0] <= int(value) <= self.value_range[1]
+
+        return True
+
+    def __str__(self):
+        return self.name
+
+
+ConfigRule = collections.namedtuple('ConfigRule', 'kind args schema limit')
+
+
+class ConfigSchema(object):
+    '''
+    Ordered rules accepted in a block.
+
+    An entry is handled by the first rule that claims it:
+
+    - *block* and *accept* claim every entry whose keyword matches their first
+      argument, and report an error when the other arguments do not match
+    - *try_block* and *try_accept* only claim entries matching all their arguments
+
+    Rules starting with a literal keyword are indexed, so checking an entry
+    does not depend on the number of rules.
+    '''
+    def __init__(self, rules):
+        self.rules = rules
+
+        self.pattern_indexes = tuple([index for (index, rule) in enumerate(rules) if not isinstance(rule.args[0], str)])
+
+        self.keyword_indexes = {}
+        for (index, rule) in enumerate(rules):
+            if isinstance(rule.args[0], str):
+                self.keyword_indexes.setdefault(rule.args[0], []).append(index)
+
+        for keyword in self.keyword_indexes:
+            self.keyword_indexes[keyword] = tuple(sorted(self.keyword_indexes[keyword] + list(self.pattern_indexes)))
+
+    def candidates(self, key):
+        return self.keyword_indexes.get(key, self.pattern_indexes)
+
+
+def _match_value(pattern, value):
+    if isinstance(pattern, str):
+        return pattern == value
+
+    return pattern.match(value)
+
+
+def _match_values(patterns, values):
+    if len(patterns) != len(values):
+        return False
+
+    for (pattern, value) in zip(patterns, values):
+        if not _match_value(pattern, value):
+            return False
+
+    return True
+
+
+def _block(args, rules):
+    return ConfigRule('block', args, ConfigSchema(rules), None)
+
+
+def _try_block(args, rules):
+    return ConfigRule('try_block', args, ConfigSchema(rules), None)
+
+
+def _accept(*args):
+    return ConfigRule('accept', args, None, None)
+
+
+def _accept_one(*args):
+    return ConfigRule('accept', args, None, 1)
+
+
+def _try_accept(*args):
+    return ConfigRule('try_accept', args, None, None)
+
+
+Aany = ValuePattern('<any>', r'.+')
+Apath = ValuePattern('<path>', r'.+')
+Astr = ValuePattern('<str>', r'[a-zA-Z0-9_\.-]+')
+Anetif = ValuePattern('<netif>', r'[a-zA-Z0-9_\.:]+')
+Aint = ValuePattern('<int>', r'\-?[0-9]+')
+Ahost = ValuePattern('<host>', r'[a-zA-Z0-9_\-\.]+')
+Aip = ValuePattern('<ip>', r'[0-9\.]+')
+Aiprange = ValuePattern('<iprange>', r'[0-9\.\-]+')
+Aipmask = ValuePattern('<ipmask>', r'[0-9\.\/]+')
+Aport = ValuePattern('<port>', r'[0-9]+')
+Amail = ValuePattern('<mail>', r'[a-zA-Z0-9_\-\+\.\@]+')
+Amask = ValuePattern('<mask>', r'[0-9\.]+')
+Adigest = ValuePattern('<digest>', r'[a-fA-F0-9]{32}')
+
+Aint_254_254 = ValuePattern('<-254..254>', r'\-?[0-9]+', (-254, 254))
+Aint_0_255 = ValuePattern('<0..255>', r'\-?[0-9]+', (0, 255))
+
+Alb_algo = ValuePattern.union(['rr', 'wrr', 'lc', 'wlc', 'lblc', 'sh', 'dh'])
+Alb_kind = ValuePattern.union(['NAT', 'DR', 'TUN'])
+Ascope = ValuePattern.union(['site', 'link', 'host', 'nowhere', 'global_defs'])
+
+
+def _build_config_schema(extended=False):
+    '''
+    Rules of keepalived-check, with its --extend option if extended is True
+    '''
+    http_rules = [
+        _block(('url',), [
+            _accept('path', Apath),
+            _accept('digest', Adigest),
+            _accept('status_code', Aint),
+        ]),
+        _accept('connect_port', Aint),
+        _accept('bindto', Aip),
+        _accept('connect_timeout', Aint),
+        _accept('nb_get_retry', Aint),
+        _accept('delay_before_retry', Aint),
+    ]
+
+    real_server_rules = [
+        _accept('weight', Aint),
+        _accept('inhibit_on_failure'),
+        _accept('notify_master', Apath),
+        _accept('notify_down', Apath),
+        _block(('HTTP_GET',), http_rules),
+        _block(('SSL_GET',), http_rules),
+        _block(('TCP_CHECK',), [
+            _accept('connect_port', Aport),
+            _accept('bindto', Aip),
+            _accept('connect_timeout', Aint),
+            _accept('nb_get_retry', Aint),
+            _accept('delay_before_retry', Aint),
+        ]),
+        _block(('SMTP_CHECK',), [
+            _block(('host',), [
+                _accept('connect_ip', Aip),
+                _accept('connect_port', Aport),
+                _accept('bindto', Aip),
+            ]),
+            _accept('connect_timeout', Aint),
+            _accept('retry', Aint),
+            _accept('delay_before_retry', Aint),
+            _accept('helo_name', Aany),
+        ]),
+        _block(('MISC_CHECK',), [
+            _accept('misc_path', Apath),
+            _accept('misc_timeout', Aint),
+            _accept('misc_dynamic'),
+        ]),
+    ]
+
+    if extended:
+        # http://dsas.blog.klab.org/archives/51030424.html
+        real_server_rules.extend([
+            _block(('DNS_CHECK',), [
+                _accept('port', Aport),
+                _accept('timeout', Aint),
+                _accept('retry', Aint),
+                _accept('type', Astr),
+                _accept('name', Astr),
+            ]),
+            _block(('SSL_HELLO',), [
+                _accept('connect_port', Aport),
+                _accept('connect_timeout', Aint),
+                _accept('retry', Aint),
+                _accept('delay_before_retry', Aint),
+                _accept('common_name', Astr),
+            ]),
+            _block(('FTP_CHECK',), [
+                _accept('connect_port', Aport),
+                _accept('bind_to', Aip),
+                _accept('connect_timeout', Aint),
+                _accept('retry', Aint),
+                _accept('delay_before_retry', Aint),
+            ]),
+        ])
+
+    virtual_server_rules = [
+        _accept('delay_loop', Aint),
+        _accept('lb_algo', Alb_algo),
+        _accept('lvs_sched', Alb_algo),
+        _accept('lb_kind', Alb_kind),
+        _accept('lvs_method', Alb_kind),
+        _accept('nat_mask', Aip),
+        _accept('persistence_timeout', Aint),
+        _accept('persistence_granularity', Amask),
+        _accept('protocol', ValuePattern.union(['TCP', 'UDP'])),
+        _accept('ha_suspend'),
+        _accept('virtualhost', Astr),
+        _accept('alpha'),
+        _accept('omega'),
+        _accept('quality', Aint),
+        _accept('hysteresis', Aint),
+        _accept('quorum', Aint),
+        _accept('quorum_up', Apath),
+        _accept('quorum_down', Apath),
+        _accept('sorry_server', Aip, Aport),
+        _try_block(('real_server', Aip, Aport), real_server_rules),
+        _try_block(('real_server', Aip), real_server_rules),
+    ]
+
+    notify_rules = [
+        _accept('notify_master', Apath),
+        _accept('notify_backup', Apath),
+        _accept('notify_fault', Apath),
+        _accept('notify_stop', Apath),
+        _accept('notify', Apath),
+    ]
+
+    root_rules = [
+        _block(('global_defs',), [
+            _block(('notification_email',), [
+                _accept(Amail),
+            ]),
+            _accept('notification_email_from', Amail),
+            _accept('smtp_server', Ahost),
+            _accept('smtp_connect_timeout', Aint),
+            _accept_one('router_id', Astr),
+            _accept_one('lvs_id', Astr),
+        ]),
+        _block(('static_ipaddress',), [
+            _try_accept(Aip, 'dev', Anetif),
+            _try_accept(Aip, 'dev', Anetif, 'scope', Ascope),
+        ]),
+        _try_block(('virtual_server', Ahost, Aport), virtual_server_rules),
+        _try_block(('virtual_server', 'fwmark', Aint), virtual_server_rules),
+        _try_block(('virtual_server', 'group', Astr), virtual_server_rules),
+        _block(('virtual_server_group', Aany), [
+            _accept(Aiprange, Aport),
+            _accept('fwmark', Aint),
+        ]),
+        _block(('vrrp_sync_group', Astr), [
+            _block(('group',), [
+                _accept(Astr),
+            ]),
+        ] + notify_rules + [
+            _accept(Astr),
+        ]),
+        _block(('vrrp_script', Astr), [
+            _accept('script', Apath),
+            _accept('interval', Aint),
+            _accept('weight', Aint),
+        ]),
+        _block(('vrrp_instance', Astr), [
+            _accept('state', ValuePattern.union(['MASTER', 'BACKUP'])),
+            _accept('interface', Anetif),
+            _accept('lvs_sync_daemon_interface', Anetif),
+            _block(('track_interface',), [
+                _try_accept(Anetif),
+                _try_accept(Anetif, 'weight', Aint_254_254),
+            ]),
+            _block(('track_script',), [
+                _try_accept(Apath),
+                _try_accept(Apath, 'weight', Aint_254_254),
+            ]),
+            _accept('dont_track_primary'),
+            _accept('mcast_src_ip', Aip),
+            _accept('garp_master_delay', Aint),
+            _accept_one('virtual_router_id', Aint_0_255),
+            _accept('priority', Aint_0_255),
+            _accept('advert_int', Aint),
+            _block(('authentication',), [
+                _accept('auth_type', ValuePattern.union(['PASS', 'AH'])),
+                _accept('auth_pass', Aany),
+            ]),
+            _block(('virtual_ipaddress',), [
+                _try_accept(Aipmask),
+                _try_accept(Aipmask, 'dev', Anetif),
+                _try_accept(Aipmask, 'label', Aany),
+            ]),
+            _block(('virtual_ipaddress_excluded',), [
+                _try_accept(Aipmask),
+            ]),
+            _block(('virtual_routes',), [
+                _try_accept('src', Aip, Aipmask, 'via', Aip, 'dev', Anetif),
+                _try_accept('blackhole', Aipmask),
+                _try_accept(Aipmask, 'via', Aip, 'dev', Anetif),
+                _try_accept(Aipmask, 'via', Aip),
+                _try_accept(Aipmask, 'dev', Anetif),
+                _try_accept(Aipmask, 'dev', Anetif, 'scope', Ascope),
+            ]),
+            _accept('nopreempt'),
+            _accept('preempt_delay', Aint),
+            _accept('debug'),
+        ] + notify_rules + [
+            _accept('smtp_alert'),
+        ]),
+        _block(('static_route',), [
+            _try_accept('src', Aip, Aipmask, 'via', Aip, 'dev', Anetif),
+            _try_accept(Aipmask, 'via', Aip, 'dev', Anetif),
+            _try_accept(Aipmask, 'via', Aip),
+            _try_accept(Aipmask, 'dev', Anetif),
+        ]),
+    ]
+
+    return ConfigSchema(root_rules)
+
+
+# extended -> ConfigSchema, built on first use, see get_config_schema
+_config_schemas = {}
+
+
+def get_config_schema(extended=False):
+    '''
+    Returns the ConfigSchema of keepalived.conf, with the extended rule set of
+    keepalived-check.rb (its --extend option: DNS_CHECK, SSL_HELLO and
+    FTP_CHECK real server checkers) if extended
+    '''
+    if extended not in _config_schemas:
+        _config_schemas[extended] = _build_config_schema(extended)
+
+    return _config_schemas[extended]
+
+
+def _claim_rule(schema, values):
+    '''
+    Returns (rule index, error message) for the first rule of schema claiming
+    an entry made of values, (None, None) if no rule claims it
+    '''
+    for index in schema.candidates(values[0]):
+        rule = schema.rules[index]
+
+        if rule.kind == 'block' or rule.kind == 'accept':
+            if not _match_value(rule.args[0], values[0]):
+                continue
+
+            if not _match_values(rule.args, values):
+                return (index, '"%s" requires %s' % (' '.join(values), ' '.join([str(arg) for arg in rule.args])))
+        elif not _match_values(rule.args, values):
+            continue
+
+        return (index, None)
+
+    return (None, None)
+
+
+def _check_body(parent, schema, diagnostics, trace):
+    counts = {}
+
+    for entry in parent.body:
+        (index, message) = _claim_rule(schema, entry.values)
+
+        if index is None:
+            diagnostics.append(ConfigDiagnostic(entry.line, entry.column, 'unknown key "%s" at %s' % (entry.key, parent.key)))
+            continue
+
+        if trace is not None:
+            trace[entry.line] = (schema, index, entry)
+
+        if message is not None:
+            diagnostics.append(ConfigDiagnostic(entry.line, entry.column, message))
+            continue
+
+        rule = schema.rules[index]
+
+        if rule.limit is not None:
+            counts[index] = counts.get(index, 0) + 1
+            if counts[index] > rule.limit:
+                diagnostics.append(ConfigDiagnostic(entry.line, entry.column, '"%s" must be %s lines or less' % \
+                                                    (' '.join(entry.values), rule.limit)))
+
+        if rule.schema is not None:
+            if entry.body is None:
+                diagnostics.append(ConfigDiagnostic(entry.line, entry.column, '"%s" requires a block' % ' '.join(entry.values)))
+            else:
+                _check_body(entry, rule.schema, diagnostics, trace)
+
+
+def check_config(root, extended=False, trace=None):
+    '''
+    Checks a parsed configuration against the keepalived-check rules and
+    returns the list of ConfigDiagnostic found, empty if the configuration is valid
+
+    If trace is a dict, it is filled with line -> (schema, rule index, entry)
+    for every entry, so a single line can be re-checked later with _claim_rule.
+    '''
+    diagnostics = []
+
+    _check_body(root, get_config_schema(extended), diagnostics, trace)
+
+    return diagnostics
+
+
+def validate_config(config_buffer, extended=False):
+    '''
+    Parses and checks config_buffer, returns the list of ConfigDiagnostic found
+    '''
+    try:
+        root = parse_config(config_buffer)
+    except ConfigSyntaxError as e:
+        return [e.diagnostic]
+
+    return check_config(root, extended)
+
+
+class ConfigChange(collections.namedtuple('ConfigChange', 'kind path old new')):
+    '''
+    One difference between two configuration trees: kind is 'added', 'removed'
+    or 'changed', path the headers of the enclosing blocks, old and new the
+    ConfigEntry on each side (None when added or removed)
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+        if self.kind == 'added':
+            return '+ %s  (line %s)' % (_format_entry(self.new), self.new.line)
+        elif self.kind == 'removed':
+            return '- %s  (line %s)' % (_format_entry(self.old), self.old.line)
+        else:
+            return '~ %s -> %s  (line %s)' % (' '.join(self.old.values), ' '.join(self.new.args), self.new.line)
+
+
+def _format_entry(entry):
+    if entry.body is None:
+        return ' '.join(entry.values)
+
+    return '%s { %s entries }' % (' '.join(entry.values), _count_entries(entry))
+
+
+def _count_entries(entry):
+    return sum([1 + (_count_entries(child) if child.body is not None else 0) for child in entry.body])
+
+
+def _entry_identities(body):
+    '''
+    Returns the list of (identity, entry) for the entries of body, and the
+    dict of identity -> entry
+
+    A block is identified by its whole header (vrrp_instance VI_1,
+    virtual_server 10.0.0.1 80, real_server 10.0.1.1 80, ...), any other
+    entry by its keyword, so a changed value is reported as a change of that
+    keyword. Entries sharing an identity are paired in order of appearance.
+    '''
+    identities = []
+    entries = {}
+
+    for entry in body:
+        if entry.body is not None:
+            identity = (True, tuple(entry.values), 1)
+        else:
+            identity = (False, entry.key, 1)
+
+        while identity in entries:
+            identity = identity[:2] + (identity[2] + 1,)
+
+        identities.append((identity, entry))
+        entries[identity] = entry
+
+    return (identities, entries)
+
+
+def diff_config_entries(old_body, new_body, path=()):
+    '''
+    Compares two lists of ConfigEntry, matching blocks by identity rather
+    than position, so reordered blocks are not reported
+
+    Returns the list of ConfigChange, those of a block grouped together and
+    followed by the ones of its sub blocks
+    '''
+    (old_identities, old_entries) = _entry_identities(old_body)
+    (new_identities, new_entries) = _entry_identities(new_body)
+
+    changes = []
+    common_blocks = []
+
+    for (identity, old_entry) in old_identities:
+        new_entry = new_entries.get(identity)
+
+        if new_entry is None:
+            changes.append(ConfigChange('removed', path, old_entry, None))
+        elif old_entry.body is not None:
+            common_blocks.append((old_entry, new_entry))
+        elif old_entry.values != new_entry.values:
+            changes.append(ConfigChange('changed', path, old_entry, new_entry))
+
+    for (identity, new_entry) in new_identities:
+        if identity not in old_entries:
+            changes.append(ConfigChange('added', path, None, new_entry))
+
+    for (old_entry, new_entry) in common_blocks:
+        changes.extend(diff_config_entries(old_entry.body, new_entry.body, path + (' '.join(old_entry.values),)))
+
+    return changes
+
+
+def _changed_entries(blocks, unchanged_digests):
+    '''
+    Returns the top level entries of blocks, a list of (text, digest) from
+    split_config_blocks, except the ones of the blocks whose digest is in
+    unchanged_digests
+    '''
+    entries = []
+    line = 1
+
+    for (text, digest) in blocks:
+        if digest not in unchanged_digests:
+            # A last statement without line end is accepted here, the diff is not a validation
+            entries.extend(parse_config(text if text.endswith('\n') else text + '\n', line).body)
+
+        line += text.count('\n')
+
+    return entries
+
+
+def diff_configs(old_config, new_config):
+    '''
+    Structural diff of two configuration buffers, see diff_config_entries
+
+    Top level blocks found unchanged on both sides, wherever they are, are
+    never parsed, so the cost depends on the size of the changes.
+
+    Raises ConfigSyntaxError if one of the changed blocks does not parse
+    '''
+    if old_config == new_config:
+        return []
+
+    old_blocks = [(text, content_digest(text)) for text in split_config_blocks(old_config)]
+    new_blocks = [(text, content_digest(text)) for text in split_config_blocks(new_config)]
+
+    unchanged_digests = set([digest for (text, digest) in old_blocks]) & set([digest for (text, digest) in new_blocks])
+
+    return diff_config_entries(_changed_entries(old_blocks, unchanged_digests), _changed_entries(new_blocks, unchanged_digests))
+
+
+class ContentCache(object):
+    '''
+    Least recently used cache of objects derived from configuration content
+
+    Keys are (kind, sha256 hex digest) tuples, hits and misses are counted per
+    kind. The cache is bounded by the estimated size of its entries, given by
+    the caller when putting them and updated with resize() for entries
+    growing afterwards.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.hits = collections.defaultdict(int)
+        self.misses = collections.defaultdict(int)
+        self.evictions = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses[key[0]] += 1
+            return None
+
+        entry = self.entries.pop(key)
+        self.entries[key] = entry
+        self.hits[key[0]] += 1
+
+        return entry[0]
+
+    def put(self, key, value, size):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+
+        if size > self.max_size:
+            return
+
+        self.entries[key] = (value, size)
+        self.size += size
+
+        self.evict()
+
+    def resize(self, key, size):
+        '''
+        Updates the size of the entry of key, for values growing after they
+        were put, without making it more recently used
+        '''
+        if key not in self.entries:
+            return
+
+        (value, previous_size) = self.entries[key]
+        if size == previous_size:
+            return
+
+        if size > self.max_size:
+            del self.entries[key]
+            self.size -= previous_size
+            self.evictions += 1
+            return
+
+        self.entries[key] = (value, size)
+        self.size += size - previous_size
+
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            (evicted_key, (evicted_value, evicted_size)) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+
+def content_digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+_word_start_braces_re = re.compile(r'(?:^|[ \t\r])([{}]+)')
+
+
+def split_config_blocks(config_buffer):
+    '''
+    Splits config_buffer in top level statements, each one with the blank and
+    comment lines preceding it. Joining the blocks gives back config_buffer.
+
+    Only lines holding braces or quotes are tokenized. The whole buffer is
+    returned as a single block if it may hold a quoted value spanning lines.
+    '''
+    blocks = []
+    block_lines = []
+    depth = 0
+    has_statement = False
+
+    lines = config_buffer.split('\n')
+    last_line = lines.pop()
+
+    for (line, line_end) in [(line, '\n') for line in lines] + [(last_line, '')]:
+        block_lines.append(line + line_end)
+
+        if '{' in line or '}' in line or "'" in line or '"' in line:
+            if "'" in line or '"' in line or '!' in line or '#' in line:
+                for (kind, text, line_number, column) in tokenize_config(line):
+                    if kind == 'open':
+                        depth += 1
+                    elif kind == 'close':
+                        depth -= 1
+                    elif kind == 'sym' and text[0] in '\'"':
+                        return [config_buffer]
+
+                    has_statement = True
+            else:
+                # Braces are tokens only at the start of a word, like the tokenizer sees them
+                for braces in _word_start_braces_re.findall(line):
+                    depth += braces.count('{') - braces.count('}')
+
+                has_statement = True
+        elif not has_statement:
+            stripped = line.strip(' \t\r')
+            has_statement = stripped != '' and stripped[0] not in '!#'
+
+        if has_statement and depth <= 0:
+            blocks.append(''.join(block_lines))
+            block_lines = []
+            depth = 0
+            has_statement = False
+
+    if block_lines and block_lines != ['']:
+        blocks.append(''.join(block_lines))
+
+    return blocks
+
+
+_nodeset_re = re.compile(r'^\s*\$nodeset(?:\s+(.*?))?\s*$')
+
+
+def nodeset_scope(line):
+    '''
+    Returns the nodesets named by a $nodeset line as a frozenset, empty for
+    '$nodeset *' (all nodesets), or None if line is not a $nodeset line
+    '''
+    match = _nodeset_re.match(line)
+
+    if match is None:
+        return None
+
+    nodesets = frozenset((match.group(1) or '').split())
+
+    if '*' in nodesets:
+        return frozenset()
+
+    return nodesets
+
+
+def nodeset_marker(block_text):
+    '''
+    Returns the scope (see nodeset_scope) of a top level $nodeset line
+    starting a section of the master configuration, block_text being a block
+    of split_config_blocks, or None if the block is not such a line
+    '''
+    for line in block_text.split('\n'):
+        stripped = line.strip(' \t\r')
+
+        if stripped and stripped[0] not in '!#':
+            return nodeset_scope(line)
+
+    return None
+
+
+def split_nodeset_sections(master_config):
+    '''
+    Splits master_config at its top level $nodeset lines
+
+    Returns an ordered dict of section name -> text, the name being the
+    sorted nodesets of the $nodeset line ('*' for all nodesets), None for
+    the text before the first $nodeset line. Sections with the same name are
+    joined, so joining the texts gives back master_config when no name is
+    repeated.
+    '''
+    sections = collections.OrderedDict()
+    name = None
+
+    for block_text in split_config_blocks(master_config):
+        scope = nodeset_marker(block_text)
+
+        if scope is not None:
+            name = ' '.join(sorted(scope)) or '*'
+
+        sections[name] = sections.get(name, '') + block_text
+
+    return sections
+
+
+def merge_nodeset_masters(master_config, nodeset_masters):
+    '''
+    Returns master_config with the section of each nodeset of nodeset_masters
+    (a dict of nodeset -> master configuration of that nodeset) replaced by
+    a $nodeset line and its master configuration. Nodesets without a section
+    are appended, a None master removes the section.
+    '''
+    sections = split_nodeset_sections(master_config)
+
+    for nodeset in nodeset_masters:
+        if nodeset_masters[nodeset] is None:
+            sections.pop(nodeset, None)
+            continue
+
+        section = '$nodeset %s\n%s' % (nodeset, nodeset_masters[nodeset])
+
+        if not section.endswith('\n'):
+            section += '\n'
+
+        sections[nodeset] = section
+
+    config = ''
+    for section in sections.values():
+        if config and not config.endswith('\n'):
+            config += '\n'
+
+        config += section
+
+    return config
+
+
+class TemplateBlock(object):
+    '''
+    One top level statement of a master configuration file
+
+    Lines without any '$' are joined in static chunks and copied verbatim,
+    only lines that may hold a special keyword are substituted for each node.
+
+    The statement is parsed and checked once, for a reference node. For each
+    node, only the lines holding a keyword are checked again. The block is
+    fully validated for a node only when one of its lines does not tokenize
+    like the reference one, or when the reference itself is not valid.
+
+    Renders and node diagnostics are kept, so a block shared by several
+    templates through the cache is only rendered and checked once per node.
+    estimated_size grows with them, for the cache to account for it.
+    '''
+    slb_hostname_keyword = '$slb_hostname'
+    master_backup_keyword = '$master_backup'
+
+    master_priority = 'priority 150'
+    backup_priority = 'priority 100'
+    other_priority = 'priority 50'
+
+    other_re = re.compile(r'\$master_backup.*$')
+    deleted_line_re = re.compile(r'\s*\$')
+
+    # Node name used to check the structure of the block once, it is never
+    # the master or backup of any vrrp_instance unless a node has this name
+    reference_node = 'slb-reference'
+
+    def __init__(self, text, digest=None):
+        self.text = text
+        self.digest = digest or content_digest(text)
+
+        # Each segment is either (static_chunk, newline_count) or (None, (line, line_end))
+        self.segments = []
+
+        lines = text.split('\n')
+        last_line = lines.pop()
+
+        static_lines = []
+        for line in lines:
+            if '$' in line:
+                self._add_static(static_lines)
+                static_lines = []
+                self.segments.append((None, (line, '\n')))
+            else:
+                static_lines.append(line + '\n')
+
+        if '$' in last_line:
+            self._add_static(static_lines)
+            static_lines = []
+            self.segments.append((None, (last_line, '')))
+        else:
+            static_lines.append(last_line)
+
+        self._add_static(static_lines)
+
+        self.has_keywords = len([segment for segment in self.segments if segment[0] is None]) > 0
+
+        # Scope of the $nodeset line of the block (see nodeset_scope), and
+        # whether the block is a section starting $nodeset line itself
+        self.nodeset_scope = None
+        self.is_nodeset_marker = False
+
+        if self.has_keywords:
+            self.is_nodeset_marker = nodeset_marker(text) is not None
+
+            for (static_chunk, value) in self.segments:
+                if static_chunk is None and self.nodeset_scope is None:
+                    self.nodeset_scope = nodeset_scope(value[0])
+
+        self.reference = None
+        self.renders = {}
+        self.node_diagnostics = {}
+
+        # Node -> ($master_backup master regex, backup regex)
+        self.node_patterns = {}
+
+        # Rough allowance for the text, its parse tree, then its per node
+        # renders and diagnostics
+        self.estimated_size = len(text) * 8
+
+    def _add_static(self, static_lines):
+        if static_lines:
+            static_chunk = ''.join(static_lines)
+            self.segments.append((static_chunk, static_chunk.count('\n')))
+
+    def _node_patterns(self, node):
+        if node not in self.node_patterns:
+            escaped_node = re.escape(node)
+
+            self.node_patterns[node] = (re.compile(r'\$master_backup\s*%s\s*\S*\s*$' % escaped_node),
+                                        re.compile(r'\$master_backup\s*\S*\s*%s\s*$' % escaped_node))
+            self.estimated_size += 1000
+
+        return self.node_patterns[node]
+
+    def _render_line(self, line, node, node_patterns):
+        '''
+        Returns line substituted for node, None if the line is deleted
+        '''
+        line = line.replace(self.slb_hostname_keyword, node, 1)
+
+        if self.master_backup_keyword in line:
+            if node in line:
+                line = node_patterns[0].sub(self.master_priority, line, 1)
+                line = node_patterns[1].sub(self.backup_priority, line, 1)
+
+            line = self.other_re.sub(self.other_priority, line, 1)
+
+        if self.deleted_line_re.match(line):
+            return None
+
+        return line
+
+    def _render_node(self, node):
+        '''
+        Renders the block for node, keeps (rendered block, line count,
+        rendered keyword lines) in self.renders
+        '''
+        node_patterns = self._node_patterns(node)
+
+        output = []
+        keyword_lines = []
+        for (static_chunk, dynamic_line) in self.segments:
+            if static_chunk is not None:
+                output.append(static_chunk)
+                continue
+
+            line = self._render_line(dynamic_line[0], node, node_patterns)
+            keyword_lines.append(line)
+
+            if line is not None:
+                output.append(line + dynamic_line[1])
+
+        rendered = ''.join(output)
+        self.renders[node] = (rendered, rendered.count('\n'), keyword_lines)
+        self.estimated_size += len(rendered) + len(keyword_lines) * 100 + 100
+
+    def render(self, node):
+        '''
+        Returns the block rendered for node as a string
+        '''
+        if not self.has_keywords:
+            return self.text
+
+        if node not in self.renders:
+            self._render_node(node)
+
+        return self.renders[node][0]
+
+    def line_count(self, node):
+        '''
+        Returns the number of lines of the block rendered for node
+        '''
+        if not self.has_keywords:
+            return self.segments[0][1]
+
+        if node not in self.renders:
+            self._render_node(node)
+
+        return self.renders[node][1]
+
+    def _check_reference(self):
+        '''
+        Renders and checks the block for the reference node
+
+        Sets self.reference to (diagnostics, keyword lines, trace), keyword
+        lines being a list of (master line, output line number, reference line)
+        for every line holding a keyword. The reference line is None if it
+        was deleted.
+        '''
+        node_patterns = self._node_patterns(self.reference_node)
+
+        output = []
+        keyword_lines = []
+        line_number = 1
+        for (static_chunk, dynamic_line) in self.segments:
+            if static_chunk is not None:
+                output.append(static_chunk)
+                line_number += dynamic_line
+                continue
+
+            line = self._render_line(dynamic_line[0], self.reference_node, node_patterns)
+            keyword_lines.append((dynamic_line[0], line_number, line))
+
+            if line is not None:
+                output.append(line + dynamic_line[1])
+                line_number += 1
+
+        trace = {}
+        try:
+            diagnostics = check_config(parse_config(''.join(output)), trace=trace)
+        except ConfigSyntaxError as e:
+            diagnostics = [e.diagnostic]
+
+        self.reference = (diagnostics, keyword_lines, trace)
+
+    def _recheck_line(self, line, reference_line, traced):
+        '''
+        Checks a keyword line rendered for a node against the reference line,
+        traced being the (schema, rule index, entry values) of the entry
+        starting on that line in the reference, None if there is none
+
+        Returns (column, message) for an invalid line, True if the line is valid,
+        or None if the line differs too much from the reference and the block
+        must be fully validated
+        '''
+        if line is None or reference_line is None:
+            return None
+
+        tokens = tokenize_config(line)
+        reference_tokens = tokenize_config(reference_line)
+
+        if [token[0] for token in tokens] != [token[0] for token in reference_tokens]:
+            return None
+
+        values = [token[1] for token in tokens if token[0] in _config_value_tokens]
+
+        if not values:
+            return True
+
+        if traced is None:
+            # Inside a value spanning several lines
+            return None
+
+        (schema, index, entry_values) = traced
+
+        if tuple([token[1] for token in reference_tokens if token[0] in _config_value_tokens]) != entry_values:
+            return None
+
+        (node_index, message) = _claim_rule(schema, values)
+
+        if node_index != index:
+            return None
+
+        if message is not None:
+            return (tokens[0][3], message)
+
+        return True
+
+    def _recheck_node(self, node, checked_lines):
+        '''
+        Checks the keyword lines of node, checked_lines caches the result of
+        lines already checked for other nodes or blocks
+
+        Returns the list of ConfigDiagnostic of node, or None if the block
+        must be fully validated
+        '''
+        (reference_diagnostics, keyword_lines, trace) = self.reference
+
+        if node not in self.renders:
+            self._render_node(node)
+
+        diagnostics = []
+        for ((master_line, line_number, reference_line), line) in zip(keyword_lines, self.renders[node][2]):
+            if line == reference_line:
+                continue
+
+            traced = None
+            if line_number in trace:
+                (schema, index, entry) = trace[line_number]
+                traced = (schema, index, tuple(entry.values))
+
+            key = (line, reference_line, traced)
+            if key not in checked_lines:
+                checked_lines[key] = self._recheck_line(line, reference_line, traced)
+
+            result = checked_lines[key]
+
+            if result is None:
+                return None
+            elif result is not True:
+                diagnostics.append(ConfigDiagnostic(line_number, result[0], result[1]))
+
+        return diagnostics
+
+    def check(self, node, checked_lines=None):
+        '''
+        Returns the list of ConfigDiagnostic of the block rendered for node,
+        line numbers being relative to the start of the block
+
+        checked_lines may be shared by the blocks of a template, to check
+        keyword lines rendering the same way in several blocks only once.
+        '''
+        if self.reference is None:
+            self._check_reference()
+
+        if not self.has_keywords:
+            return self.reference[0]
+
+        if node not in self.node_diagnostics:
+            diagnostics = None
+
+            if not self.reference[0]:
+                if checked_lines is None:
+                    checked_lines = {}
+
+                diagnostics = self._recheck_node(node, checked_lines)
+
+            if diagnostics is None:
+                diagnostics = validate_config(self.render(node))
+
+            self.node_diagnostics[node] = diagnostics
+            self.estimated_size += len(diagnostics) * 100 + 100
+
+        return self.node_diagnostics[node]
+
+
+class ConfigTemplate(object):
+    '''
+    Master configuration file compiled for per node generation
+
+    The master is split in top level blocks (see TemplateBlock), the
+    substitutions are the same as the original sed pipeline, applied in
+    the same order on each line:
+
+    ::
+
+      s/\$slb_hostname/<node>/
+      s/\$master_backup\s*<node>\s*\S*\s*$/priority 150/
+      s/\$master_backup\s*\S*\s*<node>\s*$/priority 100/
+      s/\$master_backup.*$/priority 50/
+      /^\s*\$/d
+
+    Blocks and validation results are looked up in cache by content digest,
+    so a master differing by one block from a previous one only renders
+    and checks that block again.
+
+    A block holding a $nodeset line is only part of the configuration of the
+    nodes of the nodesets it names, node_nodesets being a dict of node -> its
+    nodesets. A top level $nodeset line does the same for every following
+    block, up to the next one ('$nodeset *' for all nodesets again). Without
+    node_nodesets, every node gets every block.
+    '''
+    def __init__(self, master_config, cache=None, node_nodesets=None):
+        self.cache = cache
+        self.node_nodesets = node_nodesets
+        self.blocks = []
+
+        for text in split_config_blocks(master_config):
+            digest = content_digest(text)
+
+            block = None
+            if cache is not None:
+                block = cache.get(('block', digest))
+
+            if block is None:
+                block = TemplateBlock(text, digest)
+
+                if cache is not None:
+                    cache.put(('block', digest), block, block.estimated_size)
+
+            self.blocks.append(block)
+
+        # Nodesets each block is scoped to, None for all nodesets
+        self.block_scopes = []
+
+        section_scope = None
+        for block in self.blocks:
+            if block.is_nodeset_marker:
+                section_scope = block.nodeset_scope or None
+
+            if block.nodeset_scope is not None and not block.is_nodeset_marker:
+                self.block_scopes.append(block.nodeset_scope or None)
+            else:
+                self.block_scopes.append(section_scope)
+
+        # Frozenset of nodesets -> blocks of the nodes of these nodesets
+        self.scoped_blocks = {}
+
+    def node_blocks(self, node):
+        '''
+        Returns the blocks of the configuration of node
+        '''
+        if self.node_nodesets is None:
+            return self.blocks
+
+        nodesets = frozenset(self.node_nodesets.get(node, []))
+
+        if nodesets not in self.scoped_blocks:
+            self.scoped_blocks[nodesets] = [block for (block, scope) in zip(self.blocks, self.block_scopes) \
+                                            if scope is None or scope & nodesets]
+
+        return self.scoped_blocks[nodesets]
+
+    def nodesets(self):
+        '''
+        Returns the set of nodesets named by the $nodeset lines
+        '''
+        return set([nodeset for scope in self.block_scopes if scope is not None for nodeset in scope])
+
+    def resize_cached_blocks(self):
+        '''
+        Updates the size of the cached blocks of this template, which grows
+        as they are rendered and checked for more nodes
+        '''
+        if self.cache is None:
+            return
+
+        for block in self.blocks:
+            if block.has_keywords:
+                self.cache.resize(('block', block.digest), block.estimated_size)
+
+    def render(self, node):
+        '''
+        Returns the configuration of node as a string
+        '''
+        config = ''.join([block.render(node) for block in self.node_blocks(node)])
+
+        self.resize_cached_blocks()
+
+        return config
+
+    def node_role(self, node):
+        '''
+        Returns 'master' if node is the master of at least one $master_backup
+        line, 'backup' if it is the backup of at least one, 'other' otherwise
+        '''
+        role = 'other'
+
+        for block in self.node_blocks(node):
+            if not block.has_keywords:
+                continue
+
+            node_patterns = block._node_patterns(node)
+
+            for (static_chunk, value) in block.segments:
+                if static_chunk is not None:
+                    continue
+
+                line = value[0].replace(TemplateBlock.slb_hostname_keyword, node, 1)
+                if TemplateBlock.master_backup_keyword not in line or node not in line:
+                    continue
+
+                if node_patterns[0].search(line):
+                    return 'master'
+                elif node_patterns[1].search(line):
+                    role = 'backup'
+
+        return role
+
+    def validate(self, node_configs):
+        '''
+        Validates the configuration of every node, node_configs being an
+        ordered dict of node -> configuration rendered from this template
+
+        Returns an ordered dict of node -> list of ConfigDiagnostic
+        '''
+        checked_lines = {}
+        static_blocks_ok = len([block for block in self.blocks if not block.has_keywords and block.check(None)]) == 0
+
+        node_diagnostics = collections.OrderedDict()
+
+        for node in node_configs:
+            digest = content_digest(node_configs[node])
+
+            diagnostics = None
+            if self.cache is not None:
+                diagnostics = self.cache.get(('validation', digest))
+
+            if diagnostics is None:
+                diagnostics = []
+                node_blocks = self.node_blocks(node)
+
+                # Line numbers are only needed when something is wrong
+                if not static_blocks_ok or [block for block in node_blocks if block.has_keywords and block.check(node, checked_lines)]:
+                    line_offset = 0
+
+                    for block in node_blocks:
+                        for diagnostic in block.check(node, checked_lines):
+                            diagnostics.append(diagnostic._replace(line=diagnostic.line + line_offset))
+
+                        line_offset += block.line_count(node)
+
+                if self.cache is not None:
+                    self.cache.put(('validation', digest), diagnostics, len(diagnostics) * 100 + 100)
+
+            node_diagnostics[node] = diagnostics
+
+        self.resize_cached_blocks()
+
+        return node_diagnostics
+
+
+class ConfigIncludeError(Exception):
+    def __init__(self, message):
+        super(ConfigIncludeError, self).__init__(message)
+
+        self.message = message
+
+
+class ConfigExpansion(object):
+    '''
+    A master configuration with its include directives replaced by the
+    content of the included files
+
+    graph is the dependency graph, an ordered dict of file -> list of the
+    files it includes (the master being None), and digests the content
+    digest of every included file.
+    '''
+    def __init__(self, config, graph, digests, source_map):
+        self.config = config
+        self.graph = graph
+        self.digests = digests
+
+        # Sorted list of (first expanded line, file or None, line in that file)
+        self.source_map = source_map
+        self.source_lines = [segment[0] for segment in source_map]
+
+    def locate(self, line):
+        '''
+        Returns (file or None for the master, line in that file) of a line of
+        the expanded configuration
+        '''
+        if not self.source_map:
+            return (None, line)
+
+        (first_line, source, source_line) = self.source_map[max(0, bisect.bisect_right(self.source_lines, line) - 1)]
+
+        return (source, source_line + line - first_line)
+
+    def describe(self, diagnostic):
+        '''
+        Returns a ConfigDiagnostic as a string, located in the file it comes from
+        '''
+        (source, line) = self.locate(diagnostic.line)
+
+        located = 'line %s, column %s: %s' % (line, diagnostic.column, diagnostic.message)
+
+        if source is None:
+            return located
+
+        return '%s %s' % (source, located)
+
+    def includers(self, files):
+        '''
+        Returns the files whose expansion depends on files: every file from
+        which one of them can be reached in the dependency graph, the master
+        being None
+        '''
+        reverse_graph = collections.defaultdict(set)
+        for (source, included_files) in self.graph.iteritems():
+            for included_file in included_files:
+                reverse_graph[included_file].add(source)
+
+        reached = set()
+        pending = list(files)
+        while pending:
+            for source in reverse_graph[pending.pop()]:
+                if source not in reached:
+                    reached.add(source)
+                    pending.append(source)
+
+        return reached
+
+
+class ConfigIncludes(object):
+    '''
+    Expands keepalived's include directive (include <path or glob>) in master
+    configurations
+
+    Relative paths are relative to base_dir (the config dir), glob matches
+    are included in sorted order like keepalived does. A glob matching
+    nothing is ignored, a missing file or an include cycle is an error.
+
+    Included files are read again only when their size or mtime change, so
+    expanding an unchanged tree only costs a stat per file. Blocks of
+    unchanged files are found in the template cache, so only the files that
+    changed and the blocks that include them are rendered and checked again.
+    '''
+    include_re = re.compile(r'^[ \t]*include[ \t]+(\S+)[ \t]*(?:[!#].*)?$')
+
+    max_depth = 16
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+        # Path -> (size, mtime, content, digest)
+        self.files = {}
+
+    def read(self, path):
+        '''
+        Returns the content of path and its digest
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            raise ConfigIncludeError('Cannot read included file %s: %s' % (path, e.strerror))
+
+        cached = self.files.get(path)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime):
+            return cached[2:]
+
+        fd = open(path, 'r')
+        content = fd.read()
+        fd.close()
+
+        self.files[path] = (stat.st_size, stat.st_mtime, content, content_digest(content))
+
+        return self.files[path][2:]
+
+    def resolve(self, pattern):
+        '''
+        Returns the files matched by the path or glob pattern of an include
+        '''
+        path = os.path.normpath(os.path.join(self.base_dir, pattern))
+
+        if not glob.has_magic(path):
+            return [path]
+
+        return sorted([match for match in glob.glob(path) if os.path.isfile(match)])
+
+    def relpath(self, path):
+        '''
+        Returns path relative to base_dir if it is inside, path otherwise
+        '''
+        relative_path = os.path.relpath(path, self.base_dir)
+
+        if relative_path.startswith('..'):
+            return path
+
+        return relative_path
+
+    def expand(self, master_config):
+        '''
+        Returns the ConfigExpansion of master_config
+
+        Raises ConfigIncludeError
+        '''
+        graph = collections.OrderedDict()
+        digests = {}
+
+        if 'include' not in master_config:
+            graph[None] = []
+            return ConfigExpansion(master_config, graph, digests, [])
+
+        lines = []
+        source_map = []
+
+        self._expand(master_config, None, [], graph, digests, lines, source_map)
+
+        return ConfigExpansion(''.join(lines), graph, digests, source_map)
+
+    def _expand(self, config, source, stack, graph, digests, lines, source_map):
+        graph.setdefault(source, [])
+
+        source_line = 1
+        segment_start = True
+
+        config_lines = config.split('\n')
+        last_line = config_lines.pop()
+
+        for (line, line_end) in [(line, '\n') for line in config_lines] + [(last_line, '')]:
+            match = self.include_re.match(line) if 'include' in line else None
+
+            if match is None:
+                if line or line_end:
+                    if segment_start:
+                        source_map.append((len(lines) + 1, source, source_line))
+                        segment_start = False
+
+                    lines.append(line + line_end)
+            else:
+                for path in self.resolve(match.group(1)):
+                    relative_path = self.relpath(path)
+
+                    if relative_path in stack or relative_path == source:
+                        raise ConfigIncludeError('Include cycle: %s' % ' -> '.join([item or 'master' for item in stack + [source, relative_path]]))
+
+                    if len(stack) >= self.max_depth:
+                        raise ConfigIncludeError('Includes nested deeper than %s levels in %s' % (self.max_depth, source or 'master'))
+
+                    (content, digest) = self.read(path)
+
+                    graph[source].append(relative_path)
+                    digests[relative_path] = digest
+
+                    if content and not content.endswith('\n'):
+                        content += '\n'
+
+                    self._expand(content, relative_path, stack + [source], graph, digests, lines, source_map)
+
+                # The line after the include starts a new segment of this file
+                segment_start = True
+
+            source_line += 1
+
+
+class ConfigManifest(object):
+    '''
+    Per top level block digests of a configuration file
+
+    The manifest digest is computed from the block digests, two files with
+    the same manifest digest are identical and the blocks of two differing
+    manifests tell which statements differ. Blocks are labelled by their
+    first line (e.g. "vrrp_instance VI_1"), a label used more than once
+    gets a "#<occurrence>" suffix.
+
+    size and mtime are the ones of the file the manifest describes, a
+    manifest is only trusted for a file with the same size and mtime.
+    '''
+    def __init__(self, blocks, size=None, mtime=None):
+        # List of (label, block digest)
+        self.blocks = blocks
+        self.size = size
+        self.mtime = mtime
+
+        self.digest = hashlib.sha256(''.join([digest for (label, digest) in blocks])).hexdigest()
+
+    @staticmethod
+    def block_label(text):
+        '''
+        Returns the first statement line of text, without its opening brace
+        '''
+        for line in text.split('\n'):
+            stripped = line.strip(' \t\r')
+
+            if stripped and stripped[0] not in '!#':
+                return ' '.join(stripped.rstrip('{').split())
+
+        return '(blank lines)'
+
+    @classmethod
+    def from_blocks(cls, block_texts, digests=None, size=None, mtime=None):
+        '''
+        Returns the manifest of a file made of block_texts, digests are computed
+        unless given
+        '''
+        if digests is None:
+            digests = [content_digest(text) for text in block_texts]
+
+        label_count = collections.defaultdict(int)
+        blocks = []
+
+        for (text, digest) in zip(block_texts, digests):
+            label = cls.block_label(text)
+
+            label_count[label] += 1
+            if label_count[label] > 1:
+                label = '%s #%s' % (label, label_count[label])
+
+            blocks.append((label, digest))
+
+        return cls(blocks, size, mtime)
+
+    @classmethod
+    def from_content(cls, content, size=None, mtime=None):
+        return cls.from_blocks(split_config_blocks(content), size=size, mtime=mtime)
+
+    @classmethod
+    def from_json(cls, manifest_json):
+        '''
+        Returns the manifest serialized by to_json, raises ValueError if
+        manifest_json is not a valid manifest
+        '''
+        try:
+            manifest_dict = json.loads(manifest_json)
+
+            manifest = cls([(str(label), str(digest)) for (label, digest) in manifest_dict['blocks']], \
+                           manifest_dict['size'], manifest_dict['mtime'])
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError('Invalid manifest: %s' % e)
+
+        if manifest.digest != manifest_dict.get('digest'):
+            raise ValueError('Invalid manifest: digest does not match its blocks')
+
+        return manifest
+
+    def to_json(self):
+        return json.dumps({'digest': self.digest, 'size': self.size, 'mtime': self.mtime, 'blocks': self.blocks})
+
+    def matches(self, size, mtime):
+        return self.size == size and self.mtime == mtime
+
+    def diff(self, other):
+        '''
+        Returns the blocks differing between self and other, as a list of
+        (label, 'changed' | 'missing' | 'added'), 'missing' blocks are only in
+        self and 'added' blocks only in other
+        '''
+        if self.digest == other.digest:
+            return []
+
+        other_blocks = dict(other.blocks)
+        labels = set([label for (label, digest) in self.blocks])
+
+        differences = []
+        for (label, digest) in self.blocks:
+            if label not in other_blocks:
+                differences.append((label, 'missing'))
+            elif other_blocks[label] != digest:
+                differences.append((label, 'changed'))
+
+        differences.extend([(label, 'added') for (label, digest) in other.blocks if label not in labels])
+
+        if not differences:
+            differences.append(('(block order)', 'changed'))
+
+        return differences
+
+
+class PendingConfig(object):
+    '''
+    Master configuration being edited in configuration mode
+
+    Both the committed master and the working copy are kept as strings with
+    their digest, so telling whether there is something to commit is a
+    digest comparison. The committed master is read again only when the size
+    or mtime of the master configuration file change (see
+    Keepalived.refresh_pending_master).
+
+    Included files are edited in place, the digests of the ones included by
+    the working copy are compared with the ones of the last commit.
+    '''
+    def __init__(self, master_config, master_stat=None, include_digests=None):
+        include_digests = include_digests or {}
+
+        self.set_master(master_config, master_stat)
+
+        self.working_config = self.master_config
+        self.working_digest = self.master_digest
+
+        # Included file -> digest, for the last commit and the working copy
+        self.include_digests = dict(include_digests)
+        self.working_include_digests = dict(include_digests)
+        self.include_error = None
+
+        # Node -> node configuration generated by the last commit attempt
+        self.node_config = {}
+
+    def set_master(self, master_config, master_stat=None):
+        '''
+        Sets the committed master, master_stat being the (size, mtime) of the
+        file it was read from
+        '''
+        self.master_config = master_config
+        self.master_digest = content_digest(master_config)
+        self.master_stat = master_stat
+
+    def update(self, working_config):
+        '''
+        Replaces the working copy, returns True if it changed
+        '''
+        working_digest = content_digest(working_config)
+
+        if working_digest == self.working_digest:
+            return False
+
+        self.working_config = working_config
+        self.working_digest = working_digest
+
+        return True
+
+    def is_changed(self):
+        return self.working_digest != self.master_digest or self.working_include_digests != self.include_digests
+
+    def changed_includes(self):
+        '''
+        Returns the included files changed since the last commit, as a list of
+        (file, 'added' | 'removed' | 'changed')
+        '''
+        changes = []
+
+        for include_file in sorted(set(self.include_digests.keys() + self.working_include_digests.keys())):
+            if include_file not in self.include_digests:
+                changes.append((include_file, 'added'))
+            elif include_file not in self.working_include_digests:
+                changes.append((include_file, 'removed'))
+            elif self.include_digests[include_file] != self.working_include_digests[include_file]:
+                changes.append((include_file, 'changed'))
+
+        return changes
+
+    def diff(self, from_label='Master Configuration File', to_label='Pending Configuration File', context=7):
+        '''
+        Returns the unified diff of the master and the working copy, as a list of lines
+        '''
+        if self.working_digest == self.master_digest:
+            return []
+
+        return list(difflib.unified_diff(self.master_config.splitlines(True), self.working_config.splitlines(True), \
+                                         from_label, to_label, n=context))
+
+
+class ConfigArchive(object):
+    '''
+    Content addressed archive of the master configuration revisions
+
+    Each distinct content is stored once, zlib compressed, in
+    objects/<first 2 digest chars>/<digest>. The index file lists one
+    revision per line:
+
+    ::
+
+      <revision> <timestamp> <digest> <size>
+
+    The index is read again only when its mtime or size changes.
+    '''
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.index_file = '%s/index' % archive_dir
+        self.index_stat = None
+        self.revisions = collections.OrderedDict()
+
+    @staticmethod
+    def object_relpath(digest):
+        return 'objects/%s/%s' % (digest[:2], digest)
+
+    def load(self):
+        '''
+        Reads the index into self.revisions (revision -> (timestamp, digest, size))
+        '''
+        try:
+            stat = os.stat(self.index_file)
+        except OSError:
+            self.index_stat = None
+            self.revisions = collections.OrderedDict()
+            return
+
+        if (stat.st_mtime, stat.st_size) == self.index_stat:
+            return
+
+        revisions = collections.OrderedDict()
+
+        fd = open(self.index_file, 'r')
+        for line in fd:
+            fields = line.split()
+            if len(fields) == 4:
+                revisions[int(fields[0])] = (fields[1], fields[2], int(fields[3]))
+        fd.close()
+
+        self.revisions = revisions
+        self.index_stat = (stat.st_mtime, stat.st_size)
+
+    def _write_index(self, revisions):
+        fd = open('%s.tmp' % self.index_file, 'w')
+        for revision in revisions:
+            fd.write('%s %s %s %s\n' % ((revision,) + revisions[revision]))
+        fd.close()
+
+        os.rename('%s.tmp' % self.index_file, self.index_file)
+
+    def add(self, content, timestamp):
+        '''
+        Archives content as a new revision
+
+        Returns (revision, object path relative to the archive dir)
+        '''
+        self.load()
+
+        digest = content_digest(content)
+        object_file = '%s/%s' % (self.archive_dir, self.object_relpath(digest))
+
+        if not os.path.exists(object_file):
+            if not os.path.isdir(os.path.dirname(object_file)):
+                os.makedirs(os.path.dirname(object_file))
+
+            fd = open('%s.tmp' % object_file, 'wb')
+            fd.write(zlib.compress(content, 9))
+            fd.close()
+
+            os.rename('%s.tmp' % object_file, object_file)
+
+        revision = 1
+        if self.revisions:
+            revision = max(self.revisions) + 1
+
+        fd = open(self.index_file, 'a')
+        fd.write('%s %s %s %s\n' % (revision, timestamp, digest, len(content)))
+        fd.close()
+
+        self.index_stat = None
+        self.load()
+
+        return (revision, self.object_relpath(digest))
+
+    def get(self, revision):
+        '''
+        Returns the content of revision, raises KeyError if it does not exist
+        '''
+        self.load()
+
+        digest = self.revisions[revision][1]
+
+        fd = open('%s/%s' % (self.archive_dir, self.object_relpath(digest)), 'rb')
+        content = zlib.decompress(fd.read())
+        fd.close()
+
+        return content
+
+    def diff(self, revision, other_revision, context=7):
+        '''
+        Returns the unified diff between two revisions, as a list of lines
+        '''
+        return list(difflib.unified_diff(self.get(revision).splitlines(True), self.get(other_revision).splitlines(True), \
+                                         'Revision %s' % revision, 'Revision %s' % other_revision, n=context))
+
+    def compact(self, retention):
+        '''
+        Keeps the last retention revisions and removes the objects no longer
+        referenced. A retention of 0 keeps everything.
+
+        Returns the removed objects paths, relative to the archive dir
+        '''
+        self.load()
+
+        if retention <= 0 or len(self.revisions) <= retention:
+            return []
+
+        revisions = list(self.revisions)
+        kept_revisions = collections.OrderedDict([(revision, self.revisions[revision]) for revision in revisions[-retention:]])
+
+        kept_digests = set([entry[1] for entry in kept_revisions.values()])
+        dropped_digests = set([self.revisions[revision][1] for revision in revisions[:-retention]]) - kept_digests
+
+        self._write_index(kept_revisions)
+
+        removed = []
+        for digest in sorted(dropped_digests):
+            object_file = '%s/%s' % (self.archive_dir, self.object_relpath(digest))
+
+            try:
+                os.remove(object_file)
+                removed.append(self.object_relpath(digest))
+
+                if not os.listdir(os.path.dirname(object_file)):
+                    os.rmdir(os.path.dirname(object_file))
+            except OSError:
+                pass
+
+        self.index_stat = None
+        self.load()
+
+        return removed
+
+    def import_legacy(self, prefix):
+        '''
+        Moves the archive files of previous plugin versions, named
+        <prefix>_<timestamp>, into the archive. Returns the number imported.
+        '''
+        legacy_files = sorted([filename for filename in os.listdir(self.archive_dir) \
+                               if filename.startswith('%s_' % prefix) and os.path.isfile('%s/%s' % (self.archive_dir, filename))])
+
+        for filename in legacy_files:
+            fd = open('%s/%s' % (self.archive_dir, filename), 'r')
+            content = fd.read()
+            fd.close()
+
+            self.add(content, filename[len(prefix) + 1:])
+            os.remove('%s/%s' % (self.archive_dir, filename))
+
+        return len(legacy_files)
+
+
+def _find_monotonic_clock():
+    '''
+    Returns a function returning seconds from an arbitrary point, not affected
+    by system clock changes, time.time if there is none
+    '''
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        # find_library runs ldconfig, the clock is only looked up on first use
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        # CLOCK_MONOTONIC on Linux
+        clock_monotonic = 1
+
+        def clock_gettime_monotonic():
+            timespec = _timespec()
+            if clock_gettime(clock_monotonic, ctypes.pointer(timespec)) != 0:
+                error_number = ctypes.get_errno()
+                raise OSError(error_number, os.strerror(error_number))
+
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+        clock_gettime_monotonic()
+
+        return clock_gettime_monotonic
+    except (ImportError, AttributeError, OSError, TypeError):
+        return time.time
+
+
+_monotonic_clock = None
+
+
+def monotonic_time():
+    '''
+    Seconds from an arbitrary point, not affected by system clock changes
+    '''
+    global _monotonic_clock
+
+    if _monotonic_clock is None:
+        _monotonic_clock = _find_monotonic_clock()
+
+    return _monotonic_clock()
+
+
+class CommitStats(object):
+    '''
+    Timings and counters of one commit
+
+    Commit phases follow each other, phase() ends the running phase and
+    starts the next one. Node phases (push, activate, reload, probe) run on
+    several nodes at once, each node timing its own phases (node_phase()) or
+    being timed with node_timer(), along with the return code of the command
+    run on the node.
+    '''
+    def __init__(self):
+        self.started = time.time()
+        self.start = monotonic_time()
+        self.duration = None
+        self.result = None
+
+        # Phase -> seconds
+        self.phases = collections.OrderedDict()
+        self.running_phase = None
+        self.running_phase_start = None
+
+        # Node -> phase -> {'seconds': float, 'return_code': int or None}
+        self.nodes = collections.OrderedDict()
+
+        self.counters = collections.defaultdict(int)
+
+    def phase(self, phase):
+        '''
+        Ends the running phase, starts phase if not None
+        '''
+        now = monotonic_time()
+
+        if self.running_phase is not None:
+            self.phases[self.running_phase] = self.phases.get(self.running_phase, 0) + now - self.running_phase_start
+
+        (self.running_phase, self.running_phase_start) = (phase, now)
+
+    @contextlib.contextmanager
+    def node_timer(self, nodes, phase):
+        start = monotonic_time()
+        try:
+            yield
+        finally:
+            seconds = monotonic_time() - start
+
+            for node in nodes:
+                self.nodes.setdefault(node, collections.OrderedDict()).setdefault(phase, {'return_code': None})['seconds'] = seconds
+
+    def node_phase(self, node, phase, seconds, return_code):
+        self.nodes.setdefault(node, collections.OrderedDict())[phase] = {'seconds': seconds, 'return_code': return_code}
+
+    def return_code(self, node, phase, return_code):
+        self.nodes.setdefault(node, collections.OrderedDict()).setdefault(phase, {'seconds': None})['return_code'] = return_code
+
+    def count(self, counter, value=1):
+        self.counters[counter] += value
+
+    def finish(self, result):
+        self.phase(None)
+        self.duration = monotonic_time() - self.start
+        self.result = result
+
+    def node_seconds(self, node):
+        return sum([phase_stats['seconds'] or 0 for phase_stats in self.nodes[node].values()])
+
+    def to_dict(self):
+        return collections.OrderedDict([('started', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started))),
+                                        ('result', self.result),
+                                        ('duration', self.duration),
+                                        ('phases', self.phases),
+                                        ('nodes', self.nodes),
+                                        ('counters', collections.OrderedDict(sorted(self.counters.items())))])
+
+
+@contextlib.contextmanager
+def _null_timer():
+    yield
+
+
+def read_pidfile(pidfile):
+    '''
+    Returns the pid written in pidfile
+    '''
+    fd = open(pidfile, 'r')
+    try:
+        return int(fd.read().split()[0])
+    finally:
+        fd.close()
+
+
+vrrp_state_re = re.compile(r'^\s*State = (\S+)\s*$', re.M)
+
+# States of a vrrp instance having converged after a reload
+vrrp_settled_states = ['MASTER', 'BACKUP']
+
+
+# Last line of each phase run by phases_script: phase, return code, start and
+# end times on the node
+phase_end_re = re.compile(r'^== (\S+) Return Code=(\d+) (\S+) (\S+)$')
+
+
+def phases_script(phases):
+    '''
+    Returns a shell script running the commands of phases, a list of (phase,
+    command), one after the other while they return 0, each one followed by
+    a line matching phase_end_re
+    '''
+    (phase, command) = phases[0]
+
+    script = 'phase_start=`date +%%s.%%N` ; { %s ; } ; rc=$? ; echo "== %s Return Code=$rc $phase_start `date +%%s.%%N`"' % (command, phase)
+
+    if len(phases) > 1:
+        script += ' ; if [ $rc = 0 ] ; then %s ; fi' % phases_script(phases[1:])
+
+    return script
+
+class VrrpDump(collections.namedtuple('VrrpDump', 'dumped instances stats error')):
+    '''
+    Vrrp dumps of one node: epoch of the dump on the node, ordered dicts of
+    instance -> fields (see iter_vrrp_data) and instance -> counters (see
+    iter_vrrp_stats), error message or None
+    '''
+    __slots__ = ()
+
+
+vrrp_instance_re = re.compile(r'^\s*VRRP Instance\s*[=:]\s*(\S+)')
+
+
+def iter_vrrp_data(lines):
+    '''
+    Parses a vrrp data dump of keepalived (SIGUSR1) line by line, lines being
+    any iterable of lines such as an open file
+
+    Yields (instance name, ordered dict of its "key = value" fields), the
+    first occurrence of a key being kept
+    '''
+    instance = None
+    fields = None
+
+    for line in lines:
+        stripped = line.strip()
+
+        match = vrrp_instance_re.match(line)
+        if match or stripped.startswith('------<'):
+            # A new instance or section ends the current instance
+            if instance is not None:
+                yield (instance, fields)
+
+            instance = None
+
+            if match:
+                instance = match.group(1)
+                fields = collections.OrderedDict()
+
+            continue
+
+        if instance is None or ' = ' not in stripped:
+            continue
+
+        (key, value) = stripped.split(' = ', 1)
+        fields.setdefault(key.strip(), value.strip())
+
+    if instance is not None:
+        yield (instance, fields)
+
+
+def iter_vrrp_stats(lines):
+    '''
+    Parses a vrrp stats dump of keepalived (SIGUSR2) line by line, lines being
+    any iterable of lines such as an open file
+
+    Yields (instance name, ordered dict of counter -> value), counters of a
+    section being named after it (e.g. "Advertisements Received")
+    '''
+    instance = None
+    counters = None
+
+    # Stack of (indentation, section name)
+    sections = []
+
+    for line in lines:
+        stripped = line.strip()
+
+        if not stripped:
+            continue
+
+        match = vrrp_instance_re.match(line)
+        if match:
+            if instance is not None:
+                yield (instance, counters)
+
+            instance = match.group(1)
+            counters = collections.OrderedDict()
+            sections = []
+            continue
+
+        if instance is None or ':' not in stripped:
+            continue
+
+        indentation = len(line) - len(line.lstrip())
+        (key, value) = [part.strip() for part in stripped.split(':', 1)]
+
+        while sections and sections[-1][0] >= indentation:
+            sections.pop()
+
+        if not value:
+            sections.append((indentation, key))
+            continue
+
+        try:
+            counters[' '.join([section for (section_indentation, section) in sections] + [key])] = int(value)
+        except ValueError:
+            pass
+
+    if instance is not None:
+        yield (instance, counters)
+
+
+class LvsService(collections.namedtuple('LvsService', 'name scheduler real_servers')):
+    '''
+    A virtual service of /proc/net/ip_vs: name as ipvsadm -n shows it (e.g.
+    "TCP 10.10.10.100:80"), scheduler and flags, list of LvsRealServer
+    '''
+    __slots__ = ()
+
+
+class LvsRealServer(collections.namedtuple('LvsRealServer', 'address forward weight active inactive')):
+    __slots__ = ()
+
+
+# Protocols of the virtual services in /proc/net/ip_vs
+ip_vs_protocols = ['TCP', 'UDP', 'SCTP', 'FWM']
+
+# Counters of /proc/net/ip_vs_stats and ipvsadm --stats, in their order
+ip_vs_counters = ['conns', 'inpkts', 'outpkts', 'inbytes', 'outbytes']
+
+
+def ip_vs_host(host):
+    '''
+    Returns a hexadecimal IPv4 (0A0A0A64) or full IPv6 address of /proc/net
+    as ipvsadm -n shows it
+    '''
+    if ':' in host:
+        return '[%s]' % socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, host.strip('[]')))
+
+    return '.'.join([str(int(host[i:i + 2], 16)) for i in range(0, 8, 2)])
+
+
+def ip_vs_address(address):
+    '''
+    Returns an address:port of /proc/net/ip_vs (0A0A0A64:0050 or
+    [2001:0db8:...]:0050) or a firewall mark (00000001) as ipvsadm -n shows it
+    '''
+    if ':' not in address:
+        return str(int(address, 16))
+
+    (host, port) = address.rsplit(':', 1)
+
+    return '%s:%s' % (ip_vs_host(host), int(port, 16))
+
+
+def iter_ip_vs(lines):
+    '''
+    Parses /proc/net/ip_vs line by line, lines being any iterable of lines
+    such as an open file
+
+    Yields a LvsService per virtual service
+    '''
+    service = None
+
+    for line in lines:
+        fields = line.split()
+
+        if len(fields) >= 3 and fields[0] in ip_vs_protocols:
+            if service is not None:
+                yield service
+
+            service = LvsService('%s %s' % (fields[0], ip_vs_address(fields[1])), ' '.join(fields[2:]), [])
+        elif len(fields) == 6 and fields[0] == '->' and fields[3].isdigit() and service is not None:
+            service.real_servers.append(LvsRealServer(ip_vs_address(fields[1]), fields[2], int(fields[3]), int(fields[4]), int(fields[5])))
+
+    if service is not None:
+        yield service
+
+
+def parse_ip_vs_stats(lines):
+    '''
+    Returns the total counters of /proc/net/ip_vs_stats, as a tuple in
+    ip_vs_counters order, None if not found
+    '''
+    for line in lines:
+        fields = line.split()
+
+        if len(fields) == len(ip_vs_counters):
+            try:
+                return tuple([int(field, 16) for field in fields])
+            except ValueError:
+                pass
+
+    return None
+
+
+def iter_ipvsadm_stats(lines):
+    '''
+    Parses the output of ipvsadm -Ln --stats --exact line by line
+
+    Yields ((service name, real server address or None for the service),
+    counters tuple in ip_vs_counters order)
+    '''
+    service = None
+
+    for line in lines:
+        fields = line.split()
+
+        try:
+            if len(fields) == 7 and fields[0] in ip_vs_protocols:
+                service = '%s %s' % (fields[0], fields[1])
+                yield ((service, None), tuple([int(field) for field in fields[2:]]))
+            elif len(fields) == 7 and fields[0] == '->' and service is not None:
+                yield ((service, fields[1]), tuple([int(field) for field in fields[2:]]))
+        except ValueError:
+            continue
+
+
+# Reduces /proc/net/ip_vs_conn on the node in one pass, to one line per
+# virtual address, real server and state: count proto vip vport rip rport state
+ip_vs_conn_count_awk = "awk 'NR > 1 { count[$1 \" \" $4 \" \" $5 \" \" $6 \" \" $7 \" \" $8]++ } END { for (key in count) print count[key], key }'"
+
+
+def iter_ip_vs_conn_counts(lines):
+    '''
+    Parses the output of ip_vs_conn_count_awk line by line
+
+    Yields ((service name, real server address, state), number of entries of
+    the connection table)
+    '''
+    for line in lines:
+        fields = line.split()
+
+        if len(fields) != 7 or not fields[0].isdigit():
+            continue
+
+        try:
+            yield (('%s %s:%s' % (fields[1], ip_vs_host(fields[2]), int(fields[3], 16)), \
+                    '%s:%s' % (ip_vs_host(fields[4]), int(fields[5], 16)), fields[6]), int(fields[0]))
+        except (ValueError, socket.error):
+            continue
+
+
+def counter_rates(first, second, seconds):
+    '''
+    Returns the per second rates of the counters tuples of two samples taken
+    seconds apart, counters going backward (reset) give a rate of 0
+    '''
+    return tuple([max(0, after - before) / float(seconds) for (before, after) in zip(first, second)])
+
+
+def format_duration(seconds):
+    '''
+    Returns seconds as a short duration such as 3d4h, 2h13m, 5m7s or 42s
+    '''
+    seconds = max(0, int(seconds))
+
+    for (unit, unit_seconds, sub_unit, sub_unit_seconds) in [('d', 86400, 'h', 3600), ('h', 3600, 'm', 60), ('m', 60, 's', 1)]:
+        if seconds >= unit_seconds:
+            return '%s%s%s%s' % (seconds / unit_seconds, unit, seconds % unit_seconds / sub_unit_seconds, sub_unit)
+
+    return '%ss' % seconds
+
+
+def find_executable(name):
+    '''
+    Returns the path of the executable name in the directories of PATH, None
+    if not found
+    '''
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory or os.curdir, name)
+
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+
+    return None
+
+
+def find_plugin_file(name, plugin_dirs, base_dir):
+    '''
+    Returns the path of the <name>.py plugin module in plugin_dirs, the comma
+    separated plugin-dir setting of the Sysadmin-Toolkit configuration,
+    relative directories being relative to base_dir. Returns None if no
+    plugin directory holds it.
+    '''
+    for plugin_dir in [plugin_dir.strip() for plugin_dir in plugin_dirs.split(',') if plugin_dir.strip()]:
+        path = os.path.join(base_dir, os.path.expanduser(plugin_dir), '%s.py' % name)
+
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+
+class _PluginSet(object):
+    '''
+    Plugins of a batch commit run from the command line, see main
+    '''
+    def __init__(self, plugins):
+        self.plugins = plugins
+
+    def get_plugins(self):
+        return self.plugins
+
+
+def main(argv=None):
+    '''
+    Batch commit from the command line, without the Sysadmin-Toolkit CLI:
+
+    ::
+
+      python keepalived.py -c /etc/sysadmin-toolkit/sysadmin-toolkit.conf --master keepalived.conf.new
+      generate-master | python keepalived.py -c sysadmin-toolkit.conf --master - --nodeset lvs-a --dry-run
+      python keepalived.py -c sysadmin-toolkit.conf --nodeset-master lvs-a=lvs-a.conf --nodeset-master lvs-b=lvs-b.conf
+
+    The keepalived and clustering plugins are configured from their sections
+    of the Sysadmin-Toolkit configuration file, the clustering plugin is
+    loaded from --clustering-plugin, clustering.py in the plugin-dir of the
+    commandprompt section by default. --nodeset-master replaces the $nodeset
+    section of a nodeset in the current master configuration. --dry-run does
+    not need keepalived on the host. The exit status is the one of
+    Keepalived.batch_commit.
+    '''
+    parser = optparse.OptionParser(usage='%prog -c CONFIG --master FILE|- | --nodeset-master NODESET=FILE... [--nodeset NODESET]... [--dry-run]')
+    parser.add_option('-c', '--config', help='Sysadmin-Toolkit configuration file')
+    parser.add_option('--master', help='new master configuration file, - for stdin')
+    parser.add_option('--nodeset-master', dest='nodeset_masters', action='append', default=[], metavar='NODESET=FILE',
+                      help='new master configuration of a nodeset, may be repeated')
+    parser.add_option('--nodeset', dest='nodesets', action='append', default=[],
+                      help='nodeset to commit to, may be repeated [nodeset of the plugin]')
+    parser.add_option('--dry-run', action='store_true', default=False, help='only generate, validate and show the changes')
+    parser.add_option('--clustering-plugin', help='clustering plugin module [clustering.py in the plugin-dir of the configuration]')
+
+    (options, args) = parser.parse_args(argv)
+
+    if options.config is None or (options.master is None) == (not options.nodeset_masters):
+        parser.error('-c and one of --master or --nodeset-master are required')
+
+    if [nodeset_master for nodeset_master in options.nodeset_masters if '=' not in nodeset_master]:
+        parser.error('--nodeset-master takes NODESET=FILE')
+
+    config = ConfigParser.SafeConfigParser()
+    if not config.read(options.config):
+        parser.error('cannot read %s' % options.config)
+
+    def plugin_config(name):
+        if config.has_section(name):
+            return dict(config.items(name))
+
+        return dict(config.defaults())
+
+    clustering_plugin_file = options.clustering_plugin
+    if clustering_plugin_file is None:
+        clustering_plugin_file = find_plugin_file('clustering', plugin_config('commandprompt').get('plugin-dir', ''), \
+                                                  os.path.dirname(os.path.abspath(options.config)))
+
+        if clustering_plugin_file is None:
+            parser.error('cannot find clustering.py in the plugin-dir of %s, use --clustering-plugin' % options.config)
+
+    logging.basicConfig(format='%(levelname)s %(message)s')
+    logger = logging.getLogger('keepalived')
+    logger.setLevel(getattr(logging, plugin_config('keepalived').get('log-level', 'warning').upper(), logging.WARNING))
+
+    if options.master == '-':
+        master_config = sys.stdin.read()
+    elif options.master is not None:
+        fd = open(options.master, 'r')
+        master_config = fd.read()
+        fd.close()
+    else:
+        master_config = collections.OrderedDict()
+
+        for nodeset_master in options.nodeset_masters:
+            (nodeset, master_file) = nodeset_master.split('=', 1)
+
+            fd = open(master_file, 'r')
+            master_config[nodeset] = fd.read()
+            fd.close()
+
+    try:
+        clustering_plugin = imp.load_source('clustering', clustering_plugin_file).get_plugin(logger, plugin_config('clustering'))
+        keepalived_plugin = get_plugin(logger, plugin_config('keepalived'))
+
+        plugin_set = _PluginSet({'clustering': clustering_plugin, 'keepalived': keepalived_plugin})
+        clustering_plugin.update_plugin_set(plugin_set)
+        keepalived_plugin.update_plugin_set(plugin_set)
+
+        return keepalived_plugin.batch_commit(master_config, options.nodesets or None, options.dry_run)
+    except sysadmintoolkit.exception.PluginError as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+
+
+def get_plugin(logger, config):
+    global plugin_instance
+
+    if plugin_instance is None:
+        plugin_instance = Keepalived(logger, config)
+
+    return plugin_instance
+
+
+class Keepalived(sysadmintoolkit.plugin.Plugin):
+    '''
+    Description
+    -----------
+
+    Provides a keepalived configuration manager, to manage an any-node
+    cluster of keepalived/LVS servers.
+
+    Some keywords are replaced in the master configuration file to
+    generate per node configuration.
+
+    Requirements
+    ------------
+
+    The plugin uses the Clustering plugin to communicated with nodes
+    across the cluster.
+
+    The keepalived package must be installed. The keepalived binary is
+    looked up in PATH when first needed (commit, debug), not when the
+    plugin is loaded.
+
+    Configuration
+    -------------
+
+    *nodesets*
+      Comma separated nodesets of the clustering plugin managed by the
+      plugin. All of them are committed to together, from one master
+      configuration where $nodeset lines scope blocks to nodesets.
+
+      Default: nodesets = default
+
+    *modes*
+      Supported modes:
+
+      ::
+
+        lvs:  Linux virtual server commands, show lvs services and show lvs rates
+        vrrp: VRRP commands, show vrrp status and show vrrp stats
+
+      Example: modes = lvs, vrrp
+
+      Default: no mode loaded by default
+
+    *live-config-file*
+      Configuration file used by the keepalived daemon,
+      must be the same on all nodes of the cluster.
+
+      Default: live-config-file = /etc/keepalived/keepalived.conf
+
+    *config-dir*
+      Main directory where revisions, master configuration
+      and node configuration files are kept. Relative include
+      directives of the master configuration are relative to it,
+      included files inside it are pushed with the master but not
+      archived.
+
+      Default: config-dir = /etc/keepalived/master
+
+    *reload-cmd*
+      Command to trigger a reload of the keepalied daemon.
+
+      Default: reload-cmd = service keepalived reload
+
+    *reload-method*
+      How keepalived is reloaded on nodes:
+
+      ::
+
+        command: run reload-cmd
+        signal:  send SIGHUP to the pid in pid-file, directly from the
+                 plugin process on the local node
+
+      Default: reload-method = command
+
+    *pid-file*
+      Pidfile of the keepalived daemon, must be the same on all nodes of
+      the cluster.
+
+      Default: pid-file = /var/run/keepalived.pid
+
+    *reload-mode*
+      When keepalived is reloaded on nodes during a commit:
+
+      ::
+
+        parallel: nodes are reloaded together as soon as their
+                  configurations are activated
+        rolling:  nodes are reloaded in batches once all configurations are
+                  activated, nodes neither master nor backup of any
+                  $master_backup line first, then backups, masters last.
+                  Each batch must pass reload-probe before the next one is
+                  reloaded, the remaining nodes are not reloaded after a
+                  failure. Each nodeset is rolled on its own, the batches
+                  of the same rank of every nodeset being reloaded together.
+
+      Default: reload-mode = parallel
+
+    *reload-batch-size*
+      Number of nodes reloaded at the same time in rolling mode.
+
+      Default: reload-batch-size = 1
+
+    *reload-probe*
+      Check gating each batch of a rolling reload, retried every second
+      until reload-probe-timeout:
+
+      ::
+
+        process: the pid in pid-file is alive
+        vrrp:    keepalived dumps its vrrp data on SIGUSR1 to vrrp-data-file,
+                 every vrrp instance is in MASTER or BACKUP state
+        none:    no check
+
+      Default: reload-probe = process
+
+    *reload-probe-timeout*
+      Number of seconds a node has to pass reload-probe after its reload.
+
+      Default: reload-probe-timeout = 30
+
+    *vrrp-data-file*
+      File keepalived dumps its vrrp data to on SIGUSR1.
+
+      Default: vrrp-data-file = /tmp/keepalived.data
+
+    *vrrp-stats-file*
+      File keepalived dumps its vrrp statistics to on SIGUSR2.
+
+      Default: vrrp-stats-file = /tmp/keepalived.stats
+
+    *vrrp-cache-ttl*
+      Number of seconds the vrrp dumps of the nodes are reused by the vrrp
+      mode commands. Keepalived is only signaled again on a node when its
+      dump files are older, so operators polling the cluster at the same
+      time share the dumps. 0 dumps on every command.
+
+      Default: vrrp-cache-ttl = 5
+
+    *lvs-proc-dir*
+      Directory of the ip_vs, ip_vs_stats and ip_vs_conn files read by the
+      lvs mode commands on the nodes.
+
+      Default: lvs-proc-dir = /proc/net
+
+    *lvs-stats-cmd*
+      Command printing the per virtual service and real server counters on
+      the nodes, the kernel does not expose them in lvs-proc-dir.
+
+      Default: lvs-stats-cmd = ipvsadm -Ln --stats --exact
+
+    *lvs-rate-interval*
+      Number of seconds between the two samples show lvs rates computes
+      rates from.
+
+      Default: lvs-rate-interval = 1
+
+    *cache-size*
+      Size in megabytes of the in-memory cache of compiled master blocks and
+      validation results, kept across commits and keyed by content digest.
+      It lasts as long as the plugin instance and is not written to disk: the
+      commits of one interactive session share it, a command line commit
+      starts with an empty cache. 0 disables the cache.
+
+      Default: cache-size = 64
+
+    *commit-concurrency*
+      Maximum number of nodes in one command of the clustering plugin during
+      a commit, 0 for all of them. All nodes are deployed by one command,
+      each node going through push, activate and reload at its own pace,
+      the clustering plugin running it on the nodes in parallel. A positive
+      value splits the nodes in commands run one after the other, for
+      clustering plugins that cannot reach many nodes at once. The
+      clustering plugin is never called from several threads. The commit is
+      aborted before any step if one node configuration is not valid.
+
+      Default: commit-concurrency = 0
+
+    *archive-retention*
+      Number of master configuration revisions kept in the archive, older
+      revisions and the contents only they reference are removed on commit,
+      from config-dir and from the archive of every node the index is pushed
+      to. The index, pushed with every commit, is bounded by it (about 100
+      bytes per revision). 0 keeps every revision.
+
+      Default: archive-retention = 1000
+
+    *stats-history*
+      Number of commits whose timings and counters are kept in memory for
+      show stats keepalived.
+
+      Default: stats-history = 20
+
+    *stats-file*
+      File where the timings and counters of each commit are appended, as
+      one JSON object per line.
+
+      Default: no stats file
+
+    *commit-lock-timeout*
+      Number of seconds a commit waits for the commits holding the commit
+      lock, a .commit-lock file in config-dir of every node committed to.
+
+      Default: commit-lock-timeout = 300
+
+    *commit-lock-max-age*
+      Number of seconds after which a commit lock is considered stale and
+      broken, a lock whose holder process is gone is broken right away.
+
+      Default: commit-lock-max-age = 3600
+
+    Master Configuration Special Keywords
+    -------------------------------------
+
+    *$slb_hostname*
+      This is replaced by the local hostname on each node. It must be left
+      verbatim in the *global_defs* section.
+
+      Example:
+
+      ::
+
+        global_defs  {
+          router_id $slb_hostname
+        }
+
+    *$master_backup*
+      This keyword takes 2 arguments: the node you want normally you service to run on, and
+      the second preferred node you want your service to run on.
+
+      This is a bloc of configuration that is present in a *vrrp_instance* bloc. This
+      replaces the "priority" keyword.
+
+      On the master node, the priority is switched to 150, on the backup 100 and on any other
+      node to 50.
+
+      Example:
+
+      ::
+
+        vrrp_instance vip-group-a {
+          state BACKUP
+          interface eth0
+          $master_backup node1 node2
+          [...]
+        }
+
+      This will replace generate 3 configuration files with
+      the line $master_backup changed to:
+
+      ::
+
+        Node        Declaration
+        -------------------------
+        node1       priority 150
+        node2       priority 100
+        node3       priority 50
+
+    *$nodeset*
+      This keyword takes the names of one or more nodesets. In a block, the
+      block is only generated in the configuration of the nodes of these
+      nodesets. On a line of its own, it does the same for all the blocks
+      that follow, up to the next $nodeset line, "$nodeset \*" going back to
+      all nodesets. Each nodeset can have its own section of the master:
+
+      ::
+
+        global_defs {
+          router_id $slb_hostname
+        }
+
+        $nodeset lvs-a
+        include nodesets/lvs-a.conf
+
+        $nodeset lvs-b
+        include nodesets/lvs-b.conf
+
+    Keepalived Configuration Parser
+    -------------------------------
+
+    Node configuration files are validated in-process before any file is written,
+    with a port of keepalived-check's grammar and rules. Every problem found is
+    reported with its line and column.
+
+    The parser's original website is https://github.com/frsyuki/keepalived-check, the
+    rules are the ones of the modified version available at https://github.com/lpther/keepalived-check
+
+
+    '''
+    def __init__(self, logger, config):
+        super(Keepalived, self).__init__('keepalived', logger, config)
+
+        self.clustering_plugin = None
+
+        self.cluster_nodesets = ['default']
+        if 'nodesets' in config:
+            self.cluster_nodesets = [nodeset.strip() for nodeset in config['nodesets'].split(',') if nodeset.strip()]
+
+            if not self.cluster_nodesets:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: nodesets must name at least one nodeset', errno=215)
+
+        # [path, mtime, version or None] of the keepalived binary, see find_keepalived
+        self.keepalived_binary = None
+
+        self.lvs_support = False
+        self.vrrp_support = False
+        if 'modes' in config:
+            if 'vrrp' in [mode.strip() for mode in config['modes'].split(',')]:
+                self.vrrp_support = True
+
+            if 'lvs' in [mode.strip() for mode in config['modes'].split(',')]:
+                self.lvs_support = True
+
+        if self.lvs_support:
+            self.logger.info('Keepalived plugin started with LVS support')
+
+        if self.vrrp_support:
+            self.logger.info('Keepalived plugin started with VRRP support')
+
+        self.live_config_file = '/etc/keepalived/keepalived.conf'
+        if 'live-config-file' in config:
+            self.live_config_file = config['live-config-file']
+
+        self.config_dir = '/etc/keepalived/master'
+        if 'config-dir' in config:
+            self.config_dir = config['config-dir']
+        self.master_config_file = os.path.normpath('%s/%s.master' % (self.config_dir, os.path.basename(self.live_config_file)))
+
+        # Checked on first use, see live_config_file_writable and config_dir_writable
+        self._live_config_file_writable = None
+        self._config_dir_writable = None
+
+        # config-dir is created before the first write, see prepare_config_dir
+        self.config_dir_prepared = False
+
+        self.reload_cmd = 'service keepalived reload'
+        if 'reload-cmd' in config:
+            self.reload_cmd = config['reload-cmd']
+
+        self.reload_method = 'command'
+        if 'reload-method' in config:
+            self.reload_method = config['reload-method'].strip()
+
+            if self.reload_method not in ['command', 'signal']:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: reload-method must be command or signal', errno=205)
+
+        self.pid_file = '/var/run/keepalived.pid'
+        if 'pid-file' in config:
+            self.pid_file = config['pid-file']
+
+        self.vrrp_data_file = '/tmp/keepalived.data'
+        if 'vrrp-data-file' in config:
+            self.vrrp_data_file = config['vrrp-data-file']
+
+        self.vrrp_stats_file = '/tmp/keepalived.stats'
+        if 'vrrp-stats-file' in config:
+            self.vrrp_stats_file = config['vrrp-stats-file']
+
+        self.vrrp_cache_ttl = 5
+        if 'vrrp-cache-ttl' in config:
+            try:
+                self.vrrp_cache_ttl = max(0, int(config['vrrp-cache-ttl']))
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: vrrp-cache-ttl must be an integer', errno=211)
+
+        # (monotonic time of the fetch, nodes, dict of node -> VrrpDump), see get_vrrp_dumps
+        self.vrrp_cache = None
+
+        self.lvs_proc_dir = '/proc/net'
+        if 'lvs-proc-dir' in config:
+            self.lvs_proc_dir = config['lvs-proc-dir']
+
+        self.lvs_stats_cmd = 'ipvsadm -Ln --stats --exact'
+        if 'lvs-stats-cmd' in config:
+            self.lvs_stats_cmd = config['lvs-stats-cmd']
+
+        self.lvs_rate_interval = 1.0
+        if 'lvs-rate-interval' in config:
+            try:
+                self.lvs_rate_interval = float(config['lvs-rate-interval'])
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: lvs-rate-interval must be a number', errno=212)
+
+            if self.lvs_rate_interval <= 0:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: lvs-rate-interval must be positive', errno=212)
+
+        self.reload_mode = 'parallel'
+        if 'reload-mode' in config:
+            self.reload_mode = config['reload-mode'].strip()
+
+            if self.reload_mode not in ['parallel', 'rolling']:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: reload-mode must be parallel or rolling', errno=206)
+
+        self.reload_batch_size = 1
+        if 'reload-batch-size' in config:
+            try:
+                self.reload_batch_size = max(1, int(config['reload-batch-size']))
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: reload-batch-size must be an integer', errno=207)
+
+        self.reload_probe = 'process'
+        if 'reload-probe' in config:
+            self.reload_probe = config['reload-probe'].strip()
+
+            if self.reload_probe not in ['process', 'vrrp', 'none']:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: reload-probe must be process, vrrp or none', errno=208)
+
+        self.reload_probe_timeout = 30
+        if 'reload-probe-timeout' in config:
+            try:
+                self.reload_probe_timeout = int(config['reload-probe-timeout'])
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: reload-probe-timeout must be an integer', errno=209)
+
+        if self.reload_method == 'signal':
+            self.logger.debug('Reloading keepalived with SIGHUP to the pid in %s' % self.pid_file)
+        else:
+            self.logger.debug('Using reload command "%s"' % self.reload_cmd)
+
+        cache_size = 64
+        if 'cache-size' in config:
+            try:
+                cache_size = int(config['cache-size'])
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: cache-size must be an integer', errno=202)
+
+        self.cache = ContentCache(cache_size * 1024 * 1024)
+
+        self.archive = ConfigArchive('%s/archive' % self.config_dir)
+
+        self.includes = ConfigIncludes(self.config_dir)
+
+        self.archive_retention = 1000
+        if 'archive-retention' in config:
+            try:
+                self.archive_retention = int(config['archive-retention'])
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: archive-retention must be an integer', errno=204)
+
+        self.commit_concurrency = 0
+        if 'commit-concurrency' in config:
+            try:
+                self.commit_concurrency = max(0, int(config['commit-concurrency']))
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: commit-concurrency must be an integer', errno=203)
+
+        stats_history = 20
+        if 'stats-history' in config:
+            try:
+                stats_history = int(config['stats-history'])
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: stats-history must be an integer', errno=210)
+
+        self.commit_history = collections.deque(maxlen=max(1, stats_history))
+        self.commit_stats = None
+
+        self.stats_file = None
+        if 'stats-file' in config:
+            self.stats_file = config['stats-file']
+
+        self.commit_lock_timeout = 300
+        if 'commit-lock-timeout' in config:
+            try:
+                self.commit_lock_timeout = int(config['commit-lock-timeout'])
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: commit-lock-timeout must be an integer', errno=213)
+
+        self.commit_lock_max_age = 3600
+        if 'commit-lock-max-age' in config:
+            try:
+                self.commit_lock_max_age = int(config['commit-lock-max-age'])
+            except ValueError:
+                raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: commit-lock-max-age must be an integer', errno=214)
+
+        # (nodes, lock content) while the commit lock is held, see acquire_commit_lock
+        self.commit_lock = None
+
+        # Seconds an incomplete commit lock is left to its holder, see is_stale_commit_lock
+        self.commit_lock_grace = 10
+
+        self.add_command(sysadmintoolkit.command.ExecCommand('debug keepalived', self, self.debug), modes=['root', 'config'])
+        self.add_command(sysadmintoolkit.command.ExecCommand('show stats keepalived', self, self.display_commit_stats), modes=['root', 'config'])
+        self.add_command(sysadmintoolkit.command.ExecCommand('show config keepalived', self, self.display_master_config_file), modes=['root', 'config'])
+        self.add_command(sysadmintoolkit.command.ExecCommand('show archive keepalived', self, self.display_archive), modes=['root', 'config'])
+        self.add_command(sysadmintoolkit.command.ExecCommand('show archive keepalived <revision>', self, self.display_archived_revision), modes=['root', 'config'])
+        self.add_command(sysadmintoolkit.command.ExecCommand('show archive keepalived <revision> diff <other-revision>', self, self.display_archive_diff), modes=['root', 'config'])
+        self.add_dynamic_keyword_fn('<revision>', self.get_archive_revisions, modes=['root', 'config'])
+        self.add_dynamic_keyword_fn('<other-revision>', self.get_archive_revisions, modes=['root', 'config'])
+
+        # Path -> ConfigManifest, see get_manifest
+        self.manifests = {}
+
+        self.pending_config = None
+
+        self.logger.debug('Keepalived plugin initialization complete')
+
+    def update_plugin_set(self, plugin_set):
+        super(Keepalived, self).update_plugin_set(plugin_set)
+
+        if 'clustering' in self.plugin_set.get_plugins():
+            self.clustering_plugin = self.plugin_set.get_plugins()['clustering']
+            self.add_command(sysadmintoolkit.command.ExecCommand('edit keepalived', self, self.edit_master_config_file), modes=['config'])
+            self.add_command(sysadmintoolkit.command.ExecCommand('show config keepalived pending', self, self.display_pending_config), modes=['config'])
+            self.add_command(sysadmintoolkit.command.ExecCommand('show config keepalived pending unified', self, self.display_pending_config_unified), modes=['config'])
+            self.add_command(sysadmintoolkit.command.ExecCommand('show config keepalived pending node <node>', self, self.display_pending_node_config), modes=['config'])
+            self.add_dynamic_keyword_fn('<node>', self.get_nodeset_nodes, modes=['config'])
+            self.add_command(sysadmintoolkit.command.ExecCommand('commit keepalived', self, self.commit_pending_config), modes=['config'])
+            self.add_command(sysadmintoolkit.command.ExecCommand('rollback keepalived <revision>', self, self.rollback_pending_config), modes=['config'])
+
+            if self.vrrp_support:
+                self.add_command(sysadmintoolkit.command.ExecCommand('show vrrp status', self, self.display_vrrp_status), modes=['root', 'config'])
+                self.add_command(sysadmintoolkit.command.ExecCommand('show vrrp stats', self, self.display_vrrp_stats), modes=['root', 'config'])
+
+            if self.lvs_support:
+                self.add_command(sysadmintoolkit.command.ExecCommand('show lvs services', self, self.display_lvs_services), modes=['root', 'config'])
+                self.add_command(sysadmintoolkit.command.ExecCommand('show lvs rates', self, self.display_lvs_rates), modes=['root', 'config'])
+
+
+    def enter_mode(self, cmdprompt):
+        super(Keepalived, self).enter_mode(cmdprompt)
+
+        if cmdprompt.get_mode() == 'config':
+            self.logger.debug('Loading master config file as pending configuration')
+
+            (master_config, master_stat) = self.read_master_config()
+
+            self.pending_config = PendingConfig(master_config, master_stat, self.load_include_record())
+            self.refresh_pending_includes()
+
+    def leave_mode(self, cmdprompt):
+        super(Keepalived, self).leave_mode(cmdprompt)
+
+        if cmdprompt.get_mode() == 'config':
+            self.refresh_pending_master()
+
+            if self.pending_config.is_changed():
+                self.logger.warning('Uncommitted configuration files')
+
+                print
+                print '  Pending keepalived configuration changes:'
+                self.display_pending_config(None)
+
+                while True:
+                    input = raw_input('>> Do you want to commit ? (y/n) - ')
+
+                    if input.lower() in ['y', 'yes', 'n', 'no']:
+                        break
+
+                    print
+
+                if input.lower() in ['n', 'no']:
+                    print
+                    print '  Aborting changes, no harm done!'
+                    print
+
+                elif input.lower() in ['y', 'yes']:
+                    self.commit_pending_config(None)
+
+            self.pending_config = None
+
+    def read_master_config(self):
+        '''
+        Returns the content of the master configuration file and its
+        (size, mtime), an empty configuration and None before the first commit
+        '''
+        try:
+            master_stat = os.stat(self.master_config_file)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+            return ('', None)
+
+        fd = open(self.master_config_file, 'r')
+        master_config = fd.read()
+        fd.close()
+
+        return (master_config, (master_stat.st_size, master_stat.st_mtime))
+
+    def refresh_pending_master(self):
+        '''
+        Reads the master configuration file again only if its size or mtime
+        changed since it was last read, e.g. by a commit from another session
+        '''
+        try:
+            master_stat = os.stat(self.master_config_file)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+            master_stat = None
+
+        if master_stat is not None and (master_stat.st_size, master_stat.st_mtime) != self.pending_config.master_stat:
+            self.logger.debug('Master config file changed on disk, reading it again')
+            self.pending_config.set_master(*self.read_master_config())
+
+        self.refresh_pending_includes()
+
+    def refresh_pending_includes(self):
+        '''
+        Expands the includes of the working copy, updating the digests of the
+        included files in the pending configuration
+
+        Returns the ConfigExpansion, None if the includes cannot be expanded
+        '''
+        try:
+            expansion = self.includes.expand(self.pending_config.working_config)
+        except ConfigIncludeError as e:
+            self.pending_config.include_error = e.message
+            return None
+
+        self.pending_config.include_error = None
+        self.pending_config.working_include_digests = expansion.digests
+
+        return expansion
+
+    def load_include_record(self):
+        '''
+        Returns the included files of the last commit, as a dict of file -> digest
+        '''
+        include_record_file = '%s/.include-record' % self.config_dir
+
+        if not os.path.exists(include_record_file):
+            return {}
+
+        try:
+            fd = open(include_record_file, 'r')
+            include_record = json.load(fd)
+            fd.close()
+        except ValueError:
+            self.logger.warning('Ignoring corrupted include record %s' % include_record_file)
+            return {}
+
+        return dict([(str(include_file), str(digest)) for (include_file, digest) in include_record.items()])
+
+    def save_include_record(self, include_digests):
+        include_record_file = '%s/.include-record' % self.config_dir
+
+        fd = open('%s.tmp' % include_record_file, 'w')
+        json.dump(include_digests, fd, indent=1, sort_keys=True)
+        fd.close()
+
+        os.rename('%s.tmp' % include_record_file, include_record_file)
+
+    @property
+    def live_config_file_writable(self):
+        '''
+        False if the live config file does not exist and cannot be created
+        '''
+        if self._live_config_file_writable is None:
+            self._live_config_file_writable = os.path.exists(self.live_config_file) or \
+                                              os.access(os.path.dirname(self.live_config_file), os.W_OK)
+
+            if not self._live_config_file_writable:
+                self.logger.warning('Current user cannot write the live config file %s' % self.live_config_file)
+
+        return self._live_config_file_writable
+
+    @property
+    def config_dir_writable(self):
+        '''
+        False if config-dir does not exist and cannot be created
+        '''
+        if self._config_dir_writable is None:
+            self._config_dir_writable = os.path.exists(self.config_dir) or os.access(os.path.dirname(self.config_dir), os.W_OK)
+
+            if not self._config_dir_writable:
+                self.logger.warning('Current user cannot write in config dir %s' % self.config_dir)
+
+        return self._config_dir_writable
+
+    def prepare_config_dir(self):
+        '''
+        Creates config-dir and its archive dir, once, before the first write
+        '''
+        if self.config_dir_prepared:
+            return
+
+        try:
+            self.logger.debug('Making sure archive dir %s is present' % os.path.abspath('%s/archive' % self.config_dir))
+            os.makedirs(os.path.abspath('%s/archive' % self.config_dir))
+        except OSError as e:
+            # Ignore if dir already exists
+            if e.errno != 17:
+                raise e
+
+        self.config_dir_prepared = True
+
+    def find_keepalived(self):
+        '''
+        Returns the path of the keepalived binary, looked up in PATH on first
+        use and again only if the binary found is changed or removed
+
+        Raises PluginError if keepalived is not in PATH
+        '''
+        if self.keepalived_binary is not None:
+            try:
+                if os.stat(self.keepalived_binary[0]).st_mtime == self.keepalived_binary[1]:
+                    return self.keepalived_binary[0]
+            except OSError:
+                pass
+
+            self.keepalived_binary = None
+
+        path = find_executable('keepalived')
+        if path is None:
+            raise sysadmintoolkit.exception.PluginError(errmsg='keepalived command could not be found', errno=201, plugin=self)
+
+        self.keepalived_binary = [path, os.stat(path).st_mtime, None]
+
+        return path
+
+    def get_keepalived_version(self):
+        '''
+        Returns the output of keepalived -v, kept until the binary changes
+        '''
+        path = self.find_keepalived()
+
+        if self.keepalived_binary[2] is None:
+            self.keepalived_binary[2] = sysadmintoolkit.utils.get_status_output('%s -v' % pipes.quote(path), self.logger)[1].strip()
+
+        return self.keepalived_binary[2]
+
+    def generate_config_from_master(self, template, nodes=None):
+        '''
+        Renders the master configuration template for every node of nodes,
+        the nodes of the nodesets by default
+
+        Returns an ordered dict of node -> node configuration (str)
+        '''
+        config_map = collections.OrderedDict()
+
+        if nodes is None and self.clustering_plugin:
+            nodes = self.get_nodesets_nodes(self.cluster_nodesets)
+
+        for node in nodes or []:
+            config_map[node] = template.render(node)
+
+        return config_map
+
+    # Dynamic keywords
+
+    def get_archive_revisions(self, user_input_obj=None):
+        '''
+        Returns the archived revisions as a dict of revision -> description
+        '''
+        self.archive.load()
+
+        revisions = {}
+        for revision in self.archive.revisions:
+            revisions[str(revision)] = 'Revision committed on %s' % self.archive.revisions[revision][0]
+
+        return revisions
+
+    def get_nodeset_nodes(self, user_input_obj=None):
+        '''
+        Returns the nodes of the nodesets as a dict of node -> description
+        '''
+        node_nodesets = self.get_node_nodesets(self.cluster_nodesets)
+
+        nodes = {}
+        for node in node_nodesets:
+            nodes[node] = 'Node of nodeset %s' % ', '.join(node_nodesets[node])
+
+        return nodes
+
+    def get_revision_argument(self, revision):
+        '''
+        Returns revision (str) as an archived revision number
+        '''
+        self.archive.load()
+
+        try:
+            if int(revision) in self.archive.revisions:
+                return int(revision)
+        except ValueError:
+            pass
+
+        raise sysadmintoolkit.exception.PluginError(errmsg='Unknown archived revision %s' % revision, errno=401, plugin=self)
+
+    # Sysadmin-toolkit commands
+
+    def display_master_config_file(self, user_input_obj):
+        '''
+        Display the content of the master configuration file
+        '''
+        if self.clustering_plugin:
+            print 'Verifying that master config file is synchronized across the cluster...'
+            print
+            self.display_sync_status()
+
+            print
+            print '  ' + ('*' * 80)
+
+        if not os.access(os.path.dirname(self.master_config_file), os.R_OK):
+            self.logger.warning('Cannot open master config file %s for reading ' % self.master_config_file)
+            raise sysadmintoolkit.exception.PluginError('Cannot open master config file %s for reading' % self.master_config_file, errmsg=400)
+
+        fd = open(self.master_config_file, 'r')
+        print
+        print fd.read()
+        fd.close()
+
+        return 0
+
+    def get_manifest(self, path):
+        '''
+        Returns the ConfigManifest of path, None if path does not exist
+
+        Manifests are kept in memory and in <path>.manifest along with the size
+        and mtime of path, the file is only hashed again when they change.
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        (size, mtime) = (stat.st_size, int(stat.st_mtime))
+
+        manifest = self.manifests.get(path)
+        if manifest is not None and manifest.matches(size, mtime):
+            return manifest
+
+        manifest = None
+        try:
+            with open('%s.manifest' % path, 'r') as fd:
+                manifest = ConfigManifest.from_json(fd.read())
+
+            if not manifest.matches(size, mtime):
+                manifest = None
+        except (IOError, ValueError):
+            pass
+
+        if manifest is None:
+            self.logger.debug('Computing manifest of %s' % path)
+
+            fd = open(path, 'r')
+            manifest = ConfigManifest.from_content(fd.read(), size, mtime)
+            fd.close()
+
+            if self.config_dir_writable:
+                try:
+                    self.write_manifest(path, manifest)
+                except (IOError, OSError) as e:
+                    self.logger.warning('Could not write manifest of %s: %s' % (path, e))
+
+        self.manifests[path] = manifest
+
+        return manifest
+
+    def write_manifest(self, path, manifest):
+        '''
+        Writes manifest to <path>.manifest, returns its content
+        '''
+        manifest_json = manifest.to_json()
+
+        fd = open('%s.manifest.tmp' % path, 'w')
+        fd.write(manifest_json)
+        fd.close()
+
+        os.rename('%s.manifest.tmp' % path, '%s.manifest' % path)
+
+        self.manifests[path] = manifest
+
+        return manifest_json
+
+    def get_node_manifests(self, nodes):
+        '''
+        Fetches the manifests of the master and node configuration files of nodes,
+        with the size and mtime of the files, in one cluster command
+
+        Returns a dict of node -> [(size, mtime) or None, ConfigManifest or None],
+        for the master then the node configuration file
+        '''
+        command = 'cd %s && for f in %s %s_`uname -n` ; do echo "== $f" ; stat -c "%%s %%Y" $f && cat $f.manifest ; echo ; done' % \
+                  (pipes.quote(self.config_dir), pipes.quote(os.path.basename(self.master_config_file)), \
+                   pipes.quote(os.path.basename(self.master_config_file)))
+
+        node_manifests = {}
+
+        for (buffer, buffer_nodes) in self.clustering_plugin.run_cluster_command(command, nodes):
+            files = []
+
+            for line in buffer:
+                line = line.strip()
+
+                if line.startswith('== '):
+                    files.append([None, None])
+                elif not files:
+                    continue
+                elif line.startswith('{'):
+                    try:
+                        files[-1][1] = ConfigManifest.from_json(line)
+                    except ValueError:
+                        pass
+                elif len(line.split()) == 2 and ''.join(line.split()).isdigit():
+                    files[-1][0] = tuple([int(value) for value in line.split()])
+
+            files.extend([[None, None]] * (2 - len(files)))
+
+            for node in buffer_nodes:
+                node_manifests[node] = files[:2]
+
+        return node_manifests
+
+    def display_sync_status(self):
+        '''
+        Compares the manifests of the master and node configuration files of
+        reachable nodes with the local ones, down to the differing blocks
+
+        Returns the number of nodes out of sync
+        '''
+        nodes = self.get_nodesets_nodes(self.cluster_nodesets, reachable=True)
+
+        master_manifest = self.get_manifest(self.master_config_file)
+        node_manifests = self.get_node_manifests(nodes)
+
+        out_of_sync = 0
+
+        for node in sorted(nodes):
+            expected_manifests = [('master configuration', master_manifest),
+                                  ('node configuration', self.get_manifest('%s_%s' % (self.master_config_file, node)))]
+
+            problems = []
+            for ((description, expected_manifest), (stat, manifest)) in zip(expected_manifests, node_manifests.get(node, [[None, None]] * 2)):
+                if expected_manifest is None:
+                    continue
+
+                if stat is None:
+                    problems.append('%s missing' % description)
+                elif manifest is None:
+                    problems.append('%s has no manifest' % description)
+                elif not manifest.matches(*stat):
+                    problems.append('%s modified outside of a commit' % description)
+                else:
+                    differences = expected_manifest.diff(manifest)
+
+                    if differences:
+                        problems.append('%s differs: %s' % (description, \
+                                        ', '.join(['%s %s' % (label, change) for (label, change) in differences])))
+
+            if problems:
+                out_of_sync += 1
+                print '  %s: OUT OF SYNC' % node
+                for problem in problems:
+                    print '    %s' % problem
+            else:
+                print '  %s: in sync (%s)' % (node, master_manifest.digest[:12] if master_manifest else 'no master configuration')
+
+        print
+
+        if out_of_sync:
+            print '  %s of %s nodes out of sync' % (out_of_sync, len(nodes))
+        else:
+            print '  All %s nodes in sync' % len(nodes)
+
+        return out_of_sync
+
+    def display_archive(self, user_input_obj):
+        '''
+        Display the archived revisions of the master configuration file
+        '''
+        self.archive.load()
+
+        if not self.archive.revisions:
+            print
+            print '  No archived revision'
+            print
+
+            return 0
+
+        current_digest = None
+        if os.access(self.master_config_file, os.R_OK):
+            fd = open(self.master_config_file, 'r')
+            current_digest = content_digest(fd.read())
+            fd.close()
+
+        print
+        print '    Revision  Committed on (UTC)      Size  Digest'
+        print '    --------  -------------------  -------  ------------'
+
+        for revision in self.archive.revisions:
+            (timestamp, digest, size) = self.archive.revisions[revision]
+            print '  %s %8s  %19s  %7s  %s' % ('*' if digest == current_digest else ' ', revision, timestamp, size, digest[:12])
+
+        print
+        print '  * current master configuration'
+        print
+
+        return 0
+
+    def display_archived_revision(self, user_input_obj):
+        '''
+        Display the content of an archived revision
+        '''
+        revision = self.get_revision_argument(user_input_obj.get_entered_command().split()[3])
+
+        print
+        print self.archive.get(revision)
+
+        return 0
+
+    def display_archive_diff(self, user_input_obj):
+        '''
+        Display the differences between two archived revisions
+        '''
+        words = user_input_obj.get_entered_command().split()
+        revision = self.get_revision_argument(words[3])
+        other_revision = self.get_revision_argument(words[5])
+
+        old_config = self.archive.get(revision)
+        new_config = self.archive.get(other_revision)
+
+        print
+        if old_config != new_config:
+            self.display_config_diff(old_config, new_config, 'Revision %s' % revision, 'Revision %s' % other_revision)
+        else:
+            print '  Revisions %s and %s are identical' % (revision, other_revision)
+        print
+
+        return 0
+
+    def edit_master_config_file(self, user_input_obj):
+        '''
+        Edit a copy of the master configuration file
+        '''
+        previous_config = self.pending_config.working_config
+
+        # The editor is the only step working on a file
+        temp_master_file = tempfile.NamedTemporaryFile()
+        temp_master_file.write(previous_config)
+        temp_master_file.flush()
+
+        self.logger.debug('Editing file %s' % temp_master_file.name)
+
+        sysadmintoolkit.utils.execute_interactive_cmd('vi %s' % temp_master_file.name, self.logger)
+
+        fd = open(temp_master_file.name, 'r')
+        edited_config = fd.read()
+        fd.close()
+
+        temp_master_file.close()
+
+        if not self.pending_config.update(edited_config):
+            print
+            print 'No changes done, ignoring previous command'
+            print
+
+            return 0
+        else:
+            print
+            print 'The following changes were made:'
+            print
+
+            self.display_config_diff(previous_config, edited_config, 'Master Configuration File (Working Copy)', 'Last Edit')
+
+            return 0
+
+    def rollback_pending_config(self, user_input_obj):
+        '''
+        Replace the pending configuration with an archived revision
+        '''
+        revision = self.get_revision_argument(user_input_obj.get_entered_command().split()[2])
+
+        self.pending_config.update(self.archive.get(revision))
+
+        print
+        print 'Revision %s loaded as pending configuration, use "commit keepalived" to apply it' % revision
+
+        self.display_pending_config(None)
+
+        return 0
+
+    def display_pending_config(self, user_input_obj):
+        '''
+        Display uncommitted configuration
+        '''
+        self.refresh_pending_master()
+
+        if not self.pending_config.is_changed():
+            print
+            print '  No pending configuration'
+            print
+        else:
+            print
+
+            if self.pending_config.working_digest != self.pending_config.master_digest:
+                self.display_config_diff(self.pending_config.master_config, self.pending_config.working_config, \
+                                         'Master Configuration File', 'Pending Configuration File')
+                print
+
+            self.display_pending_includes()
+
+    def display_pending_includes(self):
+        '''
+        Lists the included files changed since the last commit and the files
+        including them
+        '''
+        if self.pending_config.include_error is not None:
+            print '  Includes cannot be expanded: %s' % self.pending_config.include_error
+            print
+            return
+
+        changed_includes = self.pending_config.changed_includes()
+
+        if not changed_includes:
+            return
+
+        expansion = self.refresh_pending_includes()
+
+        print '  Included files changed since the last commit:'
+        print
+
+        for (include_file, change) in changed_includes:
+            includers = expansion.includers([include_file]) if expansion is not None else set()
+
+            print '    %-8s %s%s' % (change, include_file, \
+                                     ' (included by %s)' % ', '.join(sorted([includer or 'master' for includer in includers])) \
+                                     if includers else '')
+
+        print
+
+    def display_pending_config_unified(self, user_input_obj):
+        '''
+        Display uncommitted configuration as a unified line diff
+        '''
+        self.refresh_pending_master()
+
+        if not self.pending_config.is_changed():
+            print
+            print '  No pending configuration'
+            print
+        else:
+            print
+
+            self.display_diff(self.pending_config.diff())
+
+            print
+
+            self.display_pending_includes()
+
+    def display_pending_node_config(self, user_input_obj):
+        '''
+        Display what the uncommitted configuration changes in the configuration
+        of one node
+        '''
+        node = user_input_obj.get_entered_command().split()[5]
+
+        if node not in self.get_nodesets_nodes(self.cluster_nodesets):
+            raise sysadmintoolkit.exception.PluginError(errmsg='Unknown node %s' % node, errno=402, plugin=self)
+
+        self.refresh_pending_master()
+
+        expansion = self.refresh_pending_includes()
+        if expansion is None:
+            raise sysadmintoolkit.exception.PluginError(errmsg='Cannot expand includes: %s' % self.pending_config.include_error, \
+                                                        errno=403, plugin=self)
+
+        node_config_file = '%s_%s' % (self.master_config_file, node)
+
+        if os.path.exists(node_config_file):
+            # Generated by the last commit, with the includes of that time
+            fd = open(node_config_file, 'r')
+            current_node_config = fd.read()
+            fd.close()
+        else:
+            try:
+                current_node_config = self.get_template(self.includes.expand(self.pending_config.master_config).config).render(node)
+            except ConfigIncludeError as e:
+                raise sysadmintoolkit.exception.PluginError(errmsg='Cannot expand includes: %s' % e.message, errno=403, plugin=self)
+
+        pending_node_config = self.get_template(expansion.config).render(node)
+
+        print
+        if current_node_config == pending_node_config:
+            print '  No change in the configuration of node %s' % node
+        else:
+            self.display_config_diff(current_node_config, pending_node_config, \
+                                     'Node %s Configuration' % node, 'Pending Node %s Configuration' % node)
+        print
+
+        return 0
+
+    def display_config_diff(self, old_config, new_config, from_label, to_label):
+        '''
+        Prints the structural differences between two configurations, blocks
+        being matched by identity (see diff_configs). Falls back to a unified
+        line diff if one side does not parse.
+        '''
+        try:
+            changes = diff_configs(old_config, new_config)
+        except ConfigSyntaxError as e:
+            print '  %s does not parse (%s), showing line differences' % (to_label, e.diagnostic)
+            print
+
+            self.display_diff(difflib.unified_diff(old_config.splitlines(True), new_config.splitlines(True), \
+                                                   from_label, to_label, n=7))
+            return
+
+        print '  %s -> %s' % (from_label, to_label)
+
+        if not changes:
+            print
+            print '  No structural difference (comments, blank lines or spacing only)'
+            return
+
+        path = None
+        for change in changes:
+            if change.path != path:
+                path = change.path
+
+                print
+                print '  %s' % (' > '.join(path) if path else '(top level)')
+
+            print '    %s' % str(change)
+
+        print
+        print '  %s added, %s removed, %s changed' % tuple([len([change for change in changes if change.kind == kind]) \
+                                                          for kind in ['added', 'removed', 'changed']])
+
+    def display_diff(self, diff):
+        '''
+        Prints the lines of a unified diff
+        '''
+        for line in diff:
+            if line.endswith('\n'):
+                sys.stdout.write(line)
+            else:
+                sys.stdout.write('%s\n\\ No newline at end of file\n' % line)
+
+    def commit_pending_config(self, user_input_obj):
+        '''
+        Generate configuration from new master configuration file, validate, push to
+        nodes of the cluster and reload the keepalived daemon
+        '''
+        return self.locked_commit(self.cluster_nodesets)
+
+    def batch_commit(self, master_config, nodesets=None, dry_run=False):
+        '''
+        Commits master_config to the nodes of nodesets (the nodesets of the
+        plugin by default) without the config mode: no editor, no prompt and
+        no temporary file. With dry_run, the node configurations are only
+        generated and validated, and the changes displayed.
+
+        master_config may also be a dict of nodeset -> master configuration of
+        that nodeset, replacing the $nodeset sections of these nodesets in the
+        committed master configuration (see merge_nodeset_masters). They are
+        merged again once the commit lock is held, into the master committed
+        by the commits that held it before.
+
+        Commits on the same plugin instance share its cache (see cache-size),
+        the first commit of a new process compiles the whole master.
+
+        Returns 0 on success or if there is nothing to commit, 1 if the
+        configuration is not valid, 2 if a push failed, 3 if a reload failed,
+        4 if the commit lock could not be taken
+        '''
+        (committed_master_config, master_stat) = self.read_master_config()
+
+        nodeset_masters = None
+        if isinstance(master_config, dict):
+            (master_config, nodeset_masters) = (committed_master_config, master_config)
+
+        pending_config = PendingConfig(committed_master_config, master_stat, self.load_include_record())
+        pending_config.update(master_config)
+
+        # A batch commit leaves the working copy of a config mode session alone
+        session_pending_config = self.pending_config
+        self.pending_config = pending_config
+
+        try:
+            self.refresh_pending_includes()
+
+            return self.locked_commit(nodesets or self.cluster_nodesets, dry_run, nodeset_masters)
+        finally:
+            self.pending_config = session_pending_config
+
+    def locked_commit(self, nodesets, dry_run=False, nodeset_masters=None):
+        '''
+        Runs commit holding the commit lock on the reachable nodes of every
+        nodeset of the plugin and of nodesets (none is taken for a dry run):
+        commits to different nodesets still share the master, the archive and
+        the push record, wherever they run from
+
+        nodeset_masters (a dict of nodeset -> master configuration of that
+        nodeset) replaces the working copy by the committed master with these
+        nodeset sections merged in, once more after the lock is taken.
+
+        Returns the result of commit, 4 if the lock could not be taken
+        '''
+        self.refresh_pending_master()
+
+        if nodeset_masters is not None:
+            self.merge_pending_nodesets(nodeset_masters)
+
+        if not self.pending_config.is_changed():
+            self.logger.warning('Master configuration file unchanged, no commit to do!')
+            return 0
+
+        if dry_run:
+            return self.commit(nodesets, dry_run)
+
+        lock_nodesets = self.cluster_nodesets + [nodeset for nodeset in nodesets if nodeset not in self.cluster_nodesets]
+
+        if not self.acquire_commit_lock(self.get_nodesets_nodes(lock_nodesets, reachable=True)):
+            return 4
+
+        try:
+            if nodeset_masters is not None:
+                # The commits holding the lock before may have changed other sections
+                self.refresh_pending_master()
+                self.merge_pending_nodesets(nodeset_masters)
+
+            return self.commit(nodesets)
+        finally:
+            self.release_commit_lock()
+
+    def merge_pending_nodesets(self, nodeset_masters):
+        '''
+        Replaces the working copy by the committed master configuration with
+        the sections of nodeset_masters merged in, see merge_nodeset_masters
+        '''
+        self.pending_config.update(merge_nodeset_masters(self.pending_config.master_config, nodeset_masters))
+
+        self.refresh_pending_includes()
+
+    def get_nodesets_nodes(self, nodesets, reachable=False):
+        '''
+        Returns the nodes of nodesets (only the reachable ones if reachable),
+        in nodeset order without duplicates
+        '''
+        nodes = []
+
+        for nodeset in nodesets:
+            if reachable:
+                nodeset_nodes = self.clustering_plugin.get_reachable_nodes(nodeset)
+            else:
+                nodeset_nodes = self.clustering_plugin.get_nodeset(nodeset)
+
+            nodes.extend([node for node in nodeset_nodes if node not in nodes])
+
+        return nodes
+
+    def get_node_nodesets(self, nodesets):
+        '''
+        Returns an ordered dict of node -> list of the nodesets of nodesets it
+        belongs to, in nodeset order
+        '''
+        node_nodesets = collections.OrderedDict()
+
+        for nodeset in nodesets:
+            for node in self.clustering_plugin.get_nodeset(nodeset):
+                node_nodesets.setdefault(node, []).append(nodeset)
+
+        return node_nodesets
+
+    def get_template(self, master_config, nodesets=None):
+        '''
+        Returns the ConfigTemplate of master_config, for the nodes of the
+        nodesets of the plugin and of nodesets
+        '''
+        nodesets = self.cluster_nodesets + [nodeset for nodeset in nodesets or [] if nodeset not in self.cluster_nodesets]
+
+        return ConfigTemplate(master_config, self.cache, self.get_node_nodesets(nodesets))
+
+    def commit(self, nodesets, dry_run=False):
+        '''
+        Generates the node configurations of the nodes of nodesets from the
+        pending configuration, validates them, pushes them to the reachable
+        nodes and reloads keepalived, see commit_pending_config and
+        batch_commit for the result. With dry_run, stops after validation and
+        displays what would change.
+        '''
+        self.logger.info('Commit requested%s' % (' (dry run)' if dry_run else ''))
+
+        self.refresh_pending_master()
+
+        if not self.pending_config.is_changed():
+            self.logger.warning('Master configuration file unchanged, no commit to do!')
+            return 0
+
+        # A dry run only uses the built-in validator, it may run from a host
+        # without keepalived
+        if not dry_run:
+            self.find_keepalived()
+
+        self.commit_stats = CommitStats()
+        self.commit_stats.phase('generate')
+
+        self.logger.debug('Generating node configuration file')
+
+        master_config = self.pending_config.working_config
+
+        try:
+            expansion = self.includes.expand(master_config)
+        except ConfigIncludeError as e:
+            self.logger.error('Cannot expand includes of the master configuration: %s' % e.message)
+            print 'Error expanding includes: %s' % e.message
+            print
+            print '>> Aborting commit!'
+            print
+
+            self.record_commit_stats(1)
+            return 1
+
+        self.pending_config.working_include_digests = expansion.digests
+
+        template = self.get_template(expansion.config, nodesets)
+
+        unknown_nodesets = template.nodesets().difference(self.cluster_nodesets, nodesets)
+        if unknown_nodesets:
+            self.logger.error('Master configuration names unknown nodesets: %s' % ', '.join(sorted(unknown_nodesets)))
+            print 'Error in master configuration: $nodeset names nodesets not managed by the plugin: %s' % \
+                    ', '.join(sorted(unknown_nodesets))
+            print
+            print '>> Aborting commit!'
+            print
+
+            self.record_commit_stats(1)
+            return 1
+
+        self.pending_config.node_config = self.generate_config_from_master(template, self.get_nodesets_nodes(nodesets))
+
+        self.logger.info('Node configuration files generated successfully')
+
+        self.commit_stats.phase('validate')
+
+        node_diagnostics = template.validate(self.pending_config.node_config)
+
+        all_parse_ok = True
+        all_push_ok = True
+        all_reload_ok = True
+        for node in self.pending_config.node_config:
+            if not node_diagnostics[node]:
+                self.logger.info('%s configuration file is OK' % node)
+            else:
+                msg = '\n'.join([expansion.describe(diagnostic) for diagnostic in node_diagnostics[node]])
+                self.logger.error('%s configuration file parsing FAILED:\n  %s' % (node, msg))
+                print 'Error parsing configuration for node %s:\n%s' % (node, msg)
+                print
+                print '>> Aborting commit!'
+                print
+
+                all_parse_ok = False
+
+                break
+
+        if all_parse_ok and dry_run:
+            self.logger.info('All files have been parsed successfully')
+
+            self.display_dry_run(self.get_nodesets_nodes(nodesets, reachable=True))
+
+            self.pending_config.node_config = {}
+            self.commit_stats = None
+
+            return 0
+
+        if all_parse_ok:
+            self.logger.info('All files have been parsed successfully')
+
+            self.commit_stats.phase('archive')
+
+            self.prepare_config_dir()
+
+            self.logger.debug('Backing up previous master configuration file')
+            self.logger.debug('Populating config dir with new files')
+
+            previous_master_config = self.pending_config.master_config
+
+            time_suffix = time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime())
+
+            if self.archive.import_legacy(os.path.basename(self.master_config_file)):
+                self.logger.info('Imported legacy archive files in %s' % self.archive.archive_dir)
+
+            self.archive.load()
+
+            if previous_master_config and (not self.archive.revisions or \
+                    self.archive.revisions.values()[-1][1] != content_digest(previous_master_config)):
+                # Keep the configuration being replaced, so it can be rolled back to
+                self.archive.add(previous_master_config, \
+                                 time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime(os.path.getmtime(self.master_config_file))))
+
+            (revision, object_relpath) = self.archive.add(master_config, time_suffix)
+            removed_objects = self.archive.compact(self.archive_retention)
+            if removed_objects:
+                self.logger.debug('Removed %s archived objects no longer referenced' % len(removed_objects))
+
+            self.logger.info('Master configuration archived as revision %s' % revision)
+
+            fd = open(self.archive.index_file, 'r')
+            archive_index = fd.read()
+            fd.close()
+
+            archive_object_size = os.path.getsize('%s/%s' % (self.archive.archive_dir, object_relpath))
+
+            self.commit_stats.count('bytes_written', archive_object_size + len(archive_index))
+            self.commit_stats.count('files_written', 2)
+
+            self.commit_stats.phase('write')
+
+            fd = open(self.master_config_file, 'w')
+            fd.write(master_config)
+            fd.close()
+
+            master_stat = os.stat(self.master_config_file)
+            self.pending_config.set_master(master_config, (master_stat.st_size, master_stat.st_mtime))
+
+            if expansion.digests:
+                # Template blocks are the ones of the expanded configuration
+                master_manifest = ConfigManifest.from_content(master_config, master_stat.st_size, int(master_stat.st_mtime))
+            else:
+                master_manifest = ConfigManifest.from_blocks([block.text for block in template.blocks], \
+                                                             [block.digest for block in template.blocks], \
+                                                             master_stat.st_size, int(master_stat.st_mtime))
+
+            manifest_jsons = {}
+            manifest_jsons[self.master_config_file] = self.write_manifest(self.master_config_file, master_manifest)
+
+            self.commit_stats.count('bytes_written', len(master_config) + len(manifest_jsons[self.master_config_file]))
+            self.commit_stats.count('files_written', 2)
+
+            for node in self.pending_config.node_config:
+                node_config_file = '%s_%s' % (self.master_config_file, node)
+                node_manifest = ConfigManifest.from_content(self.pending_config.node_config[node])
+
+                # Unchanged node files keep their mtime, so their manifest and
+                # push record stay valid
+                previous_manifest = self.get_manifest(node_config_file)
+                if previous_manifest is None or previous_manifest.digest != node_manifest.digest:
+                    fd = open(node_config_file, 'w')
+                    fd.write(self.pending_config.node_config[node])
+                    fd.close()
+
+                    node_stat = os.stat(node_config_file)
+                    (node_manifest.size, node_manifest.mtime) = (node_stat.st_size, int(node_stat.st_mtime))
+
+                    self.commit_stats.count('bytes_written', len(self.pending_config.node_config[node]) + \
+                                            len(self.write_manifest(node_config_file, node_manifest)))
+                    self.commit_stats.count('files_written', 2)
+                else:
+                    node_manifest = previous_manifest
+
+                manifest_jsons[node_config_file] = node_manifest.to_json()
+
+            self.commit_stats.phase('plan')
+
+            nodes = self.get_nodesets_nodes(nodesets, reachable=True)
+
+            # Included files inside config-dir follow the master, so any node
+            # can commit it again
+            include_files = []
+            for include_file in sorted(expansion.digests):
+                if os.path.isabs(include_file):
+                    self.logger.warning('Included file %s is outside of %s, not pushed to nodes' % (include_file, self.config_dir))
+                    continue
+
+                include_files.append((include_file, expansion.digests[include_file], \
+                                      os.path.getsize('%s/%s' % (self.config_dir, include_file))))
+
+            node_files = collections.OrderedDict()
+            for node in nodes:
+                node_files[node] = [(os.path.basename(self.master_config_file), content_digest(master_config), len(master_config)),
+                                    ('archive/%s' % object_relpath, content_digest(master_config), archive_object_size),
+                                    ('archive/index', content_digest(archive_index), len(archive_index))] + include_files
+
+                if node in self.pending_config.node_config:
+                    node_config = self.pending_config.node_config[node]
+                    node_files[node].append(('%s_%s' % (os.path.basename(self.master_config_file), node), \
+                                             content_digest(node_config), len(node_config)))
+
+                for config_file in [self.master_config_file, '%s_%s' % (self.master_config_file, node)]:
+                    if config_file in manifest_jsons:
+                        node_files[node].append(('%s.manifest' % os.path.basename(config_file), \
+                                                 content_digest(manifest_jsons[config_file]), len(manifest_jsons[config_file])))
+
+            push_record = self.load_push_record()
+            push_plan = self.plan_push(node_files, push_record, content_digest(previous_master_config))
+
+            changed_nodes = self.plan_activation(nodes, push_record, content_digest(previous_master_config))
+            unchanged_nodes = [node for node in nodes if node not in changed_nodes]
+
+            self.commit_stats.count('nodes_changed', len(changed_nodes))
+            self.commit_stats.count('nodes_unchanged', len(unchanged_nodes))
+
+            self.commit_stats.count('bytes_pushed', sum([size for node in push_plan for (relpath, digest, size) in push_plan[node][0]]))
+            self.commit_stats.count('files_pushed', sum([len(push_plan[node][0]) for node in push_plan]))
+            self.commit_stats.count('files_skipped', sum([len(push_plan[node][1]) for node in push_plan]))
+
+            self.commit_stats.phase('deploy')
+
+            rolling = self.reload_mode == 'rolling'
+
+            if rolling:
+                self.logger.info('Pushing files and activating configuration on reachable nodes (%s)' % changed_nodes)
+            else:
+                self.logger.info('Pushing files, activating and reloading keepalived on reachable nodes (%s)' % changed_nodes)
+
+            if unchanged_nodes:
+                self.logger.info('Configuration unchanged on nodes %s, only pushing the master configuration and archive' % unchanged_nodes)
+
+            deploy_results = self.deploy_node_configs(nodes, push_plan, reload=not rolling, activate_nodes=changed_nodes)
+
+            if rolling:
+                self.commit_stats.phase('rolling_reload')
+
+                activated_nodes = [node for (node, failed_phase, output) in deploy_results \
+                                   if failed_phase is None and node in changed_nodes]
+
+                roles = dict([(node, template.node_role(node)) for node in activated_nodes])
+
+                # Nodesets are rolled independently, each node with its first nodeset
+                node_nodesets = self.get_node_nodesets(nodesets)
+                groups = collections.OrderedDict()
+                for node in activated_nodes:
+                    groups.setdefault(node_nodesets.get(node, [None])[0], []).append(node)
+
+                reload_results = dict([(result[0], result) for result in \
+                                       self.rolling_reload(activated_nodes, roles, groups.values())])
+
+                deploy_results = [reload_results.get(result[0], result) for result in deploy_results]
+
+            self.commit_stats.phase('record')
+
+            for (node, failed_phase, output) in deploy_results:
+                live_digest = push_record.get(node, {}).get(self.live_config_file)
+
+                if failed_phase in [None, 'activate', 'reload', 'probe']:
+                    push_record[node] = dict([(relpath, digest) for (relpath, digest, size) in node_files[node]])
+                else:
+                    push_record.pop(node, None)
+
+                if failed_phase is None:
+                    if node in changed_nodes:
+                        self.logger.info('%s configuration pushed (%s bytes in %s files, %s files skipped), activated and reloaded' % \
+                                         (node, sum([size for (relpath, digest, size) in push_plan[node][0]]), \
+                                          len(push_plan[node][0]), len(push_plan[node][1])))
+
+                        live_digest = content_digest(self.pending_config.node_config[node])
+
+                    # Node configuration known to be live and reloaded on the node
+                    push_record[node][self.live_config_file] = live_digest
+                    continue
+
+                if failed_phase in ['reload', 'probe']:
+                    all_reload_ok = False
+                    self.logger.error('Problem with keepalived reload with node %s:\n%s' % (node, '\n'.join(output)))
+                else:
+                    all_push_ok = False
+                    self.logger.error('Problem with %s with node %s:\n%s' % (failed_phase, node, '\n'.join(output)))
+
+                print 'Commit failed on node %s during %s:\n%s' % (node, failed_phase, '\n'.join(output))
+                print
+
+            self.save_push_record(push_record)
+
+            self.pending_config.include_digests = dict(expansion.digests)
+            self.save_include_record(expansion.digests)
+
+            print
+            print 'Pushed %s bytes in %s files to %s nodes, %s unchanged files skipped' % \
+                    (self.commit_stats.counters['bytes_pushed'], self.commit_stats.counters['files_pushed'], \
+                     len(push_plan), self.commit_stats.counters['files_skipped'])
+
+            if unchanged_nodes:
+                print 'Configuration unchanged, not activated nor reloaded on %s nodes: %s' % (len(unchanged_nodes), ', '.join(unchanged_nodes))
+
+        self.pending_config.node_config = {}
+
+        if not all_parse_ok:
+            result = 1
+        elif not all_push_ok:
+            result = 2
+        elif not all_reload_ok:
+            result = 3
+        else:
+            result = 0
+
+        self.record_commit_stats(result)
+
+        if result == 0:
+            self.logger.debug('Commit completed successfully')
+            print
+            print 'Commit completed successfully'
+            print
+
+        return result
+
+    def display_dry_run(self, nodes):
+        '''
+        Displays what committing the pending configuration would change, the
+        node configurations being generated
+        '''
+        print
+        print 'Dry run, nothing is written, pushed nor reloaded'
+        print
+
+        if self.pending_config.working_digest != self.pending_config.master_digest:
+            self.display_config_diff(self.pending_config.master_config, self.pending_config.working_config, \
+                                     'Master Configuration File', 'Pending Configuration File')
+            print
+
+        self.display_pending_includes()
+
+        changed_nodes = self.plan_activation(nodes, self.load_push_record(), content_digest(self.pending_config.master_config))
+
+        print '  Would activate and reload %s of %s reachable nodes: %s' % (len(changed_nodes), len(nodes), ', '.join(changed_nodes))
+        print
+
+    def acquire_commit_lock(self, nodes, timeout=None):
+        '''
+        Takes the commit lock, a .commit-lock file in config-dir, on every node
+        of nodes, waiting up to timeout seconds (commit-lock-timeout by
+        default) for the commits holding it to finish
+
+        Every node is tried in one cluster command. If any node is held by
+        another commit, the locks taken are given back before waiting, so two
+        commits never hold part of the cluster each. A lock whose holder
+        process is gone, or older than commit-lock-max-age, is broken, see
+        is_stale_commit_lock.
+
+        Returns True if the lock is held on every node
+        '''
+        if timeout is None:
+            timeout = self.commit_lock_timeout
+
+        deadline = monotonic_time() + timeout
+        waiting = False
+
+        while True:
+            lock_content = '%s %s %d %032x' % (socket.gethostname(), os.getpid(), time.time(), random.getrandbits(128))
+
+            # A held lock is reported with the time of the node and the mtime
+            # of the lock file, '-' if it was removed in between
+            command = 'mkdir -p %s && cd %s && if ( set -C ; echo %s > .commit-lock ) 2>/dev/null ; then echo "== locked" ; ' \
+                      'else echo "== held `date +%%s` `stat -c %%Y .commit-lock 2>/dev/null || echo -` `cat .commit-lock 2>/dev/null`" ; fi' % \
+                      (pipes.quote(self.config_dir), pipes.quote(self.config_dir), pipes.quote(lock_content))
+
+            locked_nodes = []
+            released_nodes = []
+            holders = {}
+
+            for (node, sections) in self.run_sectioned_command(command, nodes).items():
+                for (header, lines) in sections:
+                    if header[:1] == ['locked']:
+                        locked_nodes.append(node)
+                    elif header[:1] == ['held'] and len(header) >= 3:
+                        try:
+                            holders[node] = (int(header[1]) - int(header[2]), header[3:])
+                        except ValueError:
+                            released_nodes.append(node)
+
+            failed_nodes = [node for node in nodes if node not in locked_nodes and node not in holders and node not in released_nodes]
+
+            if not holders and not released_nodes and not failed_nodes:
+                self.commit_lock = (nodes, lock_content)
+                self.logger.debug('Commit lock taken on %s' % nodes)
+                return True
+
+            self.release_commit_lock((locked_nodes, lock_content))
+
+            if failed_nodes:
+                self.logger.error('Could not take the commit lock on %s' % failed_nodes)
+                print 'Could not take the commit lock in %s on nodes %s' % (self.config_dir, ', '.join(failed_nodes))
+                print
+                return False
+
+            stale_nodes = [node for node in holders if self.is_stale_commit_lock(holders[node][1], holders[node][0], nodes)]
+
+            if stale_nodes:
+                for node in stale_nodes:
+                    self.logger.warning('Breaking stale commit lock of node %s held by %s' % \
+                                        (node, ' '.join(holders[node][1][:2]) or 'an unfinished commit lock'))
+
+                self.release_commit_lock((stale_nodes, None), dict([(node, holders[node][1]) for node in stale_nodes]))
+                continue
+
+            if released_nodes and not holders:
+                # Released between the two steps of the command, try again right away
+                continue
+
+            (holder_host, holder_pid) = (holders.values()[0][1] + ['?', '?'])[:2]
+
+            if monotonic_time() >= deadline:
+                self.logger.error('Commit lock still held by %s (pid %s) after %ss' % (holder_host, holder_pid, timeout))
+                print 'Commit lock held by %s (pid %s), giving up after %ss' % (holder_host, holder_pid, timeout)
+                print
+                return False
+
+            if not waiting:
+                print 'Waiting for the commit lock held by %s (pid %s)...' % (holder_host, holder_pid)
+                waiting = True
+
+            # Commits queued at the same time retry at different times
+            time.sleep(random.uniform(0.2, 1.0))
+
+    def release_commit_lock(self, commit_lock=None, holders=None):
+        '''
+        Removes the commit lock from its nodes if it still holds the content
+        it was taken with, commit_lock being (nodes, content) and the lock
+        taken by acquire_commit_lock by default. With holders (node -> lock
+        content fields), the lock of each node is removed if it is still the
+        one of its holder.
+
+        The lock file is renamed before its content is compared, so only one
+        of several commits breaking the same stale lock removes it, and a
+        lock taken again in between is put back instead of removed.
+        '''
+        if commit_lock is None:
+            (commit_lock, self.commit_lock) = (self.commit_lock, None)
+
+        if not commit_lock or not commit_lock[0]:
+            return
+
+        (nodes, lock_content) = commit_lock
+
+        # Content -> nodes, one cluster command per distinct content
+        content_nodes = collections.OrderedDict()
+        for node in nodes:
+            content_nodes.setdefault(lock_content if holders is None else ' '.join(holders[node]), []).append(node)
+
+        for (expected_content, nodes) in content_nodes.items():
+            moved_lock = '.commit-lock.%032x' % random.getrandbits(128)
+
+            self.clustering_plugin.run_cluster_command('cd %s && if mv .commit-lock %s 2>/dev/null ; then '
+                                                       'if [ "`cat %s`" != %s ] ; then ln %s .commit-lock 2>/dev/null ; fi ; '
+                                                       'rm -f %s ; fi' % \
+                                                       (pipes.quote(self.config_dir), moved_lock, moved_lock, \
+                                                        pipes.quote(expected_content), moved_lock, moved_lock), nodes)
+
+    def is_stale_commit_lock(self, holder, age, nodes):
+        '''
+        Returns True if the commit lock with content holder (host, pid, epoch,
+        token) and whose file is age seconds old is older than
+        commit-lock-max-age, or its process is gone. The process is only
+        checked on the local node and on nodes.
+
+        A lock without a complete content is being written by its holder,
+        unless it is older than commit_lock_grace seconds: its holder died
+        before writing it.
+        '''
+        if age > self.commit_lock_max_age:
+            return True
+
+        try:
+            (host, pid) = (holder[0], int(holder[1]))
+            int(holder[2])
+            holder[3]
+        except (IndexError, ValueError):
+            return age > min(self.commit_lock_grace, self.commit_lock_max_age)
+
+        if self.is_local_node(host):
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                return e.errno == errno.ESRCH
+
+            return False
+
+        if host in nodes:
+            (running, output) = self.run_node_command(host, 'ps -p %s >/dev/null' % pid)
+            return not running and len(output) > 0
+
+        return False
+
+    def record_commit_stats(self, result):
+        '''
+        Ends the statistics of the running commit, keeps them in the commit
+        history and appends them as a JSON line to stats-file if set
+        '''
+        self.commit_stats.finish(result)
+        self.commit_history.append(self.commit_stats)
+
+        self.logger.info('Commit took %.3fs (%s)' % (self.commit_stats.duration, \
+                         ', '.join(['%s %.3fs' % (phase, seconds) for (phase, seconds) in self.commit_stats.phases.items()])))
+
+        if self.stats_file:
+            try:
+                with open(self.stats_file, 'a') as fd:
+                    fd.write('%s\n' % json.dumps(self.commit_stats.to_dict()))
+            except IOError as e:
+                self.logger.warning('Could not write commit statistics to %s: %s' % (self.stats_file, e))
+
+        self.commit_stats = None
+
+    def node_timer(self, nodes, phase):
+        '''
+        Returns a context manager timing phase on nodes, run at once, in the
+        running commit
+        '''
+        if self.commit_stats is None:
+            return _null_timer()
+
+        return self.commit_stats.node_timer(nodes, phase)
+
+    def load_push_record(self):
+        '''
+        Returns the files pushed by previous commits from this host, as a
+        dict of node -> {relative path: content digest}
+        '''
+        push_record_file = '%s/.push-record' % self.config_dir
+
+        if not os.path.exists(push_record_file):
+            return {}
+
+        try:
+            fd = open(push_record_file, 'r')
+            push_record = json.load(fd)
+            fd.close()
+        except ValueError:
+            self.logger.warning('Ignoring corrupted push record %s' % push_record_file)
+            return {}
+
+        return push_record
+
+    def save_push_record(self, push_record):
+        push_record_file = '%s/.push-record' % self.config_dir
+
+        fd = open('%s.tmp' % push_record_file, 'w')
+        json.dump(push_record, fd, indent=1, sort_keys=True)
+        fd.close()
+
+        os.rename('%s.tmp' % push_record_file, push_record_file)
+
+    def plan_push(self, node_files, push_record, previous_master_digest):
+        '''
+        Decides which files each node must receive, node_files being a dict of
+        node -> list of (relative path, content digest, size) the node needs.
+
+        A file is skipped when the push record says the node already got the
+        same content. The record of a node is only trusted if its master digest
+        is the one of the master being replaced, otherwise another host
+        committed since and everything is sent again.
+
+        Returns a dict of node -> (files to send, files skipped)
+        '''
+        master_relpath = os.path.basename(self.master_config_file)
+
+        push_plan = collections.OrderedDict()
+        for node in node_files:
+            node_record = push_record.get(node, {})
+
+            if node_record.get(master_relpath) != previous_master_digest:
+                node_record = {}
+
+            push_plan[node] = ([entry for entry in node_files[node] if node_record.get(entry[0]) != entry[1]],
+                               [entry for entry in node_files[node] if node_record.get(entry[0]) == entry[1]])
+
+        return push_plan
+
+    def plan_activation(self, nodes, push_record, previous_master_digest):
+        '''
+        Returns the nodes whose live configuration must be replaced and
+        keepalived reloaded: the ones whose new node configuration is not the
+        one the push record says is live on the node. The record is trusted
+        under the same condition as in plan_push.
+        '''
+        master_relpath = os.path.basename(self.master_config_file)
+
+        changed_nodes = []
+        for node in nodes:
+            node_record = push_record.get(node, {})
+
+            if node not in self.pending_config.node_config or node_record.get(master_relpath) != previous_master_digest or \
+                    node_record.get(self.live_config_file) != content_digest(self.pending_config.node_config[node]):
+                changed_nodes.append(node)
+
+        return changed_nodes
+
+    def is_local_node(self, node):
+        '''
+        Returns True if node is the node the plugin runs on
+        '''
+        hostname = socket.gethostname()
+
+        return node in [hostname, hostname.split('.')[0]]
+
+    def run_node_command(self, node, command, phase=None):
+        '''
+        Runs command on node through the clustering plugin, see
+        run_nodes_command
+
+        Returns (True if the command returned 0, output lines)
+        '''
+        return self.run_nodes_command([node], command, phase)[node]
+
+    def run_nodes_command(self, nodes, command, phase=None):
+        '''
+        Runs command on nodes through the clustering plugin, see
+        run_nodes_phases. The return code of each node is kept in the running
+        commit statistics for phase.
+
+        Returns an ordered dict of node -> (True if the command returned 0,
+        output lines), in nodes order
+        '''
+        results = collections.OrderedDict()
+
+        for (node, phase_results) in self.run_nodes_phases(dict([(node, [(phase, command)]) for node in nodes]), nodes).items():
+            results[node] = phase_results[0][1:]
+
+        return results
+
+    def run_nodes_phases(self, node_phases, nodes=None):
+        '''
+        Runs on each node its phases, a list of (phase, command) run one after
+        the other while they succeed, node_phases being a dict of node -> its
+        phases. Each node goes through its phases at its own pace, all the
+        nodes in one command of the clustering plugin (or in commands of at
+        most commit-concurrency nodes, one after the other). Nodes with
+        different phase commands select theirs by `uname -n`.
+
+        The clustering plugin is only called from the thread running the
+        commit, it is not known to be safe to call from several threads.
+
+        The return code and duration of every phase on each node are kept in
+        the running commit statistics, phases being None are not recorded.
+
+        Returns an ordered dict of node -> list of (phase, True if it returned
+        0, output lines) for every phase run on the node, the last one being
+        the failed one if any, in nodes order (node_phases order by default)
+        '''
+        if nodes is None:
+            nodes = node_phases.keys()
+
+        if not nodes:
+            return collections.OrderedDict()
+
+        # Phases script -> nodes running it
+        scripts = collections.OrderedDict()
+        for node in nodes:
+            scripts.setdefault(phases_script(node_phases[node]), []).append(node)
+
+        if len(scripts) == 1:
+            command = scripts.keys()[0]
+        else:
+            command = 'case `uname -n` in %s *) echo "Node `uname -n` not expected" ;; esac' % \
+                      ' '.join(['%s) %s ;;' % ('|'.join(['%s|%s.*' % (pipes.quote(node), pipes.quote(node)) for node in script_nodes]), script) \
+                                for (script, script_nodes) in scripts.items()])
+
+        outputs = {}
+
+        chunk_size = self.commit_concurrency or len(nodes) or 1
+        for i in range(0, len(nodes), chunk_size):
+            for (buffer, buffer_nodes) in self.clustering_plugin.run_cluster_command(command, nodes[i:i + chunk_size]):
+                for node in buffer_nodes:
+                    outputs.setdefault(node, []).extend(buffer)
+
+        results = collections.OrderedDict()
+        for node in nodes:
+            results[node] = []
+
+            output = []
+            phases = list(node_phases[node])
+            for line in outputs.get(node, []):
+                output.append(line)
+
+                match = phase_end_re.match(line.strip())
+                if match is None or not phases or match.group(1) != str(phases[0][0]):
+                    continue
+
+                (phase, command) = phases.pop(0)
+                return_code = int(match.group(2))
+
+                seconds = None
+                try:
+                    seconds = max(0, float(match.group(4)) - float(match.group(3)))
+                except ValueError:
+                    pass
+
+                if self.commit_stats is not None and phase is not None:
+                    self.commit_stats.node_phase(node, phase, seconds, return_code)
+
+                results[node].append((phase, return_code == 0, output))
+                output = []
+
+            # The phase being run when the node stopped answering
+            if phases and (not results[node] or results[node][-1][1]):
+                if self.commit_stats is not None and phases[0][0] is not None:
+                    self.commit_stats.node_phase(node, phases[0][0], None, None)
+
+                results[node].append((phases[0][0], False, output))
+
+            if self.commit_stats is not None:
+                self.commit_stats.count('node_commands', len(results[node]))
+
+        return results
+
+    def reload_command(self):
+        '''
+        Returns the shell command reloading keepalived with reload-method
+        '''
+        if self.reload_method == 'signal':
+            return 'kill -HUP `cat %s`' % pipes.quote(self.pid_file)
+
+        return self.reload_cmd
+
+    def signal_keepalived(self, node, signal_name, phase=None):
+        '''
+        Sends signal_name (HUP, USR1, ...) to keepalived on node, see
+        signal_keepalived_nodes
+
+        Returns (True if the signal was sent, output lines)
+        '''
+        return self.signal_keepalived_nodes([node], signal_name, phase)[node]
+
+    def signal_keepalived_nodes(self, nodes, signal_name, phase=None):
+        '''
+        Sends signal_name (HUP, USR1, ...) to keepalived on nodes, with os.kill
+        on the local node and kill through the clustering plugin on the others
+
+        Returns an ordered dict of node -> (True if the signal was sent,
+        output lines), in nodes order
+        '''
+        results = {}
+
+        for node in [node for node in nodes if self.is_local_node(node)]:
+            if self.commit_stats is not None:
+                self.commit_stats.count('signals')
+
+            try:
+                pid = read_pidfile(self.pid_file)
+                os.kill(pid, getattr(signal, 'SIG%s' % signal_name))
+
+                results[node] = (True, ['SIG%s sent to pid %s' % (signal_name, pid)])
+            except (IOError, OSError, ValueError, IndexError) as e:
+                results[node] = (False, ['Could not send SIG%s to keepalived: %s' % (signal_name, e)])
+
+            if self.commit_stats is not None and phase is not None:
+                self.commit_stats.return_code(node, phase, 0 if results[node][0] else 1)
+
+        remote_nodes = [node for node in nodes if node not in results]
+        if remote_nodes:
+            results.update(self.run_nodes_command(remote_nodes, 'kill -%s `cat %s`' % (signal_name, pipes.quote(self.pid_file)), phase))
+
+        return collections.OrderedDict([(node, results[node]) for node in nodes])
+
+    def reload_local_node(self, node):
+        '''
+        Reloads keepalived on node, the local node, with reload-method
+
+        Returns (True if the reload was triggered, output lines)
+        '''
+        if self.reload_method == 'signal':
+            with self.node_timer([node], 'reload'):
+                return self.signal_keepalived(node, 'HUP', 'reload')
+
+        return self.run_node_command(node, self.reload_command(), 'reload')
+
+    def probe_nodes(self, nodes):
+        '''
+        Runs reload-probe once on nodes, the local node directly and the
+        others in one cluster command
+
+        Returns an ordered dict of node -> (True if the probe passed, output
+        lines)
+        '''
+        if self.reload_probe == 'none':
+            return collections.OrderedDict([(node, (True, [])) for node in nodes])
+
+        results = {}
+
+        for node in [node for node in nodes if self.is_local_node(node)]:
+            start = monotonic_time()
+
+            if self.reload_probe == 'process':
+                try:
+                    pid = read_pidfile(self.pid_file)
+                    os.kill(pid, 0)
+
+                    results[node] = (True, ['Keepalived is running with pid %s' % pid])
+                except (IOError, OSError, ValueError, IndexError) as e:
+                    results[node] = (False, ['Keepalived is not running: %s' % e])
+            else:
+                results[node] = self.probe_local_vrrp(node)
+
+            # Same return codes as the probe commands of the other nodes
+            if self.commit_stats is not None:
+                self.commit_stats.node_phase(node, 'probe', monotonic_time() - start, 0 if results[node][0] else 1)
+
+        remote_nodes = [node for node in nodes if node not in results]
+        if remote_nodes:
+            for (node, (dump_ok, output)) in self.run_nodes_command(remote_nodes, self.probe_command(), 'probe').items():
+                results[node] = self.check_probe_output(dump_ok, output)
+
+        return collections.OrderedDict([(node, results[node]) for node in nodes])
+
+    def probe_local_vrrp(self, node):
+        '''
+        Runs the vrrp probe on node, the local node: the data file is removed first
+        so a stale dump is never read, keepalived is signaled to dump its vrrp
+        data and the dump is checked with check_vrrp_states
+
+        Returns (True if the probe passed, output lines)
+        '''
+        try:
+            if os.path.exists(self.vrrp_data_file):
+                os.remove(self.vrrp_data_file)
+        except OSError as e:
+            return (False, ['Could not remove %s: %s' % (self.vrrp_data_file, e)])
+
+        (signal_ok, output) = self.signal_keepalived(node, 'USR1')
+        if not signal_ok:
+            return (False, output)
+
+        for retry in range(10):
+            time.sleep(0.1)
+
+            if os.path.exists(self.vrrp_data_file):
+                fd = open(self.vrrp_data_file, 'r')
+                vrrp_data = fd.read()
+                fd.close()
+
+                return self.check_vrrp_states(vrrp_data)
+
+        return (False, ['Keepalived did not dump its vrrp data to %s' % self.vrrp_data_file])
+
+    def probe_command(self):
+        '''
+        Returns the shell command running reload-probe on a node other than
+        the local one, its output is checked with check_probe_output. The vrrp
+        probe passes under the same conditions as on the local node: the dump
+        file was written, and its instances (if any) are settled.
+        '''
+        if self.reload_probe == 'none':
+            return 'true'
+        elif self.reload_probe == 'process':
+            return 'kill -0 `cat %s`' % pipes.quote(self.pid_file)
+
+        # Only the State lines are sent back, the return code is the one of
+        # the test of the dump file
+        return 'rm -f %s && kill -USR1 `cat %s` && sleep 1 && { grep "State = " %s ; test -f %s ; }' % \
+               (pipes.quote(self.vrrp_data_file), pipes.quote(self.pid_file), \
+                pipes.quote(self.vrrp_data_file), pipes.quote(self.vrrp_data_file))
+
+    def check_probe_output(self, command_ok, output):
+        '''
+        Returns (True if the probe passed, output lines) for the result of
+        probe_command on a node
+        '''
+        if not command_ok or self.reload_probe != 'vrrp':
+            return (command_ok, output)
+
+        return self.check_vrrp_states('\n'.join(output))
+
+    def check_vrrp_states(self, vrrp_data):
+        '''
+        Returns (True if every vrrp instance of the vrrp data dump is settled,
+        output lines). A dump without any vrrp instance is settled.
+        '''
+        states = vrrp_state_re.findall(vrrp_data)
+
+        unsettled_states = [state for state in states if state not in vrrp_settled_states]
+        if unsettled_states:
+            return (False, ['Vrrp instances not settled: %s' % ', '.join(unsettled_states)])
+
+        return (True, ['%s vrrp instances settled' % len(states)])
+
+    def wait_for_probes(self, nodes, results=None):
+        '''
+        Runs reload-probe on the nodes that have not passed it yet every
+        second, until all of them passed or reload-probe-timeout expires.
+        results holds the probes already run on some of the nodes, as
+        returned.
+
+        Returns an ordered dict of node -> (True if the probe passed, output
+        lines of its last probe), in nodes order
+        '''
+        deadline = monotonic_time() + self.reload_probe_timeout
+
+        results = dict(results or {})
+        pending_nodes = [node for node in nodes if not results.get(node, (False, []))[0]]
+
+        while pending_nodes:
+            probed_nodes = [node for node in pending_nodes if node not in results]
+            if probed_nodes:
+                results.update(self.probe_nodes(probed_nodes))
+
+            pending_nodes = [node for node in pending_nodes if not results[node][0]]
+            if not pending_nodes or monotonic_time() >= deadline:
+                break
+
+            for node in pending_nodes:
+                self.logger.debug('Probe %s not passed yet on node %s: %s' % (self.reload_probe, node, '\n'.join(results[node][1])))
+
+            time.sleep(1)
+
+            results.update(self.probe_nodes(pending_nodes))
+
+        return collections.OrderedDict([(node, results[node]) for node in nodes])
+
+    def push_file_argument(self, node, relpath):
+        '''
+        Returns relpath quoted for the shell, with node replaced by `uname -n`
+        in the name of its configuration file and manifest (as in the activate
+        command), so the files of every node are pushed by the same command
+        '''
+        node_file_prefix = '%s_%s' % (os.path.basename(self.master_config_file), node)
+
+        for suffix in ['', '.manifest']:
+            if relpath == '%s%s' % (node_file_prefix, suffix):
+                return '%s"`uname -n`"%s' % (pipes.quote('%s_' % os.path.basename(self.master_config_file)), \
+                                             pipes.quote(suffix) if suffix else '')
+
+        return pipes.quote(relpath)
+
+    def archive_prune_command(self):
+        '''
+        Returns the shell command removing from the archive of a node the
+        objects its index no longer references, run once the index is pushed.
+        The objects are those compacted by this commit or by any earlier one
+        the node missed (unreachable, failed push), so every node converges to
+        the archive of the committing host.
+        '''
+        return "( cd %s && find objects -type f | awk 'NR == FNR { kept[$3] ; next } " \
+               "{ n = split($0, parts, \"/\") ; if (!(parts[n] in kept)) print }' index - | xargs -r rm -f && " \
+               "find objects -mindepth 1 -type d -empty -delete )" % pipes.quote('%s/archive' % self.config_dir)
+
+    def deploy_node_configs(self, nodes, push_plan, reload=True, activate_nodes=None):
+        '''
+        Pushes to every node the files planned for it (relative paths in
+        config dir) in a single transfer, pruning the node's archive when its
+        index is pushed (see archive_prune_command), then activates the configuration file of the nodes of activate_nodes (all
+        nodes if None) and reloads keepalived on them if reload is True.
+
+        All nodes are deployed by one cluster command (see run_nodes_phases),
+        each node going through push, activate and reload on its own. A
+        failure on one node does not stop the others. Nothing is transferred
+        to a node without files to push. The local node is reloaded with
+        os.kill once activated, see reload_local_node.
+
+        Returns a list of (node, failed phase or None, output lines of the
+        last phase), in nodes order
+        '''
+        activate_command = 'cp %s_`uname -n` %s' % (self.master_config_file, self.live_config_file)
+
+        node_phases = collections.OrderedDict()
+        for node in nodes:
+            node_phases[node] = []
+
+            push_files = [relpath for (relpath, digest, size) in push_plan[node][0]]
+
+            if push_files:
+                push_command = "printf '%%s\\n' %s | rsync -pt --files-from=- %s:%s/ %s/" % \
+                               (' '.join([self.push_file_argument(node, relpath) for relpath in push_files]), \
+                                socket.gethostname(), self.config_dir, self.config_dir)
+
+                if 'archive/index' in push_files:
+                    push_command += ' && %s' % self.archive_prune_command()
+
+                node_phases[node].append(('push', push_command))
+
+            if activate_nodes is None or node in activate_nodes:
+                node_phases[node].append(('activate', activate_command))
+
+                if reload and not (self.is_local_node(node) and self.reload_method == 'signal'):
+                    node_phases[node].append(('reload', self.reload_command()))
+
+        deployed_nodes = [node for node in nodes if node_phases[node]]
+
+        self.logger.debug('Deploying nodes %s' % deployed_nodes)
+
+        phase_results = self.run_nodes_phases(node_phases, deployed_nodes)
+
+        results = []
+        for node in nodes:
+            (failed_phase, output) = (None, [])
+
+            if node in phase_results:
+                (phase, phase_ok, output) = phase_results[node][-1]
+
+                if not phase_ok:
+                    failed_phase = phase
+                elif phase == 'activate' and reload:
+                    (reload_ok, output) = self.reload_local_node(node)
+                    failed_phase = None if reload_ok else 'reload'
+
+            results.append((node, failed_phase, output))
+
+        return results
+
+    def rolling_reload(self, nodes, roles, groups=None):
+        '''
+        Reloads keepalived on nodes in batches of reload-batch-size, nodes with
+        the 'other' role first, then 'backup', 'master' last (roles is a dict
+        of node -> role). Every node of a batch must pass reload-probe before
+        the next batch is reloaded, the remaining nodes are not reloaded after
+        a failure. Each node of a batch is probed as soon as it is reloaded,
+        in the same cluster command.
+
+        groups splits nodes in lists rolled independently, a failure only
+        stopping the rest of its group. The batches of the same rank of every
+        group are reloaded and probed together. All nodes are one group by
+        default.
+
+        Returns a list of (node, failed phase or None, output lines), in nodes order
+        '''
+        role_order = ['other', 'backup', 'master']
+
+        if groups is None:
+            groups = [nodes]
+
+        group_batches = []
+        for group in groups:
+            ordered_nodes = sorted(group, key=lambda node: role_order.index(roles.get(node, 'other')))
+
+            group_batches.append([ordered_nodes[i:i + self.reload_batch_size] \
+                                  for i in range(0, len(ordered_nodes), self.reload_batch_size)])
+
+        results = {}
+        failed_nodes = [[] for group in groups]
+
+        for batch_index in range(max([len(batches) for batches in group_batches] + [0])):
+            batch = []
+
+            for (group_index, batches) in enumerate(group_batches):
+                if batch_index >= len(batches):
+                    continue
+
+                if failed_nodes[group_index]:
+                    for node in batches[batch_index]:
+                        results[node] = (node, 'reload', ['Not reloaded, rolling reload stopped after a failure on %s' % \
+                                                          ', '.join(failed_nodes[group_index])])
+                    continue
+
+                batch.extend(batches[batch_index])
+
+            if not batch:
+                continue
+
+            self.logger.info('Reloading batch %s: %s' % (batch_index + 1, \
+                             ', '.join(['%s (%s)' % (node, roles.get(node, 'other')) for node in batch])))
+
+            reload_results = {}
+            probe_results = {}
+
+            remote_nodes = [node for node in batch if not self.is_local_node(node)]
+            if remote_nodes:
+                phase_results = self.run_nodes_phases(dict([(node, [('reload', self.reload_command()), ('probe', self.probe_command())]) \
+                                                            for node in remote_nodes]), remote_nodes)
+
+                for node in remote_nodes:
+                    reload_results[node] = phase_results[node][0][1:]
+
+                    if len(phase_results[node]) > 1:
+                        probe_results[node] = self.check_probe_output(*phase_results[node][1][1:])
 
-    The keepalived package must be installed.
+            for node in [node for node in batch if self.is_local_node(node)]:
+                reload_results[node] = self.reload_local_node(node)
 
-    Configuration
-    -------------
+            probed_nodes = [node for node in batch if reload_results[node][0]]
+            waited_nodes = [node for node in probed_nodes if not probe_results.get(node, (False, []))[0]]
 
-    *modes*
-      Supported modes:
+            with self.node_timer(waited_nodes, 'probe'):
+                probe_results = self.wait_for_probes(probed_nodes, probe_results)
 
-      ::
+            for node in batch:
+                if not reload_results[node][0]:
+                    results[node] = (node, 'reload', reload_results[node][1])
+                elif not probe_results[node][0]:
+                    results[node] = (node, 'probe', probe_results[node][1])
+                else:
+                    results[node] = (node, None, probe_results[node][1])
+                    continue
 
-        lvs:  Linux virtual server commands, such as healthchecks status (not implemented yet)
-        vrrp: VRRP commands, such as vrrp status display (not implemented yet)
+                for (group_index, group) in enumerate(groups):
+                    if node in group:
+                        failed_nodes[group_index].append(node)
 
-      Example: modes = lvs, vrrp
+        return [results[node] for node in nodes]
 
-      Default: no mode loaded by default
+    def display_commit_stats(self, user_input_obj):
+        '''
+        Display timings and counters of the last commits
+        '''
+        if not self.commit_history:
+            print 'No commit since the plugin started'
+            print
+            return 0
 
-    *live-config-file*
-      Configuration file used by the keepalived daemon,
-      must be the same on all nodes of the cluster.
+        print 'Last %s commits (of at most %s kept):' % (len(self.commit_history), self.commit_history.maxlen)
+        print
 
-      Default: live-config-file = /etc/keepalived/keepalived.conf
+        for commit_stats in self.commit_history:
+            self.display_one_commit_stats(commit_stats)
 
-    *config-dir*
-      Main directory where revisions, master configuration
-      and node configuration files are kept.
+        return 0
 
-      Default: config-dir = /etc/keepalived/master
+    def display_one_commit_stats(self, commit_stats):
+        print '  %s UTC  result %s  %.3fs' % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(commit_stats.started)), \
+                                            commit_stats.result, commit_stats.duration)
+        print '    Phases: %s' % ', '.join(['%s %.3fs' % (phase, seconds) for (phase, seconds) in commit_stats.phases.items()])
 
-    *reload-cmd*
-      Command to trigger a reload of the keepalied daemon.
+        if commit_stats.counters:
+            print '    Counters: %s' % ', '.join(['%s=%s' % (counter, value) for (counter, value) in sorted(commit_stats.counters.items())])
 
-      Default: reload-cmd = service keepalived reload
+        if commit_stats.nodes:
+            print '    Nodes:'
 
-    Master Configuration Special Keywords
-    -------------------------------------
+            for node in sorted(commit_stats.nodes, key=commit_stats.node_seconds, reverse=True):
+                print '      %-20s %.3fs  %s' % (node, commit_stats.node_seconds(node), \
+                        ', '.join(['%s %s (rc=%s)' % (phase, '%.3fs' % phase_stats['seconds'] if phase_stats['seconds'] is not None else '-', \
+                                                      phase_stats['return_code']) \
+                                   for (phase, phase_stats) in commit_stats.nodes[node].items()]))
 
-    *$slb_hostname*
-      This is replaced by the local hostname on each node. It must be left
-      verbatim in the *global_defs* section.
+        print
 
-      Example:
+    def get_vrrp_dumps(self, nodes):
+        '''
+        Fetches the vrrp data and stats dumps of nodes in one cluster command,
+        reusing the previous fetch if it is younger than vrrp-cache-ttl
 
-      ::
+        On each node, keepalived is signaled (SIGUSR1 and SIGUSR2) only if its
+        dump files are older than vrrp-cache-ttl.
 
-        global_defs  {
-          router_id $slb_hostname
-        }
+        Returns (age in seconds of the fetch, dict of node -> VrrpDump)
+        '''
+        if self.vrrp_cache is not None:
+            (fetched, cached_nodes, dumps) = self.vrrp_cache
 
-    *$master_backup*
-      This keyword takes 2 arguments: the node you want normally you service to run on, and
-      the second preferred node you want your service to run on.
+            age = monotonic_time() - fetched
+            if age < self.vrrp_cache_ttl and set(nodes) <= cached_nodes:
+                return (age, dumps)
 
-      This is a bloc of configuration that is present in a *vrrp_instance* bloc. This
-      replaces the "priority" keyword.
+        command = 'd=%s ; s=%s ; now=`date +%%s` ; ' \
+                  'if ! ( [ -s $d ] && [ -s $s ] && [ $(( now - `stat -c %%Y $d` )) -lt %s ] && [ $(( now - `stat -c %%Y $s` )) -lt %s ] ) ; then ' \
+                  'rm -f $d $s && kill -USR1 `cat %s` && kill -USR2 `cat %s` && ' \
+                  'for i in `seq 30` ; do [ -s $d ] && [ -s $s ] && break ; sleep 0.1 ; done ; fi ; ' \
+                  'echo "== data `stat -c %%Y $d`" ; cat $d ; echo "== stats" ; cat $s' % \
+                  (pipes.quote(self.vrrp_data_file), pipes.quote(self.vrrp_stats_file), self.vrrp_cache_ttl, self.vrrp_cache_ttl, \
+                   pipes.quote(self.pid_file), pipes.quote(self.pid_file))
 
-      On the master node, the priority is switched to 150, on the backup 100 and on any other
-      node to 50.
+        dumps = {}
 
-      Example:
+        for (buffer, buffer_nodes) in self.clustering_plugin.run_cluster_command(command, nodes):
+            dump = self.parse_vrrp_dumps(buffer)
 
-      ::
+            for node in buffer_nodes:
+                dumps[node] = dump
 
-        vrrp_instance vip-group-a {
-          state BACKUP
-          interface eth0
-          $master_backup node1 node2
-          [...]
-        }
+        for node in nodes:
+            if node not in dumps:
+                dumps[node] = VrrpDump(None, {}, {}, 'No answer')
 
-      This will replace generate 3 configuration files with
-      the line $master_backup changed to:
+        self.vrrp_cache = (monotonic_time(), set(nodes), dumps)
 
-      ::
+        return (0, dumps)
 
-        Node        Declaration
-        -------------------------
-        node1       priority 150
-        node2       priority 100
-        node3       priority 50
+    def parse_vrrp_dumps(self, buffer):
+        '''
+        Returns the VrrpDump of the output of the get_vrrp_dumps command on one node
+        '''
+        data_start = None
+        stats_start = None
 
-    Keepalived Configuration Parser
-    -------------------------------
+        for (index, line) in enumerate(buffer):
+            if line.startswith('== data'):
+                data_start = index
+            elif line.startswith('== stats'):
+                stats_start = index
 
-    The parser's original website is https://github.com/frsyuki/keepalived-check, but
-    the plugin uses a modified version available at https://github.com/lpther/keepalived-check
+        if data_start is None or stats_start is None or stats_start < data_start:
+            return VrrpDump(None, {}, {}, '\n'.join(buffer).strip() or 'No output')
 
+        try:
+            dumped = int(buffer[data_start].split()[2])
+        except (IndexError, ValueError):
+            return VrrpDump(None, {}, {}, ('\n'.join(buffer[:data_start]).strip() or 'Keepalived did not dump its vrrp data'))
 
-    '''
-    def __init__(self, logger, config):
-        super(Keepalived, self).__init__('keepalived', logger, config)
+        instances = collections.OrderedDict(iter_vrrp_data(itertools.islice(buffer, data_start + 1, stats_start)))
+        stats = collections.OrderedDict(iter_vrrp_stats(itertools.islice(buffer, stats_start + 1, None)))
 
-        self.clustering_plugin = None
-        self.cluster_nodeset_name = 'default'
+        return VrrpDump(dumped, instances, stats, None)
 
-        ret, out = sysadmintoolkit.utils.get_status_output('which keepalived', self.logger)
-        if ret is not 0:
-            raise sysadmintoolkit.exception.PluginError('Critical error in keepalived plugin: keepalived command could not be found', errno=201)
+    def display_vrrp_status(self, user_input_obj):
+        '''
+        Display the state of every vrrp instance on every node of the cluster
+        '''
+        nodes = self.get_nodesets_nodes(self.cluster_nodesets)
+        reachable_nodes = self.get_nodesets_nodes(self.cluster_nodesets, reachable=True)
 
-        self.lvs_support = False
-        self.vrrp_support = False
-        if 'modes' in config:
-            if 'vrrp' in [mode.strip() for mode in config['modes'].split(',')]:
-                self.vrrp_support = True
+        (age, dumps) = self.get_vrrp_dumps(reachable_nodes)
 
-            if 'lvs' in [mode.strip() for mode in config['modes'].split(',')]:
-                self.lvs_support = True
+        self.display_nodes_header('Vrrp dumps of %s nodes%s' % (len(reachable_nodes), ' (cached %.1fs ago)' % age if age else ''), \
+                                  nodes, reachable_nodes, dict([(node, dumps[node].error) for node in dumps]))
 
-        if self.lvs_support:
-            self.logger.info('Keepalived plugin started with LVS support')
+        instances = self.get_vrrp_instances(reachable_nodes, dumps)
 
-        if self.vrrp_support:
-            self.logger.info('Keepalived plugin started with VRRP support')
+        if not instances:
+            print '  No vrrp instance'
+            print
+            return 0
 
-        self.live_config_file = '/etc/keepalived/keepalived.conf'
-        self.live_config_file_writable = True
-        if 'live-config-file' in config:
-            self.live_config_file = config['live-config-file']
+        print '  %-20s %-16s %-8s %5s %5s  %s' % ('Instance', 'Node', 'State', 'Prio', 'VRID', 'In state for')
+        print '  %-20s %-16s %-8s %5s %5s  %s' % ('-' * 20, '-' * 16, '-' * 8, '-' * 5, '-' * 5, '-' * 12)
 
-        if not os.path.exists(self.live_config_file) and not os.access(os.path.dirname(self.live_config_file), os.W_OK):
-            self.logger.warning('Current user cannot write the live config file %s' % self.live_config_file)
-            self.live_config_file_writable = False
+        warnings = []
 
-        self.config_dir = '/etc/keepalived/master'
-        self.config_dir_writable = True
-        if 'config-dir' in config:
-            self.config_dir = config['config-dir']
-        self.master_config_file = os.path.normpath('%s/%s.master' % (self.config_dir, os.path.basename(self.live_config_file)))
+        for instance in instances:
+            first = True
+            masters = []
 
-        if not os.path.exists(self.config_dir) and not os.access(os.path.dirname(self.config_dir), os.W_OK):
-            self.logger.warning('Current user cannot write in config dir %s' % self.config_dir)
-            self.config_dir_writable = False
-        else:
-            self.prepare_config_dir()
+            for node in sorted(instances[instance]):
+                fields = dumps[node].instances[instance]
 
-        self.reload_cmd = 'service keepalived reload'
-        if 'reload-cmd' in config:
-            self.reload_cmd = config['reload-cmd']
+                state = fields.get('State', '?')
+                if state == 'MASTER':
+                    masters.append(node)
 
-        self.logger.debug('Using reload command "%s"' % self.reload_cmd)
+                in_state_for = '-'
+                try:
+                    in_state_for = format_duration(dumps[node].dumped - int(fields['Last transition'].split()[0]))
+                except (KeyError, IndexError, ValueError):
+                    pass
 
-        self.add_command(sysadmintoolkit.command.ExecCommand('debug keepalived', self, self.debug), modes=['root', 'config'])
-        self.add_command(sysadmintoolkit.command.ExecCommand('show config keepalived', self, self.display_master_config_file), modes=['root', 'config'])
+                print '  %-20s %-16s %-8s %5s %5s  %s' % (instance if first else '', node, state, \
+                                                         fields.get('Effective priority', fields.get('Priority', '?')), \
+                                                         fields.get('Virtual Router ID', '?'), in_state_for)
+                first = False
 
-        self.pending_config = None
+            if not masters:
+                warnings.append('%s has no MASTER' % instance)
+            elif len(masters) > 1:
+                warnings.append('%s is MASTER on %s nodes: %s' % (instance, len(masters), ', '.join(masters)))
 
-        self.logger.debug('Keepalived plugin initialization complete')
+        print
 
-    def update_plugin_set(self, plugin_set):
-        super(Keepalived, self).update_plugin_set(plugin_set)
+        for warning in warnings:
+            print '  WARNING: %s' % warning
 
-        if 'clustering' in self.plugin_set.get_plugins():
-            self.clustering_plugin = self.plugin_set.get_plugins()['clustering']
-            self.add_command(sysadmintoolkit.command.ExecCommand('edit keepalived', self, self.edit_master_config_file), modes=['config'])
-            self.add_command(sysadmintoolkit.command.ExecCommand('show config keepalived pending', self, self.display_pending_config), modes=['config'])
-            self.add_command(sysadmintoolkit.command.ExecCommand('commit keepalived', self, self.commit_pending_config), modes=['config'])
+        if warnings:
+            print
 
+        return 0
 
-    def enter_mode(self, cmdprompt):
-        super(Keepalived, self).enter_mode(cmdprompt)
+    def display_vrrp_stats(self, user_input_obj):
+        '''
+        Display the vrrp statistics of every vrrp instance on every node of
+        the cluster
+        '''
+        nodes = self.get_nodesets_nodes(self.cluster_nodesets)
+        reachable_nodes = self.get_nodesets_nodes(self.cluster_nodesets, reachable=True)
 
-        if cmdprompt.get_mode() == 'config':
-            self.logger.debug('Copying master config file to a temporary file')
+        (age, dumps) = self.get_vrrp_dumps(reachable_nodes)
 
-            master_config_copy = tempfile.NamedTemporaryFile()
+        self.display_nodes_header('Vrrp dumps of %s nodes%s' % (len(reachable_nodes), ' (cached %.1fs ago)' % age if age else ''), \
+                                  nodes, reachable_nodes, dict([(node, dumps[node].error) for node in dumps]))
 
-            self.pending_config = { 'master_config': master_config_copy, 'node_config_files': {} }
-            shutil.copyfile(self.master_config_file, master_config_copy.name)
+        instances = self.get_vrrp_instances(reachable_nodes, dumps, stats=True)
 
-    def leave_mode(self, cmdprompt):
-        super(Keepalived, self).leave_mode(cmdprompt)
+        if not instances:
+            print '  No vrrp instance'
+            print
+            return 0
 
-        if cmdprompt.get_mode() == 'config':
-            if not filecmp.cmp(self.master_config_file, self.pending_config['master_config'].name, shallow=False):
-                self.logger.warning('Uncommitted configuration files')
+        print '  %-20s %-16s %9s %9s %7s %7s %7s %7s' % ('Instance', 'Node', 'Adv rcvd', 'Adv sent', 'Became', 'Release', 'Pkt err', 'Auth err')
+        print '  %-20s %-16s %9s %9s %7s %7s %7s %7s' % ('', '', '', '', 'master', 'master', '', '')
+        print '  %-20s %-16s %9s %9s %7s %7s %7s %7s' % ('-' * 20, '-' * 16, '-' * 9, '-' * 9, '-' * 7, '-' * 7, '-' * 7, '-' * 7)
 
-                print
-                print '  Pending keepalived configuration changes:'
-                self.display_pending_config(None)
+        for instance in instances:
+            first = True
 
-                while True:
-                    input = raw_input('>> Do you want to commit ? (y/n) - ')
+            for node in sorted(instances[instance]):
+                counters = dumps[node].stats[instance]
 
-                    if input.lower() in ['y', 'yes', 'n', 'no']:
-                        break
+                print '  %-20s %-16s %9s %9s %7s %7s %7s %7s' % \
+                        (instance if first else '', node, counters.get('Advertisements Received', '-'), \
+                         counters.get('Advertisements Sent', '-'), counters.get('Became master', '-'), \
+                         counters.get('Released master', '-'), \
+                         sum([value for (counter, value) in counters.items() if counter.startswith('Packet Errors ')]), \
+                         sum([value for (counter, value) in counters.items() if counter.startswith('Authentication Errors ')]))
+                first = False
 
-                    print
+        print
 
-                if input.lower() in ['n', 'no']:
-                    print
-                    print '  Aborting changes, no harm done!'
-                    print
+        return 0
 
-                elif input.lower() in ['y', 'yes']:
-                    self.commit_pending_config(None)
+    def display_nodes_header(self, title, nodes, reachable_nodes, errors):
+        '''
+        Prints title, then the unreachable nodes and the nodes in errors, a
+        dict of node -> error message or None
+        '''
+        print
+        print '  %s' % title
 
-            self.pending_config = None
+        for node in sorted(nodes):
+            if node not in reachable_nodes:
+                print '    %s: unreachable' % node
+            elif errors.get(node) is not None:
+                print '    %s: %s' % (node, errors[node].replace('\n', '\n      '))
 
-    def prepare_config_dir(self):
-        try:
-            self.logger.debug('Making sure archive dir %s is present' % os.path.abspath('%s/archive' % self.config_dir))
-            os.makedirs(os.path.abspath('%s/archive' % self.config_dir))
-        except OSError as e:
-            # Ignore if dir already exists
-            if e.errno != 17:
-                raise e
+        print
 
-    def parse_config_file(self, filepath):
+    def get_vrrp_instances(self, nodes, dumps, stats=False):
         '''
-        Runs the filepath against the parser and returns (result, message)
-
-        result     bool
-        message    str
+        Returns an ordered dict of vrrp instance -> nodes having it in their
+        data dump (stats dump if stats)
         '''
-        parser_binpath = os.path.abspath('%s/keepalived-check.rb' % self.plugin_set.get_plugins()['commandprompt'].config['scripts-dir'])
+        instances = collections.OrderedDict()
 
-        (ret, out) = sysadmintoolkit.utils.get_status_output('cd %s; %s %s' % (os.path.dirname(parser_binpath), parser_binpath, filepath), self.logger)
+        for node in sorted(nodes):
+            for instance in (dumps[node].stats if stats else dumps[node].instances):
+                instances.setdefault(instance, []).append(node)
 
-        return (ret == 0, out)
+        return instances
 
-    def generate_config_from_master(self, master_config_file):
-        config_file_map = collections.OrderedDict()
+    def run_sectioned_command(self, command, nodes):
+        '''
+        Runs command on nodes in one cluster command, its output being made of
+        sections introduced by "== <name> [arguments]" lines
 
-        if self.clustering_plugin:
-            for node in self.plugin_set.get_plugins()['clustering'].get_nodeset(self.cluster_nodeset_name):
-                config_file_map[node] = {}
-                config_file_map[node]['node_configfile'] = tempfile.NamedTemporaryFile()
-                config_file_map[node]['sedresults'] = []
-
-                node_configfile = config_file_map[node]['node_configfile'].name
-
-                config_file_map[node]['sedresults'].append(sysadmintoolkit.utils.get_status_output("""sed 's/\\$slb_hostname/%s/' %s > %s""" \
-                                                                   % (node, master_config_file, node_configfile), self.logger))
-                config_file_map[node]['sedresults'].append(sysadmintoolkit.utils.get_status_output("""sed -i 's/\\$master_backup\s*%s\s*\S*\s*$/priority 150/' %s""" \
-                                                                   % (node, node_configfile), self.logger))
-                config_file_map[node]['sedresults'].append(sysadmintoolkit.utils.get_status_output("""sed -i 's/\\$master_backup\s*\S*\s*%s\s*$/priority 100/' %s""" \
-                                                                   % (node, node_configfile), self.logger))
-                config_file_map[node]['sedresults'].append(sysadmintoolkit.utils.get_status_output("""sed -i 's/\\$master_backup.*$/priority 50/' %s""" \
-                                                                   % (node_configfile), self.logger))
-                config_file_map[node]['sedresults'].append(sysadmintoolkit.utils.get_status_output("""sed -i '/^\s*\\$/d' %s""" \
-                                                                   % (node_configfile), self.logger))
-
-        return config_file_map
+        Returns a dict of node -> list of (section header fields, section lines),
+        output before the first section being under an empty header
+        '''
+        node_sections = {}
 
-    # Dynamic keywords
+        for (buffer, buffer_nodes) in self.clustering_plugin.run_cluster_command(command, nodes):
+            sections = [([], [])]
 
-    # Sysadmin-toolkit commands
+            for line in buffer:
+                if line.startswith('== '):
+                    sections.append((line.split()[1:], []))
+                else:
+                    sections[-1][1].append(line)
 
-    def display_master_config_file(self, user_input_obj):
+            for node in buffer_nodes:
+                node_sections[node] = sections
+
+        return node_sections
+
+    def get_lvs_services(self, nodes):
         '''
-        Display the content of the master configuration file
+        Reads the virtual services and the connection table of nodes in one
+        cluster command. The connection table is reduced on each node to a
+        count per real server and state (see ip_vs_conn_count_awk), it can
+        hold hundreds of thousands of entries.
+
+        Returns a dict of node -> (list of LvsService, dict of (service, real
+        server, state) -> entries, error message or None)
         '''
-        if self.clustering_plugin:
-            print 'Verifying that master config file is synchronized across the cluster...'
-            print
-            buffer_nodes_list = self.clustering_plugin.run_cluster_command('md5sum %s | sort' % self.master_config_file, \
-                                               self.clustering_plugin.get_reachable_nodes(self.cluster_nodeset_name))
+        command = 'd=%s ; echo "== ip_vs" ; cat $d/ip_vs ; echo "== ip_vs_conn" ; %s $d/ip_vs_conn' % \
+                  (pipes.quote(self.lvs_proc_dir), ip_vs_conn_count_awk)
 
-            self.clustering_plugin.display_symmetric_buffers(buffer_nodes_list)
+        node_services = {}
 
-            print '  ' + ('*' * 80)
+        for (node, sections) in self.run_sectioned_command(command, nodes).items():
+            sections = dict([(tuple(header[:1]), lines) for (header, lines) in sections])
 
-        if not os.access(os.path.dirname(self.master_config_file), os.R_OK):
-            self.logger.warning('Cannot open master config file %s for reading ' % self.master_config_file)
-            raise sysadmintoolkit.exception.PluginError('Cannot open master config file %s for reading' % self.master_config_file, errmsg=400)
+            services = list(iter_ip_vs(sections.get(('ip_vs',), [])))
+            conn_counts = dict(iter_ip_vs_conn_counts(sections.get(('ip_vs_conn',), [])))
 
-        fd = open(self.master_config_file, 'r')
-        print
-        print fd.read()
-        fd.close()
+            ip_vs_lines = [line for line in sections.get(('ip_vs',), []) if line.strip()]
 
-        return 0
+            error = None
+            if not ip_vs_lines or not ip_vs_lines[0].startswith('IP Virtual Server'):
+                error = '\n'.join([line for lines in sections.values() for line in lines if line.strip()]) or 'No output'
 
-    def edit_master_config_file(self, user_input_obj):
-        '''
-        Edit a copy of the master configuration file
+            node_services[node] = (services, conn_counts, error)
+
+        return node_services
+
+    def get_lvs_rates(self, nodes):
         '''
-        temp_master_file = tempfile.NamedTemporaryFile()
-        shutil.copyfile(self.pending_config['master_config'].name, temp_master_file.name)
+        Takes two samples lvs-rate-interval apart of the total counters and of
+        the per service and real server counters of nodes, in one cluster
+        command
 
-        self.logger.debug('Editing file %s' % temp_master_file.name)
+        Returns a dict of node -> (total rates or None, dict of (service, real
+        server or None) -> rates, error message or None), rates being tuples in
+        ip_vs_counters order
+        '''
+        command = 'd=%s ; for i in 1 2 ; do echo "== sample `date +%%s.%%N`" ; cat $d/ip_vs_stats ; ' \
+                  'echo "== stats" ; %s ; [ $i = 2 ] || sleep %s ; done' % \
+                  (pipes.quote(self.lvs_proc_dir), self.lvs_stats_cmd, self.lvs_rate_interval)
 
-        sysadmintoolkit.utils.execute_interactive_cmd('vi %s' % temp_master_file.name, self.logger)
+        node_rates = {}
 
-        if filecmp.cmp(self.pending_config['master_config'].name, temp_master_file.name, shallow=False):
-            print
-            print 'No changes done, ignoring previous command'
-            print
+        for (node, sections) in self.run_sectioned_command(command, nodes).items():
+            samples = []
 
-            return 0
-        else:
-            print
-            print 'The following changes were made:'
-            print
+            for (header, lines) in sections:
+                if header[:1] == ['sample']:
+                    try:
+                        samples.append([float(header[1]), parse_ip_vs_stats(lines), None])
+                    except (IndexError, ValueError):
+                        samples.append([None, None, None])
+                elif header[:1] == ['stats'] and samples:
+                    samples[-1][2] = collections.OrderedDict(iter_ipvsadm_stats(lines))
 
-            sysadmintoolkit.utils.execute_interactive_cmd('diff --label "Master Configuration File (Working Copy)" --label "Last Edit" -U 7 %s %s' \
-                                                          % (self.pending_config['master_config'].name, \
-                                                             temp_master_file.name), self.logger)
+            if len(samples) != 2 or None in [samples[0][0], samples[1][0]] or samples[1][0] <= samples[0][0]:
+                node_rates[node] = (None, {}, '\n'.join([line for (header, lines) in sections for line in lines if line.strip()]) or 'No output')
+                continue
 
-            self.pending_config['master_config'].close()
-            self.pending_config['master_config'] = temp_master_file
+            seconds = samples[1][0] - samples[0][0]
 
-            return 0
+            total_rates = None
+            if samples[0][1] is not None and samples[1][1] is not None:
+                total_rates = counter_rates(samples[0][1], samples[1][1], seconds)
 
-    def display_pending_config(self, user_input_obj):
-        '''
-        Display uncommitted configuration
-        '''
-        if filecmp.cmp(self.master_config_file, self.pending_config['master_config'].name, shallow=False):
-            print
-            print '  No pending configuration'
-            print
-        else:
-            print
+            rates = collections.OrderedDict()
+            for (key, counters) in (samples[1][2] or {}).items():
+                if key in (samples[0][2] or {}):
+                    rates[key] = counter_rates(samples[0][2][key], counters, seconds)
 
-            sysadmintoolkit.utils.execute_interactive_cmd('diff --label "Master Configuration File" --label "Pending Configuration File" -U 7 %s %s' \
-                                                      % (self.master_config_file, \
-                                                         self.pending_config['master_config'].name), self.logger)
+            node_rates[node] = (total_rates, rates, None)
 
-            print
+        return node_rates
 
-    def commit_pending_config(self, user_input_obj):
+    def display_lvs_services(self, user_input_obj):
         '''
-        Generate configuration from new master configuration file, validate, push to
-        nodes of the cluster and reload the keepalived daemon
+        Display the virtual services, their real servers and connection table
+        entries on every node of the cluster
         '''
-        self.logger.info('Commit requested')
+        nodes = self.get_nodesets_nodes(self.cluster_nodesets)
+        reachable_nodes = self.get_nodesets_nodes(self.cluster_nodesets, reachable=True)
 
-        if filecmp.cmp(self.master_config_file, self.pending_config['master_config'].name, shallow=False):
-            self.logger.warning('Master configuration file unchanged, no commit to do!')
-            return 0
+        node_services = self.get_lvs_services(reachable_nodes)
 
-        self.logger.debug('Generating node configuration file')
+        self.display_nodes_header('Virtual services of %s nodes' % len(reachable_nodes), nodes, reachable_nodes, \
+                                      dict([(node, node_services[node][2]) for node in node_services]))
 
-        self.pending_config['node_config'] = self.generate_config_from_master(self.pending_config['master_config'].name)
+        # Service -> real server -> node -> LvsRealServer, in order of appearance
+        services = collections.OrderedDict()
+        schedulers = {}
 
-        self.logger.debug('Pending config: %s' % self.pending_config)
+        for node in sorted(node_services):
+            for service in node_services[node][0]:
+                schedulers.setdefault(service.name, service.scheduler)
+                real_servers = services.setdefault(service.name, collections.OrderedDict())
 
-        sed_problem = False
+                for real_server in service.real_servers:
+                    real_servers.setdefault(real_server.address, {})[node] = real_server
 
-        for node in self.pending_config['node_config']:
-            for sed_result in self.pending_config['node_config'][node]['sedresults']:
-                if sed_result[0] is not 0:
-                    sed_problem = sed_result
-                    break
+        if not services:
+            print '  No virtual service'
+            print
+            return 0
 
-        if sed_problem:
-            raise sysadmintoolkit.exception.PluginError(errmsg='Error generating node configuration file, sed result: \n%s' % sed_result[1], \
-                                                        errno=300, plugin=self)
-        else:
-            self.logger.info('Node configuration files generated successfully')
+        print '  %-32s %-16s %-6s %6s %7s %7s  %s' % ('Service / Real server', 'Node', 'Fwd', 'Weight', 'Active', 'InAct', 'Conn table')
+        print '  %-32s %-16s %-6s %6s %7s %7s  %s' % ('-' * 32, '-' * 16, '-' * 6, '-' * 6, '-' * 7, '-' * 7, '-' * 16)
 
-        all_parse_ok = True
-        for node in self.pending_config['node_config']:
-            (parse_ok, msg) = self.parse_config_file(self.pending_config['node_config'][node]['node_configfile'].name)
+        warnings = []
 
-            if parse_ok:
-                self.logger.info('%s configuration file is OK' % node)
-            else:
-                self.logger.error('%s configuration file parsing FAILED:\n  %s' % (node, msg))
-                print 'Error parsing configuration for node %s:\n%s' % (node, msg)
-                print
-                print '>> Aborting commit!'
-                print
+        for service in services:
+            print '  %s %s' % (service, schedulers[service])
 
-                all_parse_ok = False
+            service_nodes = set([node for node in node_services if service in [item.name for item in node_services[node][0]]])
+            missing_nodes = [node for node in sorted(node_services) if node_services[node][2] is None and node not in service_nodes]
+            if missing_nodes:
+                warnings.append('%s missing on %s' % (service, ', '.join(missing_nodes)))
 
-                break
+            for (address, real_server_nodes) in services[service].items():
+                first = True
 
-        if all_parse_ok:
-            self.logger.info('All files have been parsed successfully')
+                for node in sorted(real_server_nodes):
+                    real_server = real_server_nodes[node]
+                    conn_counts = node_services[node][1]
 
-            self.logger.debug('Backing up previous master configuration file')
-            self.logger.debug('Populating config dir with new files')
+                    states = dict([(key[2], count) for (key, count) in conn_counts.items() if key[:2] == (service, address)])
 
-            time_suffix = time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime())
-            shutil.copy(self.master_config_file, '%s/archive/%s_%s' % (self.config_dir, os.path.basename(self.master_config_file), time_suffix))
-            shutil.copy(self.pending_config['master_config'].name, self.master_config_file)
+                    print '  %-32s %-16s %-6s %6s %7s %7s  %s' % ('  -> %s' % address if first else '', node, real_server.forward, \
+                                                                 real_server.weight, real_server.active, real_server.inactive, \
+                                                                 '%s (%s established)' % (sum(states.values()), states.get('ESTABLISHED', 0)) \
+                                                                 if states else '-')
+                    first = False
 
-            for node in self.pending_config['node_config']:
-                shutil.copy(self.pending_config['node_config'][node]['node_configfile'].name, \
-                            '%s/%s_%s' % (self.config_dir, os.path.basename(self.master_config_file), node))
+        print
 
-            self.logger.info('Pushing files to other nodes')
+        for warning in warnings:
+            print '  WARNING: %s' % warning
 
-            buffer_nodes_list = self.clustering_plugin.run_cluster_command('rsync -avrp --delete %s:%s %s; echo "Return Code=$?"' % \
-                                                          (socket.gethostname(), self.config_dir, self.config_dir), \
-                                                          self.clustering_plugin.get_reachable_nodes(self.cluster_nodeset_name))
+        if warnings:
+            print
 
-            all_rsync_ok = True
-            for (buffer, nodes) in buffer_nodes_list:
-                buffer_str = [c for c in buffer]
-                if 'Return Code=0' not in buffer_str[-1]:
-                    all_rsync_ok = False
-                    self.logger.error('Problem with rsync with node %s:\n%s' % (nodes, '\n'.join(buffer_str)))
+        return 0
 
-            if all_rsync_ok:
-                self.logger.info('All files successfully pushed to all reachable nodes (%s)' % \
-                                 self.clustering_plugin.get_reachable_nodes(self.cluster_nodeset_name))
+    def display_lvs_rates(self, user_input_obj):
+        '''
+        Display connection, packet and byte rates of the nodes, of the virtual
+        services and of their real servers, from two samples lvs-rate-interval
+        apart
+        '''
+        nodes = self.get_nodesets_nodes(self.cluster_nodesets)
+        reachable_nodes = self.get_nodesets_nodes(self.cluster_nodesets, reachable=True)
 
-                buffer_nodes_list = self.clustering_plugin.run_cluster_command('cp %s_`uname -n` %s' % \
-                                                                               (self.master_config_file, self.live_config_file), \
-                                                                               self.clustering_plugin.get_reachable_nodes(self.cluster_nodeset_name))
+        node_rates = self.get_lvs_rates(reachable_nodes)
 
-                self.logger.info('Reloading keepalived on all nodes')
+        self.display_nodes_header('Rates over %ss on %s nodes' % (self.lvs_rate_interval, len(reachable_nodes)), nodes, reachable_nodes, \
+                                      dict([(node, node_rates[node][2]) for node in node_rates]))
 
-                buffer_nodes_list = self.clustering_plugin.run_cluster_command('%s ; echo "Return Code=$?"' % self.reload_cmd, \
-                                                          self.clustering_plugin.get_reachable_nodes(self.cluster_nodeset_name))
+        row_format = '  %-32s %-16s %9s %9s %9s %11s %11s'
 
-                all_reload_ok = True
-                for (buffer, nodes) in buffer_nodes_list:
-                    buffer_str = [c for c in buffer]
-                    if 'Return Code=0' not in buffer_str[-1]:
-                        all_reload_ok = False
-                        self.logger.error('Problem with keepalived reload with node %s:\n%s' % (nodes, '\n'.join(buffer_str)))
+        print row_format % ('', 'Node', 'Conn/s', 'InPkt/s', 'OutPkt/s', 'InBytes/s', 'OutBytes/s')
+        print row_format % ('', '-' * 16, '-' * 9, '-' * 9, '-' * 9, '-' * 11, '-' * 11)
 
+        total_nodes = [node for node in sorted(node_rates) if node_rates[node][0] is not None]
+        for node in total_nodes:
+            print row_format % (('Total' if node == total_nodes[0] else '', node) + tuple(['%.1f' % rate for rate in node_rates[node][0]]))
 
-        self.pending_config['node_config'] = {}
+        if len(total_nodes) > 1:
+            print row_format % (('', '(cluster)') + tuple(['%.1f' % sum(rates) for rates in zip(*[node_rates[node][0] for node in total_nodes])]))
 
-        if not all_parse_ok:
-            return 1
-        elif not all_rsync_ok:
-            return 2
-        elif not all_reload_ok:
-            return 3
-        else:
-            self.logger.debug('Commit completed successfully')
-            print
-            print 'Commit completed successfully'
+        print
+
+        # (service, real server or None) -> node -> rates, in order of appearance
+        keys = collections.OrderedDict()
+        for node in sorted(node_rates):
+            for (key, rates) in node_rates[node][1].items():
+                keys.setdefault(key, {})[node] = rates
+
+        if not keys:
+            print '  No per service counters (see lvs-stats-cmd)'
             print
             return 0
 
+        print '  Service / Real server'
+
+        for ((service, real_server), rates_nodes) in keys.items():
+            first = True
+
+            for node in sorted(rates_nodes):
+                print row_format % (('%s' % (service if real_server is None else '  -> %s' % real_server) if first else '', node) + \
+                                    tuple(['%.1f' % rate for rate in rates_nodes[node]]))
+                first = False
+
+            if len(rates_nodes) > 1:
+                print row_format % (('', '(cluster)') + tuple(['%.1f' % sum(rates) for rates in zip(*rates_nodes.values())]))
+
+        print
+
+        return 0
+
     def debug(self, user_input_obj):
         '''
         Display keepalived configuration and state
@@ -481,7 +5543,10 @@ class Keepalived(sysadmintoolkit.plugin.Plugin):
         print 'Keepalived plugin configuration and state:'
         print
         print '  keepalived plugin version: %s' % __version__
-        print '  keepalived version: %s' % sysadmintoolkit.utils.get_status_output('keepalived -v', self.logger)[1].strip()
+        try:
+            print '  keepalived version: %s (%s)' % (self.get_keepalived_version(), self.find_keepalived())
+        except sysadmintoolkit.exception.PluginError:
+            print '  keepalived version: keepalived not found in PATH'
         print
         print '  VRRP Support: %s' % self.vrrp_support
         print '  LVS Support: %s' % self.lvs_support
@@ -489,23 +5554,49 @@ class Keepalived(sysadmintoolkit.plugin.Plugin):
         print '  Clustering support: %s' % ('clustering' in self.plugin_set.get_plugins())
 
         if 'clustering' in self.plugin_set.get_plugins():
-            print '    Nodeset: %s' % self.cluster_nodeset_name
-            print '      Nodes: %s' % self.plugin_set.get_plugins()['clustering'].get_nodeset(self.cluster_nodeset_name)
+            for nodeset in self.cluster_nodesets:
+                print '    Nodeset: %s' % nodeset
+                print '      Nodes: %s' % self.plugin_set.get_plugins()['clustering'].get_nodeset(nodeset)
 
         print
         print '  Live keepalived configuration file: %s (writable = %s)' % (self.live_config_file, self.live_config_file_writable)
         print '  Keepalived configuration directory: %s (writable = %s)' % (self.config_dir, self.config_dir_writable)
         print '  Keepalived master configuration file: %s' % (self.master_config_file)
-        print '  Keepalived reload command: "%s"' % self.reload_cmd
+        if self.reload_method == 'signal':
+            print '  Keepalived reload: SIGHUP to pid in %s' % self.pid_file
+        else:
+            print '  Keepalived reload command: "%s"' % self.reload_cmd
+        if self.reload_mode == 'rolling':
+            print '  Reload mode: rolling, %s nodes per batch, probe %s (timeout %ss)' % \
+                    (self.reload_batch_size, self.reload_probe, self.reload_probe_timeout)
+        else:
+            print '  Reload mode: parallel'
+        print '  Commit concurrency: %s' % ('%s nodes per cluster command' % self.commit_concurrency if self.commit_concurrency else 'all nodes in one cluster command')
         print
-        print '  Path to keepalived external file parser: %s' % \
-                                os.path.normpath('%s/keepalived-check.rb' % \
-                                self.plugin_set.get_plugins()['commandprompt'].config['scripts-dir'])
+        print '  Keepalived configuration parser: built-in (keepalived-check rules)'
         print
+        print '  Cache: %s entries, %s/%s bytes, %s evictions' % (len(self.cache.entries), self.cache.size, \
+                                                                 self.cache.max_size, self.cache.evictions)
+        for kind in sorted(set(self.cache.hits.keys() + self.cache.misses.keys())):
+            print '    %s: %s hits, %s misses' % (kind, self.cache.hits[kind], self.cache.misses[kind])
+        print
+        print '  Commit statistics: %s kept (of at most %s), stats file: %s' % (len(self.commit_history), \
+                                                                          self.commit_history.maxlen, self.stats_file)
+        if self.commit_history:
+            print '  Last commit:'
+            print
+            self.display_one_commit_stats(self.commit_history[-1])
+        else:
+            print
 
         if self.pending_config:
             print '  Configuration pending commit:'
             print
-            print '    Master configuration file copy: %s' % self.pending_config['master_config'].name
+            print '    Working copy: %s bytes, digest %s, %s' % (len(self.pending_config.working_config), \
+                    self.pending_config.working_digest[:12], 'changed' if self.pending_config.is_changed() else 'unchanged')
 
         print
+
+
+if __name__ == '__main__':
+    sys.exit(main())
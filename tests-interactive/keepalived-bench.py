@@ -0,0 +1,596 @@
+#! /usr/bin/env python
+'''
+Benchmark of the keepalived plugin commit path
+
+Generates synthetic master configurations with 1 to 10,000 vrrp_instance and
+virtual_server blocks, with $master_backup spread over the nodes, and drives
+the plugin against a stand-in of the clustering plugin simulating every node
+in a temporary directory. Each size runs in its own process, so peak RSS is
+the one of that size only.
+
+Results are printed as JSON, one object per size:
+
+::
+
+  python keepalived-bench.py --sizes 1,100,1000,10000 --nodes 8 > bench.json
+
+--nodesets splits the nodes in that many nodesets, each with its own $nodeset
+section of the master holding its share of the blocks, all committed
+together:
+
+::
+
+  python keepalived-bench.py --sizes 1000 --nodes 40 --nodesets 20
+
+--startup times what the CLI pays at start for the plugin: loading the
+module and constructing the plugin, each run in a fresh process, with the
+subprocesses and filesystem calls made during construction:
+
+::
+
+  python keepalived-bench.py --startup 20
+
+--commit-lock takes the commit lock of simulated nodes left in various states
+(free, held by a live or dead commit, truncated by a commit that died while
+writing it) and reports whether it was taken or waited for as expected:
+
+::
+
+  python keepalived-bench.py --commit-lock
+
+The sysadmintoolkit package and the keepalived binary must be installed.
+'''
+import sys
+import os
+import os.path
+import imp
+import json
+import logging
+import optparse
+import pipes
+import resource
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import collections
+import __builtin__
+
+plugin_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'keepalived-plugin', 'keepalived.py')
+
+counters = collections.defaultdict(int)
+
+
+def count_subprocesses():
+    '''
+    Counts every subprocess spawned by the plugin, the toolkit and the
+    simulated nodes in counters['subprocesses']
+    '''
+    popen_init = subprocess.Popen.__init__
+
+    def counting_popen_init(self, *args, **kwargs):
+        counters['subprocesses'] += 1
+        popen_init(self, *args, **kwargs)
+
+    subprocess.Popen.__init__ = counting_popen_init
+
+    def counting(function):
+        def counting_call(*args, **kwargs):
+            counters['subprocesses'] += 1
+            return function(*args, **kwargs)
+
+        return counting_call
+
+    os.popen = counting(os.popen)
+    os.system = counting(os.system)
+
+
+def count_filesystem_calls():
+    '''
+    Counts the filesystem calls made through os, os.path and open in
+    counters['filesystem_calls']
+    '''
+    def counting(function):
+        def counting_call(*args, **kwargs):
+            counters['filesystem_calls'] += 1
+            return function(*args, **kwargs)
+
+        return counting_call
+
+    for name in ['stat', 'lstat', 'access', 'listdir', 'makedirs', 'mkdir']:
+        setattr(os, name, counting(getattr(os, name)))
+
+    for name in ['exists', 'isdir', 'isfile', 'getmtime', 'getsize']:
+        setattr(os.path, name, counting(getattr(os.path, name)))
+
+    __builtin__.open = counting(__builtin__.open)
+
+
+def generate_master(size, nodes, nodesets=None):
+    '''
+    Returns a master configuration with size vrrp_instance and size
+    virtual_server blocks
+
+    With nodesets, an ordered dict of nodeset -> nodes, the blocks are spread
+    over one $nodeset section per nodeset, $master_backup naming nodes of
+    the section's nodeset.
+    '''
+    if nodesets is None:
+        return '\n'.join(['global_defs {\n  router_id $slb_hostname\n}\n'] + generate_blocks(range(size), nodes))
+
+    blocks = ['global_defs {\n  router_id $slb_hostname\n}\n']
+
+    for (index, nodeset) in enumerate(nodesets):
+        blocks.append('$nodeset %s\n' % nodeset)
+        blocks.extend(generate_blocks(range(index, size, len(nodesets)), nodesets[nodeset]))
+
+    return '\n'.join(blocks)
+
+
+def generate_blocks(indexes, nodes):
+    '''
+    Returns the vrrp_instance blocks then the virtual_server blocks of
+    indexes, $master_backup naming nodes
+    '''
+    blocks = []
+
+    for i in indexes:
+        blocks.append('vrrp_instance VI_%s {\n'
+                      '  state BACKUP\n'
+                      '  interface eth0\n'
+                      '  virtual_router_id %s\n'
+                      '  $master_backup %s %s\n'
+                      '  advert_int 1\n'
+                      '  virtual_ipaddress {\n'
+                      '    10.%s.%s.%s/32 dev eth0\n'
+                      '  }\n'
+                      '}\n' % (i, i % 255 + 1, nodes[i % len(nodes)], nodes[(i + 1) % len(nodes)], \
+                               i / 65536 % 256, i / 256 % 256, i % 256))
+
+    for i in indexes:
+        blocks.append('virtual_server 10.%s.%s.%s 80 {\n'
+                      '  delay_loop 6\n'
+                      '  lb_algo rr\n'
+                      '  lb_kind DR\n'
+                      '  protocol TCP\n'
+                      '  real_server 172.16.%s.%s 80 {\n'
+                      '    weight 1\n'
+                      '    TCP_CHECK {\n'
+                      '      connect_timeout 3\n'
+                      '    }\n'
+                      '  }\n'
+                      '}\n' % (i / 65536 % 256, i / 256 % 256, i % 256, i / 256 % 256, i % 256))
+
+    return blocks
+
+
+class ClusterStub(object):
+    '''
+    Stand-in of the clustering plugin, each node is a directory holding its
+    own copy of config-dir and of the live configuration file
+
+    Commands are run with bash in the node directory, rsync being a shell
+    function copying the listed files from the local config-dir.
+    '''
+    rsync_function = 'rsync() { local f ; while read f ; do mkdir -p "$4/`dirname "$f"`" && cp -p %s/"$f" "$4/$f" || return 1 ; ' \
+                     'echo "$f" >> %s ; done ; } ; '
+
+    def __init__(self, nodes, root, config_dir, live_config_file, nodesets=None):
+        self.nodes = nodes
+        self.nodesets = nodesets
+        self.root = root
+        self.config_dir = config_dir
+        self.live_config_file = live_config_file
+
+        for node in nodes:
+            os.makedirs('%s/%s/archive' % (self.node_dir(node), os.path.basename(config_dir)))
+
+    def node_dir(self, node):
+        return '%s/nodes/%s' % (self.root, node)
+
+    def get_nodeset(self, nodeset):
+        if self.nodesets is None:
+            return list(self.nodes)
+
+        return list(self.nodesets.get(nodeset, []))
+
+    def get_reachable_nodes(self, nodeset):
+        return self.get_nodeset(nodeset)
+
+    def display_symmetric_buffers(self, buffer_nodes_list):
+        pass
+
+    def run_cluster_command(self, command, nodes):
+        counters['cluster_commands'] += 1
+
+        buffer_nodes_list = []
+
+        for node in nodes:
+            node_config_dir = '%s/%s' % (self.node_dir(node), os.path.basename(self.config_dir))
+            pushed_log = '%s/pushed' % self.node_dir(node)
+
+            node_command = command.replace(self.config_dir, node_config_dir) \
+                                  .replace(self.live_config_file, '%s/%s' % (self.node_dir(node), os.path.basename(self.live_config_file))) \
+                                  .replace('`uname -n`', node)
+
+            node_command = self.rsync_function % (pipes.quote(self.config_dir), pipes.quote(pushed_log)) + node_command
+
+            output = subprocess.Popen(['bash', '-c', node_command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+
+            if os.path.exists(pushed_log):
+                counters['pushed_files'] += len(open(pushed_log).readlines())
+                os.remove(pushed_log)
+
+            buffer_nodes_list.append((output.rstrip('\n').split('\n'), [node]))
+
+        return buffer_nodes_list
+
+
+class PluginSetStub(object):
+    def __init__(self, plugins):
+        self.plugins = plugins
+
+    def get_plugins(self):
+        return self.plugins
+
+
+class CmdPromptStub(object):
+    def __init__(self, mode):
+        self.mode = mode
+
+    def get_mode(self):
+        return self.mode
+
+
+def timed(phases, phase, function, *args):
+    start = time.time()
+    result = function(*args)
+    phases[phase] = round(time.time() - start, 6)
+
+    return result
+
+
+def run_size(size, node_count, concurrency, nodeset_count=1):
+    '''
+    Runs every phase for one master size, returns the results as a dict
+    '''
+    count_subprocesses()
+
+    keepalived = imp.load_source('keepalived', plugin_file)
+
+    nodes = ['node%s' % i for i in range(node_count)]
+    if socket.gethostname() not in nodes:
+        # The clustering plugin includes the local node in the nodeset
+        nodes[0] = socket.gethostname()
+
+    nodesets = None
+    if nodeset_count > 1:
+        nodesets = collections.OrderedDict([('nodeset%s' % i, nodes[i::nodeset_count]) for i in range(nodeset_count)])
+
+    root = tempfile.mkdtemp(prefix='keepalived-bench-')
+    try:
+        config = {'config-dir': '%s/master' % root, 'live-config-file': '%s/keepalived.conf' % root,
+                  'reload-cmd': 'true', 'commit-concurrency': str(concurrency)}
+
+        if nodesets is not None:
+            config['nodesets'] = ','.join(nodesets)
+
+        logger = logging.getLogger('keepalived-bench')
+        logger.addHandler(logging.NullHandler())
+
+        plugin = keepalived.Keepalived(logger, config)
+        cluster = ClusterStub(nodes, root, plugin.config_dir, plugin.live_config_file, nodesets)
+        plugin.update_plugin_set(PluginSetStub({'clustering': cluster, 'keepalived': plugin}))
+
+        plugin.prepare_config_dir()
+
+        fd = open(plugin.master_config_file, 'w')
+        fd.close()
+
+        master_config = generate_master(size, nodes, nodesets)
+
+        phases = collections.OrderedDict()
+
+        node_nodesets = None
+        if nodesets is not None:
+            node_nodesets = plugin.get_node_nodesets(nodesets)
+
+        template = timed(phases, 'compile', keepalived.ConfigTemplate, master_config, keepalived.ContentCache(plugin.cache.max_size), \
+                         node_nodesets)
+        node_configs = timed(phases, 'generate', plugin.generate_config_from_master, template)
+        node_diagnostics = timed(phases, 'validate', template.validate, node_configs)
+
+        if [node for node in node_diagnostics if node_diagnostics[node]]:
+            raise Exception('Synthetic configuration is not valid: %s' % node_diagnostics)
+
+        def commit(phase, master_config):
+            plugin.enter_mode(CmdPromptStub('config'))
+            plugin.pending_config.update(master_config)
+
+            before = dict(counters)
+            result = timed(phases, phase, plugin.commit_pending_config, None)
+
+            if result != 0:
+                raise Exception('%s returned %s' % (phase, result))
+
+            counts[phase] = dict([(counter, counters[counter] - before.get(counter, 0)) for counter in counters])
+
+            if getattr(plugin, 'commit_history', None):
+                # Phases timed by the plugin itself
+                commit_phases[phase] = collections.OrderedDict([(commit_phase, round(seconds, 6)) for (commit_phase, seconds) \
+                                                                in plugin.commit_history[-1].phases.items()])
+
+            plugin.leave_mode(CmdPromptStub('config'))
+
+        counts = collections.OrderedDict()
+        commit_phases = collections.OrderedDict()
+
+        # Output of the plugin is not part of the results
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            commit('commit', master_config)
+            commit('commit_one_block_changed', master_config.replace('virtual_router_id 1\n', 'virtual_router_id 2\n', 1))
+
+            before = dict(counters)
+            timed(phases, 'show_config', plugin.display_master_config_file, None)
+            counts['show_config'] = dict([(counter, counters[counter] - before.get(counter, 0)) for counter in counters])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        return collections.OrderedDict([('vrrp_instances', size),
+                                        ('virtual_servers', size),
+                                        ('nodes', node_count),
+                                        ('nodesets', nodeset_count),
+                                        ('commit_concurrency', concurrency),
+                                        ('master_bytes', len(master_config)),
+                                        ('phases', phases),
+                                        ('commit_phases', commit_phases),
+                                        ('counters', counts),
+                                        ('peak_rss_kb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+                                        ('peak_children_rss_kb', resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)])
+    finally:
+        shutil.rmtree(root)
+
+
+def run_startup():
+    '''
+    Loads the plugin module and constructs the plugin once, returns the
+    results as a dict
+    '''
+    root = tempfile.mkdtemp(prefix='keepalived-bench-')
+    try:
+        config = {'config-dir': '%s/master' % root, 'live-config-file': '%s/keepalived.conf' % root,
+                  'modes': 'vrrp, lvs'}
+
+        logger = logging.getLogger('keepalived-bench')
+        logger.addHandler(logging.NullHandler())
+
+        start = time.time()
+        keepalived = imp.load_source('keepalived', plugin_file)
+        load_seconds = time.time() - start
+
+        count_subprocesses()
+        count_filesystem_calls()
+
+        start = time.time()
+        keepalived.Keepalived(logger, config)
+        init_seconds = time.time() - start
+
+        return collections.OrderedDict([('load', round(load_seconds, 6)),
+                                        ('init', round(init_seconds, 6)),
+                                        ('subprocesses', counters['subprocesses']),
+                                        ('filesystem_calls', counters['filesystem_calls']),
+                                        ('config_dir_created', os.path.isdir(config['config-dir']))])
+    finally:
+        shutil.rmtree(root)
+
+
+def startup(runs):
+    '''
+    Runs run_startup in runs fresh processes, returns the results as a dict
+    '''
+    results = []
+    for run in range(runs):
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run-startup'], stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+
+        if process.returncode != 0:
+            return None
+
+        results.append(json.loads(output))
+
+    summary = collections.OrderedDict([('runs', runs)])
+    for phase in ['load', 'init']:
+        seconds = sorted([result[phase] for result in results])
+        summary[phase] = collections.OrderedDict([('min', seconds[0]), ('median', seconds[len(seconds) / 2]), ('max', seconds[-1])])
+
+    for key in ['subprocesses', 'filesystem_calls', 'config_dir_created']:
+        summary[key] = results[-1][key]
+
+    return summary
+
+
+def run_commit_lock():
+    '''
+    Takes the commit lock of simulated nodes in every scenario, returns the
+    results as a list of dicts
+    '''
+    keepalived = imp.load_source('keepalived', plugin_file)
+
+    nodes = [socket.gethostname(), 'node1', 'node2']
+
+    root = tempfile.mkdtemp(prefix='keepalived-bench-')
+    try:
+        config = {'config-dir': '%s/master' % root, 'live-config-file': '%s/keepalived.conf' % root,
+                  'commit-lock-timeout': '2'}
+
+        logger = logging.getLogger('keepalived-bench')
+        logger.addHandler(logging.NullHandler())
+
+        def make_plugin():
+            plugin = keepalived.Keepalived(logger, config)
+            plugin.update_plugin_set(PluginSetStub({'clustering': cluster, 'keepalived': plugin}))
+
+            return plugin
+
+        cluster = ClusterStub(nodes, root, config['config-dir'], config['live-config-file'])
+        lock_file = '%s/%s/.commit-lock' % (cluster.node_dir('node1'), os.path.basename(config['config-dir']))
+
+        dead_pid = subprocess.Popen(['true'])
+        dead_pid.wait()
+
+        # Name -> (lock content left on node1 or None, its age in seconds, lock expected to be taken)
+        scenarios = collections.OrderedDict([
+            ('free', (None, 0, True)),
+            ('live_holder', ('%s %s %d %032x\n' % (socket.gethostname(), os.getpid(), time.time(), 1), 0, False)),
+            ('dead_holder', ('%s %s %d %032x\n' % (socket.gethostname(), dead_pid.pid, time.time(), 1), 0, True)),
+            ('too_old', ('otherhost 1 %d %032x\n' % (time.time() - 7200, 1), 7200, True)),
+            ('truncated_being_written', ('', 0, False)),
+            ('truncated', ('', 60, True)),
+            ('partial', ('%s %s' % (socket.gethostname(), os.getpid()), 60, True))])
+
+        results = []
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            for (name, (content, age, expected)) in scenarios.items():
+                if content is not None:
+                    fd = open(lock_file, 'w')
+                    fd.write(content)
+                    fd.close()
+
+                    os.utime(lock_file, (time.time() - age, time.time() - age))
+
+                plugin = make_plugin()
+
+                start = time.time()
+                taken = plugin.acquire_commit_lock(nodes)
+                seconds = time.time() - start
+
+                plugin.release_commit_lock()
+
+                # A lock not taken is left to its holder, a lock taken is released
+                lock_left = os.path.exists(lock_file)
+
+                results.append(collections.OrderedDict([('scenario', name), ('taken', taken), ('expected', expected),
+                                                        ('seconds', round(seconds, 3)), ('lock_left', lock_left),
+                                                        ('ok', taken == expected and lock_left == (not expected))]))
+
+                if os.path.exists(lock_file):
+                    os.remove(lock_file)
+
+            # Two commits breaking the same stale lock at the same time must
+            # not both hold the lock
+            fd = open(lock_file, 'w')
+            fd.close()
+            os.utime(lock_file, (time.time() - 60, time.time() - 60))
+
+            holding = []
+            overlaps = []
+
+            def commit():
+                plugin = make_plugin()
+
+                if plugin.acquire_commit_lock(nodes):
+                    holding.append(plugin)
+                    if len(holding) > 1:
+                        overlaps.append(len(holding))
+
+                    time.sleep(0.5)
+
+                    holding.remove(plugin)
+                    plugin.release_commit_lock()
+
+            threads = [threading.Thread(target=commit) for i in range(2)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            lock_left = os.path.exists(lock_file)
+
+            results.append(collections.OrderedDict([('scenario', 'concurrent_break'), ('overlaps', len(overlaps)),
+                                                    ('seconds', round(time.time() - start, 3)), ('lock_left', lock_left),
+                                                    ('ok', not overlaps and not lock_left)]))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        return results
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='1,10,100,1000,10000',
+                      help='comma separated numbers of vrrp_instance (and virtual_server) blocks [%default]')
+    parser.add_option('--nodes', type='int', default=3, help='number of simulated nodes [%default]')
+    parser.add_option('--nodesets', type='int', default=1, help='number of nodesets the nodes are spread over [%default]')
+    parser.add_option('--concurrency', type='int', default=0, help='commit-concurrency of the plugin, 0 for all nodes [%default]')
+    parser.add_option('--startup', type='int', metavar='RUNS', help='benchmark the plugin startup over RUNS processes instead')
+    parser.add_option('--commit-lock', action='store_true', help='check the commit lock in every scenario instead')
+    parser.add_option('--run-one', type='int', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--run-startup', action='store_true', help=optparse.SUPPRESS_HELP)
+
+    (options, args) = parser.parse_args()
+
+    if not 1 <= options.nodesets <= options.nodes:
+        parser.error('--nodesets must be between 1 and --nodes')
+
+    if options.run_one is not None:
+        print json.dumps(run_size(options.run_one, options.nodes, options.concurrency, options.nodesets))
+        return 0
+
+    if options.run_startup:
+        print json.dumps(run_startup())
+        return 0
+
+    if options.commit_lock:
+        results = run_commit_lock()
+
+        print json.dumps({'python': sys.version.split()[0], 'commit_lock': results}, indent=2)
+
+        if [result for result in results if not result['ok']]:
+            sys.stderr.write('Commit lock scenarios failed\n')
+            return 1
+
+        return 0
+
+    if options.startup:
+        summary = startup(options.startup)
+
+        if summary is None:
+            sys.stderr.write('Startup benchmark failed\n')
+            return 1
+
+        print json.dumps({'python': sys.version.split()[0], 'startup': summary}, indent=2)
+        return 0
+
+    results = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run-one', str(size),
+                                    '--nodes', str(options.nodes), '--nodesets', str(options.nodesets),
+                                    '--concurrency', str(options.concurrency)],
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+
+        if process.returncode != 0:
+            sys.stderr.write('Benchmark of size %s failed\n' % size)
+            return 1
+
+        results.append(json.loads(output, object_pairs_hook=collections.OrderedDict))
+
+    print json.dumps({'python': sys.version.split()[0], 'results': results}, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
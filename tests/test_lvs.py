@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+'''
+LVS mode parsers against the captured /proc/net files and ipvsadm output of
+doc/samples
+
+Run from the repository root:
+
+::
+
+  python -m unittest discover -s tests
+'''
+import imp
+import os.path
+import subprocess
+import unittest
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+samples_dir = os.path.join(root_dir, 'doc', 'samples')
+
+keepalived = imp.load_source('keepalived', os.path.join(root_dir, 'keepalived-plugin', 'keepalived.py'))
+
+
+def sample(*path):
+    return open(os.path.join(samples_dir, *path), 'r')
+
+
+class IpVsTest(unittest.TestCase):
+    def setUp(self):
+        with sample('proc-net', 'ip_vs') as fd:
+            self.services = list(keepalived.iter_ip_vs(fd))
+
+    def test_services(self):
+        self.assertEqual([(service.name, service.scheduler) for service in self.services],
+                         [('TCP 10.10.10.100:80', 'wlc'),
+                          ('TCP 10.10.10.100:443', 'wlc persistent 300'),
+                          ('UDP 10.10.10.101:53', 'rr'),
+                          ('FWM 1', 'rr'),
+                          ('TCP [2001:db8::64]:80', 'rr')])
+
+    def test_real_servers(self):
+        self.assertEqual(self.services[0].real_servers,
+                         [keepalived.LvsRealServer('172.16.0.2:80', 'Route', 1, 11, 40),
+                          keepalived.LvsRealServer('172.16.0.1:80', 'Route', 1, 12, 38)])
+        self.assertEqual(self.services[1].real_servers[1], keepalived.LvsRealServer('172.16.0.1:443', 'Route', 0, 0, 4))
+        self.assertEqual(self.services[2].real_servers[0], keepalived.LvsRealServer('172.16.0.17:53', 'Masq', 1, 0, 2))
+
+    def test_fwm(self):
+        self.assertEqual(self.services[3].real_servers, [keepalived.LvsRealServer('172.16.0.33:0', 'Route', 1, 1, 0)])
+
+    def test_ipv6(self):
+        self.assertEqual(self.services[4].real_servers, [keepalived.LvsRealServer('[2001:db8::1:1]:80', 'Route', 1, 1, 0)])
+
+
+class IpVsStatsTest(unittest.TestCase):
+    def test_totals(self):
+        with sample('proc-net', 'ip_vs_stats') as fd:
+            self.assertEqual(keepalived.parse_ip_vs_stats(fd), (0x1A2F3, 0x9C4E21, 0, 0x2E8B4F10, 0))
+
+    def test_no_totals(self):
+        self.assertEqual(keepalived.parse_ip_vs_stats(['   Total Incoming Outgoing', '']), None)
+
+
+class IpvsadmStatsTest(unittest.TestCase):
+    def setUp(self):
+        with sample('ipvsadm-stats') as fd:
+            self.stats = list(keepalived.iter_ipvsadm_stats(fd))
+
+    def test_counters(self):
+        stats = dict(self.stats)
+
+        self.assertEqual(len(self.stats), 13)
+        self.assertEqual(stats[('TCP 10.10.10.100:80', None)], (81020, 5120042, 0, 498203317, 0))
+        self.assertEqual(stats[('TCP 10.10.10.100:443', '172.16.0.1:443')], (8513, 999300, 0, 92898093, 0))
+        self.assertEqual(stats[('UDP 10.10.10.101:53', '172.16.0.18:53')], (941, 1056, 0, 76044, 0))
+        self.assertEqual(stats[('FWM 1', None)], (42, 611, 0, 48213, 0))
+        self.assertEqual(stats[('FWM 1', '172.16.0.33:0')], (42, 611, 0, 48213, 0))
+        self.assertEqual(stats[('TCP [2001:db8::64]:80', '[2001:db8::1:1]:80')], (12, 301, 0, 30104, 0))
+
+    def test_names_match_ip_vs(self):
+        with sample('proc-net', 'ip_vs') as fd:
+            names = set([(service.name, real_server.address) for service in keepalived.iter_ip_vs(fd)
+                         for real_server in service.real_servers])
+
+        self.assertEqual(names, set([key for (key, counters) in self.stats if key[1] is not None]))
+
+    def test_counter_rates(self):
+        stats = dict(self.stats)
+
+        first = stats[('TCP 10.10.10.100:80', None)]
+        second = tuple([counter + 10 for counter in first])
+
+        self.assertEqual(keepalived.counter_rates(first, second, 2.0), (5.0, 5.0, 5.0, 5.0, 5.0))
+
+
+class IpVsConnTest(unittest.TestCase):
+    def setUp(self):
+        # The connection table is reduced by the awk command run on the nodes
+        output = subprocess.Popen('%s %s' % (keepalived.ip_vs_conn_count_awk, os.path.join(samples_dir, 'proc-net', 'ip_vs_conn')),
+                                  shell=True, stdout=subprocess.PIPE).communicate()[0]
+
+        self.counts = dict(keepalived.iter_ip_vs_conn_counts(output.split('\n')))
+
+    def test_counts(self):
+        self.assertEqual(sum(self.counts.values()), 121)
+        self.assertEqual(len(self.counts), 22)
+        self.assertEqual(self.counts[('TCP 10.10.10.100:80', '172.16.0.1:80', 'ESTABLISHED')], 17)
+        self.assertEqual(self.counts[('TCP 10.10.10.100:443', '172.16.0.2:443', 'SYN_RECV')], 2)
+        self.assertEqual(self.counts[('UDP 10.10.10.101:53', '172.16.0.17:53', 'UDP')], 18)
+
+    def test_ipv6(self):
+        self.assertEqual(self.counts[('TCP [2001:db8::64]:80', '[2001:db8::1:1]:80', 'ESTABLISHED')], 1)
+
+    def test_malformed_lines(self):
+        self.assertEqual(list(keepalived.iter_ip_vs_conn_counts(['', 'x TCP 0A0A0A64 0050 AC100001 0050 CLOSE',
+                                                                 '1 TCP ZZZZZZZZ 0050 AC100001 0050 CLOSE'])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+'''
+Reload signal and reload probes against a stand-in keepalived process: it
+writes its pid file, counts the SIGHUP it gets and writes a vrrp data dump
+with the given state on SIGUSR1
+'''
+import imp
+import logging
+import os.path
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+keepalived = imp.load_source('keepalived', os.path.join(root_dir, 'keepalived-plugin', 'keepalived.py'))
+
+standin_script = '''
+import os, signal, sys, time
+
+(pid_file, vrrp_data_file, state) = sys.argv[1:4]
+
+hups = [0]
+
+def hup(signum, frame):
+    hups[0] += 1
+    open(pid_file + '.hups', 'w').write(str(hups[0]))
+
+def usr1(signum, frame):
+    open(vrrp_data_file, 'w').write(' VRRP Instance = vrrp_vips\\n   State = %s\\n VRRP Instance = vrrp_internal\\n   State = BACKUP\\n' % state)
+
+signal.signal(signal.SIGHUP, hup)
+signal.signal(signal.SIGUSR1, usr1)
+
+open(pid_file + '.tmp', 'w').write('%d\\n' % os.getpid())
+os.rename(pid_file + '.tmp', pid_file)
+
+while True:
+    time.sleep(0.05)
+'''
+
+
+def wait_for_file(path):
+    for retry in range(100):
+        if os.path.exists(path):
+            return True
+
+        time.sleep(0.05)
+
+    return False
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='keepalived-test-')
+        self.pid_file = '%s/keepalived.pid' % self.root
+        self.vrrp_data_file = '%s/keepalived.data' % self.root
+        self.process = None
+
+        self.node = socket.gethostname()
+
+    def tearDown(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+
+        shutil.rmtree(self.root)
+
+    def start(self, state, reload_probe='vrrp'):
+        '''
+        Starts the stand-in process and returns a plugin reloading it
+        '''
+        self.process = subprocess.Popen([sys.executable, '-c', standin_script, self.pid_file, self.vrrp_data_file, state])
+        self.assertTrue(wait_for_file(self.pid_file))
+
+        logger = logging.getLogger('keepalived-test')
+        logger.addHandler(logging.NullHandler())
+
+        return keepalived.Keepalived(logger, {'config-dir': '%s/master' % self.root,
+                                              'live-config-file': '%s/keepalived.conf' % self.root,
+                                              'reload-method': 'signal', 'pid-file': self.pid_file,
+                                              'vrrp-data-file': self.vrrp_data_file,
+                                              'reload-probe': reload_probe, 'reload-probe-timeout': '1'})
+
+    def hups(self):
+        if not wait_for_file('%s.hups' % self.pid_file):
+            return 0
+
+        return int(open('%s.hups' % self.pid_file).read())
+
+    def test_signal(self):
+        plugin = self.start('MASTER')
+
+        results = plugin.signal_keepalived_nodes([self.node], 'HUP')
+
+        self.assertEqual(results.keys(), [self.node])
+        self.assertTrue(results[self.node][0])
+        self.assertEqual(self.hups(), 1)
+
+    def test_signal_without_process(self):
+        plugin = self.start('MASTER')
+        os.remove(self.pid_file)
+
+        (signal_ok, output) = plugin.signal_keepalived_nodes([self.node], 'HUP')[self.node]
+
+        self.assertFalse(signal_ok)
+        self.assertTrue(output[0].startswith('Could not send SIGHUP to keepalived'))
+
+    def test_rolling_reload(self):
+        plugin = self.start('MASTER')
+
+        self.assertEqual(plugin.rolling_reload([self.node], {self.node: 'master'}),
+                         [(self.node, None, ['2 vrrp instances settled'])])
+        self.assertEqual(self.hups(), 1)
+
+    def test_rolling_reload_unsettled(self):
+        plugin = self.start('FAULT')
+
+        start = keepalived.monotonic_time()
+        [(node, failed_phase, output)] = plugin.rolling_reload([self.node], {self.node: 'master'})
+
+        self.assertEqual(failed_phase, 'probe')
+        self.assertEqual(output, ['Vrrp instances not settled: FAULT'])
+        self.assertTrue(keepalived.monotonic_time() - start >= 1)
+        self.assertEqual(self.hups(), 1)
+
+    def test_process_probe(self):
+        plugin = self.start('MASTER', 'process')
+
+        self.assertTrue(plugin.wait_for_probes([self.node])[self.node][0])
+
+        self.process.kill()
+        self.process.wait()
+        self.process = None
+
+        self.assertFalse(plugin.wait_for_probes([self.node])[self.node][0])
+
+    def test_probe_command(self):
+        # The probe run on the other nodes, checked as their output
+        plugin = self.start('MASTER')
+
+        for (state, probe_ok) in [('MASTER', True), ('FAULT', False)]:
+            self.process.kill()
+            self.process.wait()
+            os.remove(self.pid_file)
+
+            self.process = subprocess.Popen([sys.executable, '-c', standin_script, self.pid_file, self.vrrp_data_file, state])
+            self.assertTrue(wait_for_file(self.pid_file))
+
+            probe = subprocess.Popen(plugin.probe_command(), shell=True, stdout=subprocess.PIPE)
+            output = probe.communicate()[0].splitlines()
+
+            self.assertEqual(plugin.check_probe_output(probe.returncode == 0, output)[0], probe_ok)
+
+
+if __name__ == '__main__':
+    unittest.main()
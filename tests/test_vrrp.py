@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+'''
+Vrrp dump parsers against the keepalived.data and keepalived.stats samples of
+doc/samples
+'''
+import collections
+import imp
+import logging
+import os.path
+import shutil
+import tempfile
+import unittest
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+samples_dir = os.path.join(root_dir, 'doc', 'samples')
+
+keepalived = imp.load_source('keepalived', os.path.join(root_dir, 'keepalived-plugin', 'keepalived.py'))
+
+
+def sample_lines(name):
+    fd = open(os.path.join(samples_dir, name), 'r')
+    try:
+        return fd.read().splitlines()
+    finally:
+        fd.close()
+
+
+class VrrpDataTest(unittest.TestCase):
+    def setUp(self):
+        self.instances = list(keepalived.iter_vrrp_data(sample_lines('keepalived.data')))
+
+    def test_instances(self):
+        self.assertEqual([instance for (instance, fields) in self.instances], ['vrrp_vips', 'vrrp_internal'])
+
+    def test_fields(self):
+        instances = dict(self.instances)
+
+        self.assertEqual(instances['vrrp_vips']['State'], 'MASTER')
+        self.assertEqual(instances['vrrp_vips']['Priority'], '150')
+        self.assertEqual(instances['vrrp_vips']['Virtual Router ID'], '10')
+        self.assertEqual(instances['vrrp_vips']['Last transition'], '1370186571 (Sun Jun  2 15:22:51 2013)')
+
+        self.assertEqual(instances['vrrp_internal']['State'], 'BACKUP')
+        self.assertEqual(instances['vrrp_internal']['Priority'], '100')
+        self.assertEqual(instances['vrrp_internal']['Virtual Router ID'], '11')
+
+    def test_sync_groups_ignored(self):
+        # The sync group section ends the last instance
+        self.assertFalse('monitor' in dict(self.instances)['vrrp_internal'])
+
+
+class VrrpStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.stats = collections.OrderedDict(keepalived.iter_vrrp_stats(sample_lines('keepalived.stats')))
+
+    def test_instances(self):
+        self.assertEqual(self.stats.keys(), ['vrrp_vips', 'vrrp_internal'])
+
+    def test_counters(self):
+        self.assertEqual(self.stats['vrrp_vips']['Advertisements Sent'], 8512)
+        self.assertEqual(self.stats['vrrp_vips']['Advertisements Received'], 0)
+        self.assertEqual(self.stats['vrrp_vips']['Became master'], 1)
+
+        self.assertEqual(self.stats['vrrp_internal']['Advertisements Received'], 8510)
+        self.assertEqual(self.stats['vrrp_internal']['Packet Errors Advertisement Interval'], 2)
+        self.assertEqual(self.stats['vrrp_internal']['Priority Zero Sent'], 0)
+
+    def test_sections(self):
+        # Nested sections are closed by the next key at their indentation
+        self.assertEqual(self.stats['vrrp_vips'].keys()[:4],
+                         ['Advertisements Received', 'Advertisements Sent', 'Became master', 'Released master'])
+        self.assertEqual(len(self.stats['vrrp_vips']), 14)
+
+
+class ParseVrrpDumpsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='keepalived-test-')
+
+        logger = logging.getLogger('keepalived-test')
+        logger.addHandler(logging.NullHandler())
+
+        self.plugin = keepalived.Keepalived(logger, {'config-dir': '%s/master' % self.root,
+                                                     'live-config-file': '%s/keepalived.conf' % self.root})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_dumps(self):
+        buffer = ['== data 1370195000'] + sample_lines('keepalived.data') + ['== stats'] + sample_lines('keepalived.stats')
+
+        dump = self.plugin.parse_vrrp_dumps(buffer)
+
+        self.assertEqual(dump.error, None)
+        self.assertEqual(dump.dumped, 1370195000)
+        self.assertEqual(dump.instances.keys(), ['vrrp_vips', 'vrrp_internal'])
+        self.assertEqual(dump.instances['vrrp_internal']['State'], 'BACKUP')
+        self.assertEqual(dump.stats['vrrp_vips']['Advertisements Sent'], 8512)
+
+    def test_missing_markers(self):
+        dump = self.plugin.parse_vrrp_dumps(['cat: /tmp/keepalived.data: No such file or directory'])
+
+        self.assertEqual(dump, keepalived.VrrpDump(None, {}, {}, 'cat: /tmp/keepalived.data: No such file or directory'))
+
+    def test_no_dump(self):
+        dump = self.plugin.parse_vrrp_dumps(['Keepalived is not running', '== data', '== stats'])
+
+        self.assertEqual(dump.dumped, None)
+        self.assertEqual(dump.error, 'Keepalived is not running')
+
+
+if __name__ == '__main__':
+    unittest.main()